@@ -0,0 +1,110 @@
+"""in memory citation graph for computing metrics
+
+metrics for a paper need the refereed flag and number of references of
+every paper that cites it.  rather than a query per paper, the graph is
+read from the row view once per run.  papers are nodes numbered by their
+row view id, the citing papers of node i are
+targets[offsets[i]:offsets[i + 1]] (compressed sparse row) and per node
+arrays hold the bibcode, refereed flag and the number of references,
+citations and authors.
+
+    graph = CitationGraph.build(nonbib_conn, 'nonbib')
+    for bibcode, refereed, reference_num in graph.citing(row.id):
+        ...
+"""
+
+from array import array
+
+from adsputils import setup_logging
+
+
+BIBCODE_WIDTH = 19
+
+
+class CitationGraph(object):
+
+    def __init__(self, bibcodes, refereed, reference_counts, offsets, targets, citation_counts=None, author_counts=None):
+        """bibcodes is a string of fixed width bibcodes indexed by node, the rest are arrays"""
+        self.bibcodes = bibcodes
+        self.refereed = refereed
+        self.reference_counts = reference_counts
+        self.offsets = offsets
+        self.targets = targets
+        self.citation_counts = citation_counts
+        self.author_counts = author_counts
+
+    # per node values, ordered by id so nodes are filled in order.  citation count includes
+    # citations not in the row view, it is the length of the citations array
+    nodes_sql = 'select id, bibcode, refereed, coalesce(array_length(reference, 1), 0), \
+                 coalesce(array_length(citations, 1), 0), coalesce(array_length(authors, 1), 0) \
+                 from {0}.rowviewm order by id'
+
+    # the ids of the papers citing each paper, in the order of its citations.  postgres
+    # joins every citation to the row view at once, citations not in the row view are dropped
+    edges_sql = \
+        'select r.id, array_agg(c.id order by u.n) from {0}.rowviewm as r \
+         cross join lateral unnest(r.citations) with ordinality as u(bibcode, n) \
+         join {0}.rowviewm as c on c.bibcode = u.bibcode \
+         group by r.id order by r.id'
+
+    @classmethod
+    def build(cls, nonbib_conn, row_view_schema='nonbib'):
+        """read the citation graph from the row view, two passes over server side cursors"""
+        logger = setup_logging('AdsDataSqlSync', 'INFO')
+        logger.info('citation graph, reading nodes from schema {}'.format(row_view_schema))
+        conn = nonbib_conn.execution_options(stream_results=True)
+        bibcodes = bytearray()
+        refereed = array('b')
+        reference_counts = array('i')
+        citation_counts = array('i')
+        author_counts = array('i')
+        for node, bibcode, is_refereed, reference_count, citation_count, author_count \
+                in conn.execute(cls.nodes_sql.format(row_view_schema)):
+            if node < len(refereed):
+                raise ValueError('citation graph, row view id {} for {} is not unique'.format(node, bibcode))
+            # ids are canonical line numbers, fill any gap with empty nodes
+            missing = node - len(refereed)
+            if missing > 0:
+                bibcodes.extend(' ' * BIBCODE_WIDTH * missing)
+                refereed.extend([0] * missing)
+                reference_counts.extend([0] * missing)
+                citation_counts.extend([0] * missing)
+                author_counts.extend([0] * missing)
+            bibcodes.extend(bibcode.encode('utf-8').ljust(BIBCODE_WIDTH)[:BIBCODE_WIDTH])
+            refereed.append(1 if is_refereed in (True, 't', 'true') else 0)
+            reference_counts.append(int(reference_count))
+            citation_counts.append(int(citation_count))
+            author_counts.append(int(author_count))
+        size = len(refereed)
+
+        logger.info('citation graph, reading edges for {} nodes from schema {}'.format(size, row_view_schema))
+        offsets = array('L')
+        targets = array('i')
+        for node, citing in conn.execute(cls.edges_sql.format(row_view_schema)):
+            while len(offsets) <= node:
+                offsets.append(len(targets))
+            # a citation listed twice is counted once, as the per paper query did
+            seen = set()
+            for c in citing:
+                if c not in seen:
+                    seen.add(c)
+                    targets.append(c)
+        while len(offsets) <= size:
+            offsets.append(len(targets))
+        logger.info('citation graph, {} nodes and {} edges'.format(size, len(targets)))
+        return cls(str(bibcodes), refereed, reference_counts, offsets, targets, citation_counts, author_counts)
+
+    def __len__(self):
+        return len(self.refereed)
+
+    def bibcode(self, node):
+        return self.bibcodes[node * BIBCODE_WIDTH:(node + 1) * BIBCODE_WIDTH].rstrip()
+
+    def citing(self, node):
+        """return list of (bibcode, refereed, reference count) for the papers citing node"""
+        if node is None or node < 0 or node >= len(self):
+            return []
+        refereed = self.refereed
+        reference_counts = self.reference_counts
+        return [(self.bibcode(c), refereed[c] == 1, reference_counts[c])
+                for c in self.targets[self.offsets[node]:self.offsets[node + 1]]]
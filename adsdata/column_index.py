@@ -0,0 +1,163 @@
+"""sidecar index from bibcode to the lines for that bibcode in a column file
+
+answers questions like what does the citation file say about a bibcode
+without scanning the file or loading it into postgres.  the index is
+written next to the column file (file name plus .idx) and holds three
+arrays in bibcode order: the fixed width bibcodes, the byte offset of
+each bibcode's first line and the length in bytes of its lines.
+
+    index = ColumnIndex.build('citation', filename)
+    index.save()
+    index = ColumnIndex.load(filename)
+    index.lookup('2015MNRAS.447.2671Z')   # lines from the file
+    index.row('2015MNRAS.447.2671Z')      # row as sent to postgres
+"""
+
+import os
+import json
+from array import array
+from bisect import bisect_left
+
+import reader
+
+
+BIBCODE_WIDTH = 19
+SUFFIX = '.idx'
+MAGIC = 'ADSCOLUMNINDEX1'
+
+
+class ColumnIndex(object):
+
+    def __init__(self, file_type, filename, bibcodes, offsets, lengths, source_size=None, source_mtime=None):
+        """bibcodes is a string of concatenated fixed width bibcodes, offsets and lengths are arrays"""
+        self.file_type = file_type
+        self.filename = filename
+        self.bibcodes = bibcodes
+        self.offsets = offsets
+        self.lengths = lengths
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self._keys = _FixedWidthKeys(bibcodes, BIBCODE_WIDTH)
+
+    @classmethod
+    def build(cls, file_type, filename):
+        """scan the column file and return its index"""
+        bibcodes = bytearray()
+        offsets = array('L')
+        lengths = array('I')
+        in_order = True
+        previous = ''
+        r = reader.StandardFileReader(file_type, filename, backend='mmap')
+        for bibcode, offset, length in r.group_offsets():
+            if bibcode < previous:
+                in_order = False
+            previous = bibcode
+            bibcodes.extend(bibcode)
+            offsets.append(offset)
+            lengths.append(length)
+        r.close()
+        bibcodes = str(bibcodes)
+        if not in_order:
+            # column files should be sorted, if not sort the index so bisect works
+            keys = _FixedWidthKeys(bibcodes, BIBCODE_WIDTH)
+            order = sorted(xrange(len(keys)), key=keys.__getitem__)
+            bibcodes = ''.join([keys[i] for i in order])
+            offsets = array('L', [offsets[i] for i in order])
+            lengths = array('I', [lengths[i] for i in order])
+        stat = os.stat(filename)
+        return cls(file_type, filename, bibcodes, offsets, lengths, stat.st_size, int(stat.st_mtime))
+
+    @classmethod
+    def load(cls, filename, index_filename=None, check=True):
+        """read the index for column file filename
+
+        with check, raise ValueError if the column file changed after the index was built"""
+        index_filename = index_filename or filename + SUFFIX
+        with open(index_filename, 'rb') as f:
+            magic = f.readline().rstrip('\n')
+            if magic != MAGIC:
+                raise ValueError('{} is not a column file index'.format(index_filename))
+            header = json.loads(f.readline())
+            count = header['count']
+            offsets = array(str(header['offset_type']))
+            lengths = array(str(header['length_type']))
+            if offsets.itemsize != header['offset_size'] or lengths.itemsize != header['length_size']:
+                raise ValueError('{} was written on a platform with different array sizes'.format(index_filename))
+            bibcodes = f.read(count * BIBCODE_WIDTH)
+            offsets.fromstring(f.read(count * offsets.itemsize))
+            lengths.fromstring(f.read(count * lengths.itemsize))
+        if len(bibcodes) != count * BIBCODE_WIDTH or len(offsets) != count or len(lengths) != count:
+            raise ValueError('{} is truncated'.format(index_filename))
+        if check:
+            stat = os.stat(filename)
+            if stat.st_size != header['source_size'] or int(stat.st_mtime) != header['source_mtime']:
+                raise ValueError('{} is out of date, {} changed after it was built'.format(index_filename, filename))
+        return cls(header['file_type'], filename, bibcodes, offsets, lengths,
+                   header['source_size'], header['source_mtime'])
+
+    def save(self, index_filename=None):
+        """write the index, by default next to the column file"""
+        index_filename = index_filename or self.filename + SUFFIX
+        header = {'file_type': self.file_type, 'count': len(self),
+                  'offset_type': self.offsets.typecode, 'offset_size': self.offsets.itemsize,
+                  'length_type': self.lengths.typecode, 'length_size': self.lengths.itemsize,
+                  'source_size': self.source_size, 'source_mtime': self.source_mtime}
+        # write then rename so a reader never sees a partial index
+        tmp_filename = index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(MAGIC + '\n')
+            f.write(json.dumps(header) + '\n')
+            f.write(self.bibcodes)
+            self.offsets.tofile(f)
+            self.lengths.tofile(f)
+        os.rename(tmp_filename, index_filename)
+        return index_filename
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, bibcode):
+        return self.find(bibcode) is not None
+
+    def find(self, bibcode):
+        """return (offset, length) of the lines for bibcode or None"""
+        i = bisect_left(self._keys, bibcode)
+        if i < len(self) and self._keys[i] == bibcode:
+            return self.offsets[i], self.lengths[i]
+        return None
+
+    def lookup(self, bibcode):
+        """return the lines in the column file for bibcode, without newlines"""
+        location = self.find(bibcode)
+        if location is None:
+            return []
+        offset, length = location
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            return f.read(length).rstrip('\n').split('\n')
+
+    def row(self, bibcode):
+        """return the row for bibcode as the reader sends it to postgres, '' if not in the file"""
+        location = self.find(bibcode)
+        if location is None:
+            return ''
+        offset, length = location
+        r = reader.StandardFileReader(self.file_type, self.filename, start_offset=offset, end_offset=offset + length,
+                                      quarantine=False)
+        row = r.read()
+        r.close()
+        return row
+
+
+class _FixedWidthKeys(object):
+    """sequence view of a string of fixed width keys, for bisect"""
+
+    def __init__(self, keys, width):
+        self._keys = keys
+        self._width = width
+
+    def __len__(self):
+        return len(self._keys) // self._width
+
+    def __getitem__(self, i):
+        return self._keys[i * self._width:(i + 1) * self._width]
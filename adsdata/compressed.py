@@ -0,0 +1,189 @@
+"""read compressed column files
+
+column files can be stored as .gz, .zst or .lz4 rather than uncompressed.
+open_column_file returns a file like object over the decompressed lines
+so readers can iterate over it like a plain file.  zstandard and lz4 are
+optional packages, only needed when files use those formats.
+
+with ahead > 0 decompression runs on a background thread that keeps up
+to ahead chunks of decompressed data queued for the parsing thread.
+"""
+
+import io
+import os
+import threading
+import zlib
+import Queue
+
+
+SUFFIXES = ('.gz', '.zst', '.lz4')
+
+# bytes of compressed data read from disk at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_compressed(filename):
+    return filename.endswith(SUFFIXES)
+
+
+def resolve_column_file(filename):
+    """return filename, or the compressed variant of it when only that exists"""
+    if os.path.exists(filename) or is_compressed(filename):
+        return filename
+    for suffix in SUFFIXES:
+        if os.path.exists(filename + suffix):
+            return filename + suffix
+    return filename
+
+
+def open_column_file(filename, ahead=0):
+    """return a read only file like object with the decompressed lines of filename"""
+    chunks = decompressed_chunks(filename)
+    if ahead > 0:
+        chunks = ReadAhead(chunks, ahead)
+    return LineStream(chunks)
+
+
+def decompressed_chunks(filename):
+    """return iterator over the decompressed contents of filename, chosen by suffix"""
+    if filename.endswith('.gz'):
+        return _gzip_chunks(filename)
+    elif filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading {} requires the zstandard package'.format(filename))
+        return _zstd_chunks(filename, zstandard)
+    elif filename.endswith('.lz4'):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('reading {} requires the lz4 package'.format(filename))
+        return _lz4_chunks(filename, lz4.frame)
+    raise ValueError('unknown compressed file type {}, expected one of {}'.format(filename, SUFFIXES))
+
+
+def _gzip_chunks(filename):
+    # zlib directly rather than the gzip module, which splits lines in python.
+    # a gzip file can hold several members, each needs a new decompressor
+    with open(filename, 'rb') as f:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = f.read(CHUNK_SIZE)
+        while data:
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            if decompressor.unused_data:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = f.read(CHUNK_SIZE)
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def _zstd_chunks(filename, zstandard):
+    with open(filename, 'rb') as f:
+        for chunk in zstandard.ZstdDecompressor().read_to_iter(f, read_size=CHUNK_SIZE):
+            yield chunk
+
+
+def _lz4_chunks(filename, lz4_frame):
+    with lz4_frame.open(filename, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = f.read(CHUNK_SIZE)
+
+
+class LineStream(object):
+    """iterate over the lines in an iterator of byte strings
+
+    each chunk is split with io.BytesIO, iterating over it is much faster than
+    io.BufferedReader over a raw stream written in python"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._lines = self._split(chunks)
+
+    def _split(self, chunks):
+        tail = ''
+        for chunk in chunks:
+            for line in io.BytesIO(tail + chunk if tail else chunk):
+                if line[-1] != '\n':
+                    # partial line at the end of the chunk
+                    tail = line
+                    break
+                yield line
+            else:
+                tail = ''
+        if tail:
+            yield tail
+
+    def __iter__(self):
+        return self._lines
+
+    def next(self):
+        return next(self._lines)
+
+    def readline(self):
+        return next(self._lines, '')
+
+    def close(self):
+        self._lines.close()
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
+
+class ReadAhead(object):
+    """iterate over chunks produced by a background thread
+
+    the thread keeps at most depth chunks queued, an exception raised while
+    decompressing is raised again in the reading thread"""
+
+    _done = object()
+
+    def __init__(self, chunks, depth):
+        self._queue = Queue.Queue(depth)
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._fill, args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self, chunks):
+        try:
+            for chunk in chunks:
+                if self._stop.is_set():
+                    return
+                self._queue.put(chunk)
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            self._queue.put(self._done)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._finished:
+            raise StopIteration
+        chunk = self._queue.get()
+        if chunk is self._done:
+            self._finished = True
+            raise StopIteration
+        if isinstance(chunk, Exception):
+            self._finished = True
+            raise chunk
+        return chunk
+
+    def close(self):
+        """stop the thread, unblocking it if it is waiting on a full queue"""
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self._finished = True
@@ -0,0 +1,98 @@
+"""compare two versions of a column file without loading either into postgres
+
+column files are sorted by bibcode (see reader.collation_key) so yesterday's and
+today's version of a file can be merged in one streaming pass, like comm.
+the lines for each bibcode are grouped by the StandardFileReader used for
+ingest, so lines it skips as invalid are skipped here too.
+
+    for action, bibcode, values in diff_column_file('reads', baseline_filename, filename):
+        ...
+
+write_column_file_delta writes the lines of the added and changed bibcodes
+as a small column file, which is loaded with the usual readers in place of
+the full file, and lists the bibcodes that changed.
+"""
+
+import os
+
+from adsputils import load_config
+import reader
+import compressed
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+# column files with only a bibcode on each line
+bibcode_only_types = ('canonical', 'refereed', 'pub_openaccess', 'private', 'ocrabstract', 'nonarticle')
+
+
+def column_file_groups(file_type, filename, collation=None):
+    """yield (bibcode, values) for each valid bibcode in filename, nothing when there is no such file
+
+    raises ValueError when filename is not sorted in collation"""
+    filename = compressed.resolve_column_file(filename)
+    if not os.path.exists(filename):
+        return
+    # the merge in diff_groups is only right for sorted files
+    r = reader.StandardFileReader(file_type, filename, quarantine=False, collation=collation, order_required=True)
+    try:
+        for group in r.groups():
+            yield group
+    finally:
+        r.close()
+
+
+def diff_groups(baseline_groups, current_groups, sort_key=reader.collation_key('nocase')):
+    """merge two sorted iterators of (bibcode, values), yield (action, bibcode, values) for each difference
+
+    values are from current_groups, except for removed bibcodes.  sort_key
+    orders bibcodes as they are sorted in both iterators"""
+    baseline = next(baseline_groups, None)
+    current = next(current_groups, None)
+    while baseline is not None or current is not None:
+        if current is None or (baseline is not None and sort_key(baseline[0]) < sort_key(current[0])):
+            yield REMOVED, baseline[0], baseline[1]
+            baseline = next(baseline_groups, None)
+        elif baseline is None or sort_key(current[0]) < sort_key(baseline[0]):
+            yield ADDED, current[0], current[1]
+            current = next(current_groups, None)
+        else:
+            if baseline[1] != current[1]:
+                yield CHANGED, current[0], current[1]
+            baseline = next(baseline_groups, None)
+            current = next(current_groups, None)
+
+
+def diff_column_file(file_type, baseline_filename, filename, collation=None):
+    """yield (action, bibcode, values) for each bibcode that differs between two versions of a column file
+
+    a missing baseline file means every bibcode was added.  collation is how
+    both files are sorted, default comes from COLUMN_FILE_COLLATION in config"""
+    collation = collation or load_config().get('COLUMN_FILE_COLLATION', 'nocase')
+    return diff_groups(column_file_groups(file_type, baseline_filename, collation),
+                       column_file_groups(file_type, filename, collation), reader.collation_key(collation))
+
+
+def group_lines(file_type, bibcode, values):
+    """return the column file lines for bibcode"""
+    if file_type in bibcode_only_types:
+        return [bibcode + '\n']
+    return [bibcode + '\t' + value + '\n' for value in values]
+
+
+def write_column_file_delta(file_type, baseline_filename, filename, lines_file, bibcodes_file, label='',
+                            collation=None):
+    """write the differences between two versions of a column file, return dict of action to count
+
+    the current lines of added and changed bibcodes go to lines_file, they
+    are a valid column file for file_type.  every bibcode that differs goes to
+    bibcodes_file as label, action and bibcode separated by tabs"""
+    counts = {ADDED: 0, REMOVED: 0, CHANGED: 0}
+    for action, bibcode, values in diff_column_file(file_type, baseline_filename, filename, collation):
+        counts[action] += 1
+        bibcodes_file.write('{}\t{}\t{}\n'.format(label, action, bibcode))
+        if action != REMOVED:
+            lines_file.writelines(group_lines(file_type, bibcode, values))
+    return counts
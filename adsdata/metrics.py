@@ -5,25 +5,63 @@ from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import CreateSchema, DropSchema
 from sqlalchemy import and_
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, text
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 from collections import defaultdict
 from datetime import datetime
 import time
 import sys
 import json
 import argparse
+import multiprocessing
+from cStringIO import StringIO
 
 from adsputils import load_config, setup_logging
 import nonbib
 import models
+from citation_graph import CitationGraph
+import metrics_batch
 
 
 Base = declarative_base()
 meta = MetaData()
 metrics_logger = None
 
+# the citation graph and batch of an update_metrics_parallel worker process, see init_metrics_worker
+_worker = {}
+
+
+def init_metrics_worker(graph, batch):
+    """pool initializer for update_metrics_parallel, the forked worker shares graph and batch with the parent"""
+    _worker['graph'] = graph
+    _worker['batch'] = batch
+
+
+def update_metrics_range(args):
+    """worker for update_metrics_parallel, copies one range and its checkpoint in one transaction"""
+    metrics_connection_string, nonbib_connection_string, row_view_schema, schema, start, end = args
+    metrics_engine = create_engine(metrics_connection_string, poolclass=NullPool)
+    nonbib_engine = create_engine(nonbib_connection_string, poolclass=NullPool)
+    nonbib_conn = nonbib_engine.connect()
+    raw_conn = metrics_engine.raw_connection()
+    try:
+        cur = raw_conn.cursor()
+        m = Metrics(schema)
+        row_count = m.copy_metrics_range(cur, nonbib_conn, row_view_schema, _worker['graph'], start, end,
+                                         _worker['batch'])
+        cur.execute('insert into {}.metrics_checkpoint (range_start, range_end, row_count, finished) '
+                    'values (%s, %s, %s, now())'.format(schema), (start, end, row_count))
+        raw_conn.commit()
+        cur.close()
+    finally:
+        raw_conn.close()
+        nonbib_conn.close()
+        metrics_engine.dispose()
+        nonbib_engine.dispose()
+    return start, end, row_count
+
 
 class Metrics():
     """computes and provides interface for metrics data"""
@@ -61,7 +99,7 @@ class Metrics():
 
 
     def save(self, db_conn, values):
-        """buffered save does actual save every 100 records, call flush at end of processing"""
+        """buffered save does actual save every METRICS_FLUSH_SIZE records, call flush at end of processing"""
 
         bibcode = values.bibcode
         if bibcode is None:
@@ -71,22 +109,47 @@ class Metrics():
         self.upserts.append(values)
 
         self.tmp_count += 1
-        if (self.tmp_count % 100) == 0:
+        if (self.tmp_count % self.config.get('METRICS_FLUSH_SIZE', 10000)) == 0:
             self.flush(db_conn)
             self.tmp_count = 0
 
 
+    # temporary table flush copies into, it has the metrics columns other than id and no constraints
+    staging_table_sql = 'create temporary table if not exists metrics_staging on commit delete rows as \
+        select {1} from {0}.metrics where false'
+
+    # move the staged rows into the metrics table, a bibcode already there is updated in place
+    merge_staging_sql = 'insert into {0}.metrics ({1}) select {1} from metrics_staging \
+        on conflict (bibcode) do update set {2}'
+
     def flush(self, db_conn):
-        """bulk write records to sql database"""
+        """bulk write records to sql database
 
-        Session = sessionmaker()
-        sess = Session(bind=db_conn)
-        sess.execute('set search_path to {}'.format('metrics'))
-        #sess.bulk_save_objects(self.upserts)
+        the buffered records are written with to_sql into a copy to a temporary
+        table, then merged into the metrics table with one insert ... on conflict"""
+        if not self.upserts:
+            return
+        # a bibcode can only be merged once per statement, the last record saved wins
+        latest = {}
+        for current in self.upserts:
+            latest[current.bibcode] = current
+        buffer = StringIO()
         for current in self.upserts:
-            sess.add(current)
-        sess.commit()
-        sess.close()
+            if latest[current.bibcode] is not current:
+                continue
+            metrics_dict = dict((column, getattr(current, column)) for column in self.copy_columns)
+            line = self.to_sql(metrics_dict, include_id=False)
+            buffer.write((line.encode('utf-8') if isinstance(line, unicode) else line) + '\n')
+        buffer.seek(0)
+        columns = self.copy_columns[1:]
+        raw_conn = db_conn.connection
+        cur = raw_conn.cursor()
+        cur.execute(self.staging_table_sql.format(self.schema, ', '.join(columns)))
+        cur.copy_from(buffer, 'metrics_staging', columns=columns)
+        cur.execute(self.merge_staging_sql.format(self.schema, ', '.join(columns),
+                                                  ', '.join('{0} = excluded.{0}'.format(c) for c in columns[1:])))
+        raw_conn.commit()
+        cur.close()
         self.upserts = []
 
 
@@ -110,35 +173,70 @@ class Metrics():
 
 
     def update_metrics_changed(self, db_conn, nonbib_conn, row_view_schema='ingest'):  
-        """changed bibcodes are in sql table, for each we update metrics record"""
+        """changed bibcodes are in sql table, update their metrics records a page at a time
+
+        see update_metrics_page, METRICS_DELTA_PAGE_SIZE bibcodes are read, computed
+        and written together"""
         Nonbib_Session = sessionmaker(bind=nonbib_conn)
         nonbib_sess = Nonbib_Session()
         nonbib_sess.execute('set search_path to {}'.format(row_view_schema))
+        bibcodes = [row.bibcode for row in nonbib_sess.query(models.NonBibDeltaTable.bibcode)]
+        nonbib_sess.close()
 
-        Metrics_Session = sessionmaker()
-        metrics_sess = Metrics_Session(bind=db_conn)
-        metrics_sess.execute('set search_path to {}'.format('metrics'))
-        
-        sql_sync = nonbib.NonBib(row_view_schema)
-        query = nonbib_sess.query(models.NonBibTable)
+        # reading the whole citation graph only pays off for a large delta
+        graph = None
+        if len(bibcodes) >= self.config.get('METRICS_GRAPH_MIN_DELTA', 100000):
+            graph = CitationGraph.build(nonbib_conn, row_view_schema)
+        page_size = self.config.get('METRICS_DELTA_PAGE_SIZE', 1000)
         count = 0
-        for delta_row in nonbib_sess.query(models.NonBibDeltaTable).yield_per(100):
-            row = sql_sync.get_by_bibcode(nonbib_conn, delta_row.bibcode)
-            metrics_old = metrics_sess.query(models.MetricsTable).filter(models.MetricsTable.bibcode == delta_row.bibcode).first()
-            metrics_new = self.row_view_to_metrics(row, nonbib_conn, row_view_schema, metrics_old)
-            if metrics_old:
-                metrics_sess.merge(metrics_new)
-            else:
-                metrics_sess.add(metrics_new)
-            metrics_sess.commit()
-
-            if (count % 10000) == 0:
-                self.logger.debug('delta count = {}, bibcode = {}'.format(count, delta_row.bibcode))
-            count += 1
-        nonbib_sess.close()
-        metrics_sess.close()
+        for i in xrange(0, len(bibcodes), page_size):
+            count += self.update_metrics_page(db_conn, nonbib_conn, bibcodes[i:i + page_size], row_view_schema, graph)
+            self.logger.debug('delta count = {}, bibcode = {}'.format(count, bibcodes[i]))
+        self.logger.info('metrics.py, updated {} metrics records for {} changed bibcodes'.format(count, len(bibcodes)))
+
+    # the papers citing each of a list of bibcodes, in the order of its citations
+    page_citing_sql = 'select r.bibcode, c.bibcode, c.refereed, array_length(c.reference, 1) from {0}.rowviewm as r \
+        cross join lateral unnest(r.citations) with ordinality as u(bibcode, n) \
+        join {0}.rowviewm as c on c.bibcode = u.bibcode \
+        where r.bibcode = any(:bibcodes) order by r.bibcode, u.n'
+
+    def page_citing(self, nonbib_conn, bibcodes, row_view_schema='nonbib'):
+        """return dict of bibcode to its citing papers as (bibcode, refereed, reference count)
+
+        the citing papers are in the order of the bibcode's citations, the order
+        CitationGraph.citing gives them in"""
+        citing = defaultdict(list)
+        seen = set()
+        q = text(self.page_citing_sql.format(row_view_schema))
+        for bibcode, citation_bibcode, citation_refereed, len_citation_reference \
+                in nonbib_conn.execute(q, bibcodes=list(bibcodes)):
+            # a citation listed twice is counted once, as the per paper query did
+            if (bibcode, citation_bibcode) not in seen:
+                seen.add((bibcode, citation_bibcode))
+                citing[bibcode].append((citation_bibcode, citation_refereed in (True, 't', 'true'),
+                                        int(len_citation_reference) if len_citation_reference else 0))
+        return citing
+
+    def update_metrics_page(self, db_conn, nonbib_conn, bibcodes, row_view_schema='nonbib', graph=None):
+        """compute and write the metrics records for a list of bibcodes, returns the number written
+
+        one query reads the row view rows, without graph one more reads their citing
+        papers, and flush writes the records in one merge and commit.  the merge
+        updates a bibcode already in the metrics table, so existing records are not read"""
+        sql_sync = nonbib.NonBib(row_view_schema)
+        rows = sql_sync.get_by_bibcodes(nonbib_conn, bibcodes)
+        citing = None
+        if graph is None:
+            citing = self.page_citing(nonbib_conn, bibcodes, row_view_schema)
+        for row in rows:
+            m = self.row_view_to_metrics(row, nonbib_conn, row_view_schema, graph=graph,
+                                         citing=citing.get(row.bibcode, []) if citing is not None else None)
+            self.upserts.append(m)
+        if len(rows) < len(bibcodes):
+            self.logger.info('metrics.py, {} of {} changed bibcodes are not in the row view'
+                             .format(len(bibcodes) - len(rows), len(bibcodes)))
         self.flush(db_conn)
-        # need to close?
+        return len(rows)
 
     def update_metrics_bibcode(self, bibcode, db_conn, nonbib_conn, row_view_schema='nonbib'):  #, delta_schema='delta'):
         """changed bibcodes are in sql table, for each we update metrics record"""
@@ -167,13 +265,22 @@ class Metrics():
         self.save(metrics_dict)
         self.flush()
 
-    def to_sql(self, metrics_dict):
-        """return string representation of metrics data suitable for postgres copy from program"""
-        return_str = str(metrics_dict['id']) + '\t' + metrics_dict['bibcode']
+    # metrics table columns in the order to_sql writes them
+    copy_columns = ('id', 'bibcode', 'refereed', 'rn_citations', 'rn_citation_data', 'rn_citations_hist',
+                    'downloads', 'reads', 'an_citations', 'refereed_citation_num', 'citation_num', 'reference_num',
+                    'citations', 'refereed_citations', 'author_num', 'an_refereed_citations', 'modtime')
+
+    def to_sql(self, metrics_dict, include_id=True):
+        """return string representation of metrics data suitable for postgres copy from program
+
+        without include_id the columns are copy_columns[1:]"""
+        return_str = str(metrics_dict['id']) + '\t' if include_id else ''
+        return_str += metrics_dict['bibcode']
         return_str += '\t' + str(metrics_dict['refereed'])
         return_str += '\t' + str(metrics_dict['rn_citations'])
-        return_str += '\t' + json.dumps(metrics_dict['rn_citation_data'])
-        return_str += '\t' + json.dumps(metrics_dict['rn_citations_hist'])
+        # backslash is the escape character in copy's text format
+        return_str += '\t' + json.dumps(metrics_dict['rn_citation_data']).replace('\\', '\\\\')
+        return_str += '\t' + json.dumps(metrics_dict['rn_citations_hist']).replace('\\', '\\\\')
         return_str += '\t' + '{' + str(metrics_dict['downloads']).strip('[]') + '}'
         return_str += '\t' + '{' + str(metrics_dict['reads']).strip('[]') + '}'
         return_str += '\t' + str(metrics_dict['an_citations'])
@@ -189,19 +296,34 @@ class Metrics():
 
 
     def update_metrics_all(self, db_conn, nonbib_conn, row_view_schema='ingest', start_offset=1, end_offset=-1):
-        """update all elements in the metrics database between the passed id offsets"""
+        """update all elements in the metrics database between the passed id offsets
+
+        start_offset is the first row view id, rows up to but not including
+        end_offset are updated, all rows from start_offset when it is -1"""
         # we request one block of rows from the database at a time
         start_time = time.time()
         step_size = 1000
         count = 0
         offset = start_offset
         max_rows = self.config['MAX_ROWS']
+        engine = self.config.get('METRICS_ENGINE', 'row')
+        whole_table = max_rows <= 0 and start_offset <= 1 and end_offset == -1
+        if engine == 'sql' and whole_table and self.use_sql(db_conn, nonbib_conn):
+            self.update_metrics_all_sql(db_conn, row_view_schema)
+            return
+        if engine == 'batch' and whole_table and self.use_batch(db_conn):
+            self.update_metrics_all_batch(db_conn, nonbib_conn, row_view_schema)
+            return
         sql_sync = nonbib.NonBib(row_view_schema)
         Session = sessionmaker(bind=nonbib_conn)
         session = Session()
         session.execute('set search_path to {}'.format(row_view_schema))
-        for current_row in session.query(models.NonBibTable).yield_per(100):
-            metrics_dict = self.row_view_to_metrics(current_row, nonbib_conn, row_view_schema)
+        graph = CitationGraph.build(nonbib_conn, row_view_schema)
+        query = session.query(models.NonBibTable).filter(models.NonBibTable.id >= start_offset)
+        if end_offset != -1:
+            query = query.filter(models.NonBibTable.id < end_offset)
+        for current_row in query.yield_per(100):
+            metrics_dict = self.row_view_to_metrics(current_row, nonbib_conn, row_view_schema, graph=graph)
             self.save(db_conn, metrics_dict)
             count += 1
             if max_rows > 0 and count > max_rows:
@@ -212,14 +334,273 @@ class Metrics():
         end_time = time.time()
 
 
+    def use_batch(self, db_conn):
+        """return True if the batch engine can write the metrics table, it needs numpy and an empty table"""
+        try:
+            metrics_batch.import_numpy()
+        except ImportError as e:
+            self.logger.warn('metrics.py, {}, computing metrics row by row'.format(e))
+            return False
+        if db_conn.execute('select exists (select 1 from {}.metrics)'.format(self.schema)).scalar():
+            self.logger.info('metrics.py, metrics table in schema {} is not empty, computing metrics row by row'
+                             .format(self.schema))
+            return False
+        return True
+
+    def update_metrics_all_batch(self, db_conn, nonbib_conn, row_view_schema='nonbib'):
+        """compute metrics for every row view row with numpy and copy them into the empty metrics table
+
+        the numbers are computed for METRICS_BATCH_SIZE papers at a time (see
+        metrics_batch.py) and written with one copy per block, everything is
+        committed at the end.  the metrics id is the row view id, see advance_id_sequence"""
+        start_time = time.time()
+        graph = CitationGraph.build(nonbib_conn, row_view_schema)
+        batch = metrics_batch.MetricsBatch(graph)
+        raw_conn = db_conn.connection
+        cur = raw_conn.cursor()
+        count = self.copy_metrics_range(cur, nonbib_conn, row_view_schema, graph, 0, len(graph), batch)
+        self.advance_id_sequence(cur)
+        raw_conn.commit()
+        cur.close()
+        self.logger.info('metrics.py, batch metrics wrote {} rows to schema {} in {:.1f} seconds'
+                         .format(count, self.schema, time.time() - start_time))
+
+    # the sql engine, statements run in order in one transaction with {0} the metrics schema,
+    # {1} the row view schema and {2} the current year.  edges has one row per citing paper in
+    # the row view, a citation listed twice is kept once at its first position
+    metrics_sql = (
+        'create unlogged table {0}.metrics_sql_edges as \
+         select distinct on (r.id, c.id) r.id as paper, u.n, c.bibcode, c.refereed, \
+                1.0::float8 / greatest(5, coalesce(array_length(c.reference, 1), 0)) as ref_norm, \
+                1.0::float8 / greatest(coalesce(array_length(r.authors, 1), 0), 1) as auth_norm, \
+                substr(r.bibcode, 1, 4)::int as pubyear, substr(c.bibcode, 1, 4)::int as cityear \
+         from {1}.rowviewm as r cross join lateral unnest(r.citations) with ordinality as u(bibcode, n) \
+         join {1}.rowviewm as c on c.bibcode = u.bibcode \
+         order by r.id, c.id, u.n',
+        # sums in citation order so they match row_view_to_metrics to the last bit
+        'create unlogged table {0}.metrics_sql_citing as \
+         select paper, sum(ref_norm order by n) as rn_citations, \
+                count(*) filter (where refereed) as refereed_citation_num, \
+                array_agg(bibcode order by n) filter (where refereed) as refereed_citations, \
+                json_agg(json_build_object(\'bibcode\', bibcode, \'ref_norm\', ref_norm, \'auth_norm\', auth_norm, \
+                                           \'pubyear\', pubyear, \'cityear\', cityear) order by n) as rn_citation_data \
+         from {0}.metrics_sql_edges group by paper',
+        # each citing paper adds the running total of ref_norm within its paper to its year
+        'create unlogged table {0}.metrics_sql_hist as \
+         select paper, json_object_agg(cityear, total) as rn_citations_hist from \
+           (select paper, cityear, sum(running order by n) as total from \
+             (select paper, n, substr(bibcode, 1, 4) as cityear, \
+                     sum(ref_norm) over (partition by paper order by n) as running \
+              from {0}.metrics_sql_edges) as e \
+            group by paper, cityear) as h \
+         group by paper',
+        'insert into {0}.metrics (id, bibcode, refereed, rn_citations, rn_citation_data, rn_citations_hist, \
+                                  downloads, reads, an_citations, refereed_citation_num, citation_num, reference_num, \
+                                  citations, refereed_citations, author_num, an_refereed_citations, modtime) \
+         select r.id, r.bibcode, r.refereed, coalesce(c.rn_citations, 0), coalesce(c.rn_citation_data, \'[]\'), \
+                coalesce(h.rn_citations_hist, \'{{}}\'), r.downloads, r.reads, \
+                coalesce(array_length(r.citations, 1), 0)::float8 / greatest(1, {2} - substr(r.bibcode, 1, 4)::int + 1), \
+                coalesce(c.refereed_citation_num, 0), coalesce(array_length(r.citations, 1), 0), \
+                coalesce(array_length(r.reference, 1), 0), r.citations, coalesce(c.refereed_citations, \'{{}}\'), \
+                greatest(coalesce(array_length(r.authors, 1), 0), 1), \
+                coalesce(c.refereed_citation_num, 0)::float8 / greatest(1, {2} - substr(r.bibcode, 1, 4)::int + 1), \
+                now() \
+         from {1}.rowviewm as r left join {0}.metrics_sql_citing as c on c.paper = r.id \
+         left join {0}.metrics_sql_hist as h on h.paper = r.id',
+        'drop table {0}.metrics_sql_edges, {0}.metrics_sql_citing, {0}.metrics_sql_hist')
+
+    def use_sql(self, db_conn, nonbib_conn):
+        """return True if the sql engine can write the metrics table
+
+        the metrics table must be empty and in the same database as the row view"""
+        if str(db_conn.engine.url) != str(nonbib_conn.engine.url):
+            self.logger.warn('metrics.py, the sql engine needs the metrics table and row view in one database, '
+                             'computing metrics row by row')
+            return False
+        if db_conn.execute('select exists (select 1 from {}.metrics)'.format(self.schema)).scalar():
+            self.logger.info('metrics.py, metrics table in schema {} is not empty, computing metrics row by row'
+                             .format(self.schema))
+            return False
+        return True
+
+    def update_metrics_all_sql(self, db_conn, row_view_schema='nonbib', year=None):
+        """compute metrics for every row view row inside postgres and insert them into the empty metrics table
+
+        see metrics_sql, the citing papers are joined to the row view and
+        aggregated with set based statements that postgres can run with
+        METRICS_SQL_WORKERS parallel workers.  the metrics id is the row view id,
+        see advance_id_sequence"""
+        start_time = time.time()
+        year = year or datetime.today().year
+        trans = db_conn.begin()
+        try:
+            db_conn.execute('set local max_parallel_workers_per_gather = {}'
+                            .format(int(self.config.get('METRICS_SQL_WORKERS', 4))))
+            # json floats in full precision, as json.dumps writes them
+            db_conn.execute('set local extra_float_digits = 3')
+            for sql_command in self.metrics_sql:
+                db_conn.execute(sql_command.format(self.schema, row_view_schema, int(year)))
+            self.advance_id_sequence(db_conn)
+            trans.commit()
+        except:
+            # the work tables are dropped with the rest of the transaction
+            trans.rollback()
+            raise
+        count = db_conn.execute('select count(*) from {}.metrics'.format(self.schema)).scalar()
+        self.logger.info('metrics.py, sql metrics wrote {} rows to schema {} in {:.1f} seconds'
+                         .format(count, self.schema, time.time() - start_time))
+
+    def compare_engines(self, db_conn, nonbib_conn, bibcodes, row_view_schema='nonbib', metrics_logger=None):
+        """spot check the metrics table against row_view_to_metrics for a list of bibcodes
+
+        the records written by any engine are compared field by field with
+        metrics_mismatch, returns a dict of bibcode to mismatched fields.  the
+        citing papers are read in citation order, the order every engine sums
+        them in, so the running totals in rn_citations_hist agree"""
+        metrics_logger = metrics_logger or self.logger
+        Session = sessionmaker(bind=db_conn)
+        session = Session()
+        session.execute('set search_path to {}'.format(self.schema))
+        sql_sync = nonbib.NonBib(row_view_schema)
+        rows = dict((row.bibcode, row) for row in sql_sync.get_by_bibcodes(nonbib_conn, bibcodes))
+        citing = self.page_citing(nonbib_conn, bibcodes, row_view_schema)
+        mismatches = {}
+        for bibcode in bibcodes:
+            stored = self.get_by_bibcode(session, bibcode)
+            computed = None
+            if bibcode in rows:
+                computed = self.row_view_to_metrics(rows[bibcode], nonbib_conn, row_view_schema,
+                                                    citing=citing.get(bibcode, []))
+            mismatch = Metrics.metrics_mismatch(bibcode, stored, computed, metrics_logger)
+            if mismatch:
+                mismatches[bibcode] = mismatch
+        session.close()
+        metrics_logger.info('metrics.py, compared {} bibcodes, {} mismatched'.format(len(bibcodes), len(mismatches)))
+        return mismatches
+
+    # the bulk engines copy the row view id into the serial id column, that does not advance its sequence
+    advance_id_sql = "select setval(pg_get_serial_sequence('{0}.metrics', 'id'), max(id)) from {0}.metrics"
+
+    def advance_id_sequence(self, conn):
+        """move the metrics id sequence to the largest id in the table, call after copying rows with ids
+
+        otherwise records inserted later by flush are given ids already in the
+        table.  an empty table leaves the sequence as it is"""
+        conn.execute(self.advance_id_sql.format(self.schema))
+
+    # the row view rows with ids in a range, for copy_metrics_range
+    range_rows_sql = 'select id, bibcode, refereed, citations, reads, downloads, authors, reference ' \
+                     'from {0}.rowviewm where id >= %s and id < %s order by id'
+
+    def copy_metrics_range(self, cur, nonbib_conn, row_view_schema, graph, start, end, batch=None):
+        """compute metrics for the row view ids start up to end and copy them into the metrics table
+
+        with batch, a MetricsBatch of graph, the numbers are computed for
+        METRICS_BATCH_SIZE papers at a time, otherwise by row_view_to_metrics.
+        rows are copied every METRICS_BATCH_SIZE rows over cur with the row
+        view id as their id, the caller commits and calls advance_id_sequence.
+        returns the number of rows"""
+        block_size = self.config.get('METRICS_BATCH_SIZE', 100000)
+        table_name = '{}.metrics'.format(self.schema)
+        end = min(end, len(graph))
+        block = None
+        buffer = StringIO()
+        count = 0
+        rows = nonbib_conn.execution_options(stream_results=True).execute(self.range_rows_sql.format(row_view_schema),
+                                                                           start, end)
+        for row in rows:
+            if batch is not None:
+                if block is None or row.id >= block.end:
+                    block = batch.compute(row.id, min(row.id + block_size, end))
+                metrics_dict = block.metrics_dict(row.id, row.bibcode)
+                metrics_dict.update(bibcode=row.bibcode, refereed=row.refereed, citations=row.citations,
+                                    reads=row.reads, downloads=row.downloads)
+            else:
+                m = self.row_view_to_metrics(row, nonbib_conn, row_view_schema, graph=graph)
+                metrics_dict = dict((column, getattr(m, column)) for column in self.copy_columns)
+            metrics_dict['id'] = row.id
+            line = self.to_sql(metrics_dict)
+            buffer.write((line.encode('utf-8') if isinstance(line, unicode) else line) + '\n')
+            count += 1
+            if count % block_size == 0:
+                buffer.seek(0)
+                cur.copy_from(buffer, table_name, columns=self.copy_columns)
+                buffer = StringIO()
+                self.logger.debug('metrics.py, metrics copied = {}'.format(count))
+        if buffer.tell():
+            buffer.seek(0)
+            cur.copy_from(buffer, table_name, columns=self.copy_columns)
+        return count
+
+    checkpoint_table_sql = 'create table if not exists {0}.metrics_checkpoint \
+        (range_start integer primary key, range_end integer, row_count integer, finished timestamp)'
+
+    def update_metrics_parallel(self, db_engine, nonbib_engine, row_view_schema='nonbib', workers=4, range_size=1000000):
+        """compute metrics for ranges of row view ids in a pool of worker processes
+
+        the citation graph is built once before the pool starts and handed to
+        the forked workers by the pool initializer.  with METRICS_ENGINE 'batch'
+        the workers compute with a MetricsBatch of it, otherwise row by row as
+        update_metrics_all does.  each worker opens its own pair of connections and
+        copies a range (see copy_metrics_range) in one transaction together
+        with its row in metrics_checkpoint.  ranges with a checkpoint are
+        skipped, after a failure run again to finish the remaining ranges.
+        the metrics table must be empty or filled by an earlier run with the
+        same range_size.  once every range is done the id sequence is advanced"""
+        start_time = time.time()
+        db_engine.execute(self.checkpoint_table_sql.format(self.schema))
+        done = set((row[0], row[1]) for row in
+                   db_engine.execute('select range_start, range_end from {}.metrics_checkpoint'.format(self.schema)))
+        if not done and db_engine.execute('select exists (select 1 from {}.metrics)'.format(self.schema)).scalar():
+            raise ValueError('metrics table in schema {} is not empty and has no checkpoints'.format(self.schema))
+
+        nonbib_conn = nonbib_engine.connect()
+        graph = CitationGraph.build(nonbib_conn, row_view_schema)
+        nonbib_conn.close()
+        batch = None
+        if self.config.get('METRICS_ENGINE', 'row') == 'batch':
+            try:
+                metrics_batch.import_numpy()
+                batch = metrics_batch.MetricsBatch(graph)
+            except ImportError as e:
+                self.logger.warn('metrics.py, {}, computing metrics row by row'.format(e))
+        ranges = [(start, min(start + range_size, len(graph))) for start in xrange(0, len(graph), range_size)]
+        if done - set(ranges):
+            raise ValueError('metrics checkpoints in schema {} were written with a different range size'
+                             .format(self.schema))
+        todo = [r for r in ranges if r not in done]
+        self.logger.info('metrics.py, {} of {} ranges already done, computing {} ranges with {} workers'
+                         .format(len(done), len(ranges), len(todo), workers))
+        args = [(str(db_engine.url), str(nonbib_engine.url), row_view_schema, self.schema, start, end)
+                for start, end in todo]
+        pool = multiprocessing.Pool(workers, init_metrics_worker, (graph, batch))
+        try:
+            count = 0
+            for start, end, row_count in pool.imap_unordered(update_metrics_range, args):
+                count += row_count
+                self.logger.info('metrics.py, finished ids {} to {}, {} rows'.format(start, end, row_count))
+        finally:
+            pool.close()
+            pool.join()
+        # the ranges were copied with their row view ids.  the sequence is set once every range is
+        # committed, workers setting it concurrently could move it backwards
+        self.advance_id_sequence(db_engine)
+        self.logger.info('metrics.py, parallel metrics wrote {} rows in {:.1f} seconds'
+                         .format(count, time.time() - start_time))
+
     # normalized citations:
     #  for a list of N papers (the citations?)
     #  a = number of authors for the publication
     #  c = number of citations tha paper received (why not call it references?)
     #  c/a = normalized citations
     #  sum over N papers
-    def row_view_to_metrics(self, passed_row_view, nonbib_db_conn, row_view_schema='nonbib', m=None):
-        """convert the passed row view into a complete metrics dictionary"""
+    def row_view_to_metrics(self, passed_row_view, nonbib_db_conn, row_view_schema='nonbib', m=None, graph=None,
+                            citing=None):
+        """convert the passed row view into a complete metrics dictionary
+
+        the citing papers are citing, a list of (bibcode, refereed, reference count)
+        read by the caller, or come from graph, a CitationGraph of the row view, or
+        without either from a query per call"""
         if m is None:
             m = models.MetricsTable()            
         # first do easy fields
@@ -248,16 +629,15 @@ class Metrics():
         citations_histogram = defaultdict(float)
         total_normalized_citations = 0.0
         if citations:
-            q = 'select refereed,array_length(reference,1),bibcode from ' + row_view_schema + \
-                '.RowViewM where bibcode in (select unnest(citations) from ' + row_view_schema + \
-                '.RowViewM where bibcode=%s);'
-            result = nonbib_db_conn.execute(q,bibcode)
-            for row in result:
-                citation_refereed = row[0] if row[0] else False
-                citation_refereed = citation_refereed in (True, 't', 'true')
-                len_citation_reference = int(row[1]) if row[1] else 0
-                citation_bibcode = row[2]
-
+            if citing is None and graph is not None:
+                citing = graph.citing(passed_row_view.id)
+            elif citing is None:
+                q = 'select refereed,array_length(reference,1),bibcode from ' + row_view_schema + \
+                    '.RowViewM where bibcode in (select unnest(citations) from ' + row_view_schema + \
+                    '.RowViewM where bibcode=%s);'
+                citing = [(row[2], row[0] in (True, 't', 'true'), int(row[1]) if row[1] else 0)
+                          for row in nonbib_db_conn.execute(q, bibcode)]
+            for citation_bibcode, citation_refereed, len_citation_reference in citing:
                 citation_normalized_references = 1.0 / float(max(5, len_citation_reference))
                 total_normalized_citations += citation_normalized_references
                 normalized_reference += citation_normalized_references
@@ -331,6 +711,10 @@ class Metrics():
             return False
 
         if fieldname in ('downloads', 'reads'):
+            if not v1 or not v2:
+                if v1 != v2:
+                    metrics_logger.warn('{} {} arrays differ: {} {}'.format(bibcode, fieldname, v1, v2))
+                return v1 != v2
             # only last value may be different to account for slightly older test data
             t1 = v1[:-1]
             t2 = v2[:-1]
@@ -0,0 +1,126 @@
+"""compute metrics for every paper in the row view with numpy
+
+the per paper numbers are vectorized over the arrays of a CitationGraph.
+papers are handled in blocks of consecutive ids, for a block the citing
+papers of all its papers form one array of edges and sums per paper are
+bincounts over the paper each edge belongs to:
+
+    ref_norm               1 / max(5, reference count of the citing paper), per edge
+    rn_citations           sum of ref_norm
+    refereed_citation_num  sum of the refereed flags of the citing papers
+    an_citations           citation count / age in years
+
+the lists in a metrics record (rn_citation_data, refereed_citations,
+citations, reads and downloads) and rn_citations_hist, the running total
+of ref_norm per paper added to the citing paper's year, are still built
+per paper in the same order as the row engine, see
+Metrics.update_metrics_all_batch.  numpy is an optional package, only
+needed for METRICS_ENGINE = 'batch'.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+from citation_graph import BIBCODE_WIDTH
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('the batch metrics engine requires the numpy package')
+    return numpy
+
+
+class MetricsBatch(object):
+
+    def __init__(self, graph, year=None):
+        np = import_numpy()
+        self.np = np
+        self.graph = graph
+        self.year = year or datetime.today().year
+        self.offsets = np.frombuffer(graph.offsets, dtype='u{}'.format(graph.offsets.itemsize)).astype(np.int64)
+        self.targets = np.frombuffer(graph.targets, dtype='i{}'.format(graph.targets.itemsize))
+        self.refereed = np.frombuffer(graph.refereed, dtype=np.int8)
+        self.reference_counts = np.frombuffer(graph.reference_counts, dtype='i{}'.format(graph.reference_counts.itemsize))
+        self.citation_counts = np.frombuffer(graph.citation_counts, dtype='i{}'.format(graph.citation_counts.itemsize))
+        self.author_counts = np.frombuffer(graph.author_counts, dtype='i{}'.format(graph.author_counts.itemsize))
+        # publication year from the first four characters of each fixed width bibcode
+        digits = np.frombuffer(graph.bibcodes, dtype=np.uint8).reshape(-1, BIBCODE_WIDTH)
+        digits = digits[:, :4].astype(np.int32) - ord('0')
+        self.years = np.where(((digits >= 0) & (digits <= 9)).all(axis=1),
+                              digits.dot(np.array([1000, 100, 10, 1], dtype=np.int32)), 0)
+
+    def compute(self, start, end):
+        """return a Block with the metrics of papers with ids start up to end"""
+        np = self.np
+        count = end - start
+        first, last = self.offsets[start], self.offsets[end]
+        targets = self.targets[first:last]
+        # the paper in this block each edge belongs to
+        edge_paper = np.repeat(np.arange(count), np.diff(self.offsets[start:end + 1]))
+        ref_norm = 1.0 / np.maximum(5, self.reference_counts[targets]).astype(np.float64)
+        cited_refereed = self.refereed[targets]
+
+        rn_citations = np.bincount(edge_paper, weights=ref_norm, minlength=count)
+        refereed_citation_num = np.bincount(edge_paper, weights=cited_refereed, minlength=count).astype(np.int64)
+        citation_num = self.citation_counts[start:end]
+        author_num = np.maximum(self.author_counts[start:end], 1)
+        age = np.maximum(1.0, self.year - self.years[start:end] + 1)
+        an_citations = citation_num / age
+        an_refereed_citations = refereed_citation_num / age
+        return Block(self, start, end, ref_norm, cited_refereed, rn_citations, refereed_citation_num, citation_num,
+                     author_num, an_citations, an_refereed_citations)
+
+
+class Block(object):
+    """metrics for the papers with ids start up to end, arrays are indexed by id - start"""
+
+    def __init__(self, batch, start, end, ref_norm, cited_refereed, rn_citations, refereed_citation_num, citation_num,
+                 author_num, an_citations, an_refereed_citations):
+        self.batch = batch
+        self.start = start
+        self.end = end
+        self.ref_norm = ref_norm
+        self.cited_refereed = cited_refereed
+        self.rn_citations = rn_citations
+        self.refereed_citation_num = refereed_citation_num
+        self.citation_num = citation_num
+        self.author_num = author_num
+        self.an_citations = an_citations
+        self.an_refereed_citations = an_refereed_citations
+
+    def metrics_dict(self, node, bibcode):
+        """return the computed fields of paper node as a dict with the names to_sql expects"""
+        i = node - self.start
+        batch = self.batch
+        graph = batch.graph
+        first = batch.offsets[self.start]
+        edge_start, edge_end = batch.offsets[node] - first, batch.offsets[node + 1] - first
+        auth_norm = 1.0 / int(self.author_num[i])
+        pubyear = int(bibcode[:4])
+        rn_citation_data = []
+        refereed_citations = []
+        # running total of ref_norm from the first citing paper of this paper, summed
+        # in the same order as row_view_to_metrics so the values are identical
+        hist = defaultdict(float)
+        running = 0.0
+        for e in xrange(edge_start, edge_end):
+            citation_bibcode = graph.bibcode(batch.targets[first + e])
+            ref_norm = float(self.ref_norm[e])
+            rn_citation_data.append({'bibcode': citation_bibcode, 'ref_norm': ref_norm,
+                                     'auth_norm': auth_norm, 'pubyear': pubyear, 'cityear': int(citation_bibcode[:4])})
+            if self.cited_refereed[e]:
+                refereed_citations.append(citation_bibcode)
+            running += ref_norm
+            hist[citation_bibcode[:4]] += running
+        return {'rn_citations': float(self.rn_citations[i]),
+                'rn_citation_data': rn_citation_data,
+                'rn_citations_hist': dict(hist),
+                'an_citations': float(self.an_citations[i]),
+                'an_refereed_citations': float(self.an_refereed_citations[i]),
+                'refereed_citation_num': int(self.refereed_citation_num[i]),
+                'refereed_citations': refereed_citations,
+                'citation_num': int(self.citation_num[i]),
+                'reference_num': int(graph.reference_counts[node]),
+                'author_num': int(self.author_num[i])}
@@ -151,6 +151,8 @@ class DataLinksTable(Base):
     url = Column(ARRAY(String))
     title = Column(ARRAY(String))
     item_count = Column(Integer)
+    # md5 of the row content from the reader, see reader.datalinks_digest
+    digest = Column(String)
 
 column_tables = (CanonicalTable, AuthorTable, RefereedTable, SimbadTable, NedTable,
                  GrantsTable, CitationTable, RelevanceTable, ReaderTable, DownloadTable, ReadsTable, ReferenceTable,
@@ -8,6 +8,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.sql import select
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.schema import CreateSchema, DropSchema
+from sqlalchemy.pool import NullPool
+from multiprocessing.pool import ThreadPool
+from datetime import datetime
 import sys
 import argparse
 
@@ -17,6 +20,22 @@ import models
 Base = declarative_base()
 
 
+# columns holding a row view row's content, every column but bibcode and id
+row_hash_columns = ('authors', 'refereed', 'pub_openaccess', 'private', 'nonarticle', 'ocrabstract',
+                    'simbad_objects', 'ned_objects', 'grants', 'citations', 'boost', 'citation_count',
+                    'read_count', 'norm_cites', 'readers', 'downloads', 'reference', 'reads')
+
+
+def with_row_hash(select_sql):
+    """wrap a select of the row view columns, adding row_hash
+
+    row_hash is the md5 of the row's content stored as a uuid, two rows with
+    the same content have the same hash so changed rows are found by
+    comparing one 16 byte column rather than every column"""
+    return 'select joined.*, md5(row(' + ', '.join(['joined.' + c for c in row_hash_columns]) \
+        + ')::text)::uuid as row_hash from (' + select_sql + ') as joined'
+
+
 class NonBib:
     """manages 12 fields of nonbibliographic data
     
@@ -69,16 +88,78 @@ class NonBib:
         #db_engine.execute(DropSchema(self.schema))
         self.logger.info('row_view, dropped database column tables in schema {}'.format(self.schema))
 
-    def create_joined_rows(self, db_conn):
-        """join sql tables initialized from the flat/column files into a unified row view"""
-        self.logger.info('row_view, creating joined materialized view in schema {}'.format(self.schema))
+    def copy_column_tables(self, db_conn, source_schema):
+        """fill the empty column tables of this schema (see create_column_tables) with the rows from source_schema
+
+        columns the source tables predate, e.g. the datalinks digest, are left null"""
         Session = sessionmaker()
         sess = Session(bind=db_conn)
-        sql_command = NonBib.create_view_sql.format(self.schema)
+        for t in models.column_tables:
+            name = t.__tablename__
+            columns = ', '.join([c.name for c in t.__table__.columns if self.has_column(db_conn, source_schema, name, c.name)])
+            sess.execute('insert into {0}.{2} ({3}) select {3} from {1}.{2}'.format(self.schema, source_schema, name, columns))
+        sess.commit()
+        for t in models.column_tables:
+            sess.execute('analyze {}.{}'.format(self.schema, t.__tablename__))
+        sess.commit()
+        sess.close()
+        self.logger.info('row_view, copied column tables from schema {} into schema {}'.format(source_schema, self.schema))
+
+    def copy_row_view(self, db_conn, source_schema):
+        """copy the row view table of source_schema into this schema, see copy_row_view_sql"""
+        Session = sessionmaker()
+        sess = Session(bind=db_conn)
+        for sql_command in self.copy_row_view_sql(db_conn, source_schema):
+            sess.execute(sql_command)
+        sess.commit()
+        sess.execute('analyze {}.rowviewm'.format(self.schema))
+        sess.commit()
+        sess.close()
+        self.logger.info('row_view, copied joined table from schema {} into schema {}'.format(source_schema, self.schema))
+
+    def copy_row_view_sql(self, db_conn, source_schema):
+        """return the sql copying the row view table of source_schema into this schema, with its indexes
+
+        a partitioned row view is copied partition by partition into the same partitions"""
+        partitions = self.get_partition_bounds(db_conn, source_schema, 'rowviewm')
+        if not partitions:
+            return ['create table {0}.rowviewm as select * from {1}.rowviewm'.format(self.schema, source_schema),
+                    'alter table {}.rowviewm add primary key (bibcode)'.format(self.schema),
+                    'create index on {}.rowviewm (id)'.format(self.schema)]
+        sql = ['create table {0}.rowviewm (like {1}.rowviewm) partition by hash (bibcode)'.format(self.schema, source_schema)]
+        for partition, bound in partitions:
+            sql.append('create table {0}.{1} partition of {0}.rowviewm {2}'.format(self.schema, partition, bound))
+            sql.append('insert into {0}.{2} select * from {1}.{2}'.format(self.schema, source_schema, partition))
+        sql.append('create unique index on {}.rowviewm (bibcode)'.format(self.schema))
+        sql.append('create index on {}.rowviewm (id)'.format(self.schema))
+        return sql
+
+    def create_joined_rows(self, db_conn, as_table=False, partitions=0):
+        """join sql tables initialized from the flat/column files into a unified row view
+
+        as_table creates a regular table rather than a materialized view, it
+        can then be carried forward and updated by update_joined_rows.
+        partitions more than 1 creates a table partitioned by hash of bibcode,
+        see create_partitioned_rows"""
+        if partitions > 1:
+            self.create_partitioned_rows(db_conn, partitions)
+            return
+        self.logger.info('row_view, creating joined {} in schema {}'.format('table' if as_table else 'materialized view',
+                                                                            self.schema))
+        Session = sessionmaker()
+        sess = Session(bind=db_conn)
+        if as_table:
+            sql_command = NonBib.create_view_table_sql.format(self.schema)
+        else:
+            sql_command = NonBib.create_view_sql.format(self.schema)
         sess.execute(sql_command)
         sess.commit()
         
-        sql_command = 'create index on {}.RowViewM (bibcode)'.format(self.schema)
+        if as_table:
+            # upserts need a unique constraint on bibcode
+            sql_command = 'alter table {}.RowViewM add primary key (bibcode)'.format(self.schema)
+        else:
+            sql_command = 'create index on {}.RowViewM (bibcode)'.format(self.schema)
         sess.execute(sql_command)
         sql_command = 'create index on {}.RowViewM (id)'.format(self.schema)
         sess.execute(sql_command)
@@ -86,18 +167,211 @@ class NonBib:
         sess.close()
         self.logger.info('row_view, joined rows in schema {}'.format(self.schema))
     
+    def create_partitioned_rows(self, db_conn, partitions):
+        """create the row view as a table partitioned by hash of bibcode
+
+        each partition is filled and indexed over its own connection, all
+        partitions at once.  a partition's bibcodes are picked from canonical
+        before the join, so the partitions split the join rather than each
+        joining every bibcode and discarding the rest.  the work is done by
+        postgres so a thread per partition is enough.  queries against rowviewm
+        are unchanged, postgres routes lookups by bibcode to one partition"""
+        self.logger.info('row_view, creating joined table with {} partitions in schema {}'.format(partitions, self.schema))
+        Session = sessionmaker()
+        sess = Session(bind=db_conn)
+        # an empty table from the view's select gives the column types for the partitioned table
+        sess.execute('CREATE TABLE {0}.rowviewm_columns AS '.format(self.schema)
+                     + with_row_hash(NonBib.row_view_select_sql + ' from '
+                                     + NonBib.row_view_from_sql.format(self.schema) + ' where false') + ';')
+        sess.execute('create table {0}.rowviewm (like {0}.rowviewm_columns) partition by hash (bibcode)'.format(self.schema))
+        sess.execute('drop table {0}.rowviewm_columns'.format(self.schema))
+        for remainder in range(partitions):
+            sess.execute('create table {0}.rowviewm_p{1} partition of {0}.rowviewm for values with (modulus {2}, remainder {1})'
+                         .format(self.schema, remainder, partitions))
+        sess.commit()
+
+        pool = ThreadPool(partitions)
+        try:
+            pool.map(self.fill_partition, [(str(db_conn.engine.url), partitions, remainder) for remainder in range(partitions)],
+                     chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # the indexes built on each partition are attached rather than built again
+        sess.execute('create unique index on {}.rowviewm (bibcode)'.format(self.schema))
+        sess.execute('create index on {}.rowviewm (id)'.format(self.schema))
+        sess.commit()
+        sess.close()
+        self.logger.info('row_view, joined rows in {} partitions in schema {}'.format(partitions, self.schema))
+
+    def fill_partition(self, args):
+        """join the rows of one hash partition of the row view and index them, runs on its own connection"""
+        connection_string, partitions, remainder = args
+        engine = create_engine(connection_string, poolclass=NullPool)
+        try:
+            conn = engine.connect()
+            sess = sessionmaker()(bind=conn)
+            sess.execute(NonBib.fill_partition_sql.format(self.schema, remainder, partitions))
+            sess.execute('create unique index on {0}.rowviewm_p{1} (bibcode)'.format(self.schema, remainder))
+            sess.execute('create index on {0}.rowviewm_p{1} (id)'.format(self.schema, remainder))
+            sess.commit()
+            sess.close()
+            conn.close()
+        finally:
+            engine.dispose()
+        self.logger.info('row_view, filled partition {} of {} in schema {}'.format(remainder, partitions, self.schema))
+
+    def update_joined_rows(self, db_conn, baseline_schema, partitions=0, copy_baseline=False):
+        """build the row view from the baseline's row view, rejoining only the bibcodes that changed
+
+        the bibcodes whose rows differ in any column table between the two
+        schemas are found with except and saved in changedbibcodes.  the
+        baseline row view table is then moved into this schema and updated in
+        place: rows for bibcodes no longer in canonical are deleted and the
+        changed bibcodes are rejoined and upserted.  the baseline keeps a
+        table with the previous rows of just the changed bibcodes, which is
+        all create_delta_rows and log_delta_reasons compare.
+
+        everything runs in one transaction so a failure leaves the baseline
+        untouched.  when the baseline row view is not a table (e.g., a
+        materialized view from a full rebuild) or predates row_hash the row
+        view is created from scratch.  a partitioned baseline row view is moved
+        with its partitions and keeps its number of partitions.
+
+        with copy_baseline the baseline row view is copied rather than moved and
+        the baseline is left as it was, for a baseline that is still being read
+        (see rotation.py).  a partitioned row view is copied partition by partition"""
+        kind = self.get_relation_kind(db_conn, baseline_schema, 'rowviewm')
+        if kind not in ('r', 'p') or not self.has_column(db_conn, baseline_schema, 'rowviewm', 'row_hash'):
+            self.logger.info('row_view, no row view table to carry forward in baseline schema {}, creating from scratch'
+                             .format(baseline_schema))
+            self.create_joined_rows(db_conn, as_table=True, partitions=partitions)
+            return
+        self.logger.info('row_view, updating joined table from schema {} into schema {}'.format(baseline_schema, self.schema))
+        Session = sessionmaker()
+        sess = Session(bind=db_conn)
+        sess.execute(self.changed_bibcodes_sql().format(self.schema, baseline_schema))
+        sess.execute('alter table {}.changedbibcodes add primary key (bibcode)'.format(self.schema))
+        count = sess.execute('select count(*) from {}.changedbibcodes'.format(self.schema)).scalar()
+        self.logger.info('row_view, {} bibcodes changed since schema {}'.format(count, baseline_schema))
+        if copy_baseline:
+            for sql_command in self.copy_row_view_sql(db_conn, baseline_schema):
+                sess.execute(sql_command)
+        else:
+            for partition in self.get_partition_names(db_conn, baseline_schema, 'rowviewm'):
+                sess.execute('alter table {1}.{2} set schema {0}'.format(self.schema, baseline_schema, partition))
+            sess.execute('alter table {1}.rowviewm set schema {0}'.format(self.schema, baseline_schema))
+            sess.execute(NonBib.save_baseline_rows_sql.format(self.schema, baseline_schema))
+            sess.execute('alter table {}.rowviewm add primary key (bibcode)'.format(baseline_schema))
+        sess.execute(NonBib.delete_removed_rows_sql.format(self.schema))
+        sess.execute(NonBib.upsert_changed_rows_sql.format(self.schema))
+        # id is the line number in canonical, bibcodes added or removed shift the ids that follow them
+        sess.execute(NonBib.update_ids_sql.format(self.schema))
+        sess.commit()
+        sess.execute('analyze {}.rowviewm'.format(self.schema))
+        sess.commit()
+        sess.close()
+        self.logger.info('row_view, updated joined table in schema {}'.format(self.schema))
+
+    def update_changed_rows(self, db_conn, baseline_schema):
+        """rejoin the row view rows of bibcodes whose column table rows were updated in place
+
+        the bibcodes come from filedelta, written by a file level diff of the
+        column files (see diff.py).  the row view and column tables are copies
+        of the baseline schema's, which is left unchanged.  changedrowsm is
+        built from the bibcodes whose row_hash differs from the baseline's,
+        the new bibcodes and the bibcodes with changed data links.  the row
+        view must be a table with row_hash"""
+        self.logger.info('row_view, updating joined table from file deltas in schema {}'.format(self.schema))
+        Session = sessionmaker()
+        sess = Session(bind=db_conn)
+        sess.execute('drop table if exists {0}.changedbibcodes; drop table if exists {0}.changedrowsm'.format(self.schema))
+        sess.execute(NonBib.file_delta_bibcodes_sql.format(self.schema))
+        sess.execute('alter table {}.changedbibcodes add primary key (bibcode)'.format(self.schema))
+        sess.execute(NonBib.delete_removed_rows_sql.format(self.schema))
+        sess.execute(NonBib.upsert_changed_rows_sql.format(self.schema))
+        sess.execute(NonBib.update_ids_sql.format(self.schema))
+        sess.execute(NonBib.create_changed_from_previous_sql.format(self.schema, baseline_schema))
+        sess.execute(NonBib.include_file_delta_datalinks_sql.format(self.schema))
+        sess.commit()
+        sess.execute('analyze {}.rowviewm'.format(self.schema))
+        sess.commit()
+        sess.close()
+        self.logger.info('row_view, updated joined table from file deltas in schema {}'.format(self.schema))
+
+    def changed_bibcodes_sql(self):
+        """return sql creating changedbibcodes, {0} is this schema and {1} the baseline
+
+        a bibcode is changed when its row differs in either direction in any
+        of the joined tables.  canonical is compared on bibcode alone since
+        its id is a line number, see update_ids_sql"""
+        diffs = ['select bibcode from {0}.canonical except select bibcode from {1}.canonical',
+                 'select bibcode from {1}.canonical except select bibcode from {0}.canonical']
+        for t in NonBib.row_view_tables:
+            for a, b in (('{0}', '{1}'), ('{1}', '{0}')):
+                diffs.append('select bibcode from (select * from {a}.{t} except select * from {b}.{t}) as {t}_diff'
+                             .format(a=a, b=b, t=t))
+        # union and except have equal precedence, each difference needs its parentheses
+        return 'create table {0}.changedbibcodes as (' + ') union ('.join(diffs) + ');'
+
+    def get_relation_kind(self, db_conn, schema, name):
+        """return the postgres relkind ('r' table, 'p' partitioned table, 'm' materialized view) of schema.name
+
+        None if it does not exist"""
+        sql_command = "select c.relkind from pg_class c join pg_namespace n on n.oid = c.relnamespace " \
+                      "where n.nspname = '{}' and c.relname = '{}'".format(schema, name)
+        return db_conn.execute(sql_command).scalar()
+
+    def get_partition_names(self, db_conn, schema, name):
+        """return the names of the partitions of schema.name, empty when it is not partitioned"""
+        sql_command = "select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid " \
+                      "join pg_class p on p.oid = i.inhparent join pg_namespace n on n.oid = p.relnamespace " \
+                      "where n.nspname = '{}' and p.relname = '{}' order by c.relname".format(schema, name)
+        return [row[0] for row in db_conn.execute(sql_command)]
+
+    def get_partition_bounds(self, db_conn, schema, name):
+        """return (name, bound) for each partition of schema.name, bound is the partition's for values clause"""
+        sql_command = "select c.relname, pg_get_expr(c.relpartbound, c.oid) from pg_inherits i " \
+                      "join pg_class c on c.oid = i.inhrelid join pg_class p on p.oid = i.inhparent " \
+                      "join pg_namespace n on n.oid = p.relnamespace " \
+                      "where n.nspname = '{}' and p.relname = '{}' order by c.relname".format(schema, name)
+        return [(row[0], row[1]) for row in db_conn.execute(sql_command)]
+
+    def has_column(self, db_conn, schema, name, column):
+        """return True if the table or view schema.name has column
+
+        information_schema does not list the columns of materialized views, so use pg_attribute"""
+        sql_command = "select count(*) from pg_attribute a join pg_class c on c.oid = a.attrelid " \
+                      "join pg_namespace n on n.oid = c.relnamespace where n.nspname = '{}' and c.relname = '{}' " \
+                      "and a.attname = '{}' and not a.attisdropped".format(schema, name, column)
+        return db_conn.execute(sql_command).scalar() > 0
+
     def create_delta_rows(self, db_conn, baseline_schema):
+        """find bibcodes whose row differs from the baseline, new bibcodes and bibcodes with new data links
+
+        rows are compared on row_hash, a row view built before row_hash was
+        added is compared column by column"""
         self.logger.info('row_view, creating delta/changed and new table in schema {}'.format(self.schema))
         Session = sessionmaker()
         sess = Session(bind=db_conn)
-        sql_command = NonBib.create_changed_sql.format(self.schema, baseline_schema)
+        if self.has_column(db_conn, self.schema, 'rowviewm', 'row_hash') \
+                and self.has_column(db_conn, baseline_schema, 'rowviewm', 'row_hash'):
+            sql_command = NonBib.create_changed_hash_sql.format(self.schema, baseline_schema)
+        else:
+            self.logger.info('row_view, no row_hash in schema {}, comparing every column'.format(baseline_schema))
+            sql_command = NonBib.create_changed_sql.format(self.schema, baseline_schema)
         sess.execute(sql_command)
         sess.commit()
         sql_command = NonBib.include_new_bibcodes_sql.format(self.schema, baseline_schema)
         sess.execute(sql_command)
         sess.commit()
         # resolver
-        sql_command = NonBib.include_update_resolver_bibcodes_sql.format(self.schema, baseline_schema)
+        if self.has_column(db_conn, baseline_schema, 'datalinks', 'digest'):
+            sql_command = NonBib.include_update_resolver_bibcodes_sql.format(self.schema, baseline_schema)
+        else:
+            self.logger.info('row_view, no datalinks digest in schema {}, comparing every column'.format(baseline_schema))
+            sql_command = NonBib.include_update_resolver_columns_sql.format(self.schema, baseline_schema)
         sess.execute(sql_command)
         sess.commit()
         sess.close()
@@ -146,32 +420,66 @@ class NonBib:
         
 
 
-    def log_delta_reasons(self, db_conn, baseline_schema):
-        """log the counts for the changes in each column from baseline """
+    def log_delta_reasons(self, db_conn, baseline_schema, stats_schema=None):
+        """log the counts for the changes in each column from baseline
+
+        every bibcode with a changed column is in changedrowsm, so the counts
+        for all columns come from one pass over the changed rows.
+        with stats_schema the counts are also saved to its delta_stats table,
+        which is kept across runs so counts can be compared from day to day"""
         Session = sessionmaker()
         sess = Session(bind=db_conn)
         sql_command = 'select count(*) from ' + self.schema + '.changedrowsm'
-        r = sess.execute(sql_command)
-        m = 'nonbib delta, total number of changed bibcodes: {}'.format(r.scalar())
+        total = sess.execute(sql_command).scalar()
+        m = 'nonbib delta, total number of changed bibcodes: {}'.format(total)
         print m
         self.logger.info(m)
         
         column_names = ('authors', 'refereed', 'simbad_objects', 'grants', 'citations',
                         'boost', 'citation_count', 'read_count', 'norm_cites',
                         'readers', 'downloads', 'reads', 'reference', 'ned_objects')
-        for column_name in column_names:
-            if column_name != 'canonical':
-                sql_command = 'select count(*) from ' + self.schema \
-                    + '.rowviewm, ' + baseline_schema + '.rowviewm ' \
-                    + ' where ' + self.schema + '.rowviewm.bibcode=' + baseline_schema + '.rowviewm.bibcode' \
-                    + ' and ' + self.schema + '.rowviewm.' + column_name + '!=' + baseline_schema + '.rowviewm.' + column_name+ ';'
-
-            r = sess.execute(sql_command)
-            m = 'nonbib delta, number of {} different: {}'.format(column_name, r.scalar())
+        sql_command = 'select ' \
+            + ', '.join(['count(*) filter (where current.{0} is distinct from baseline.{0})'.format(c) for c in column_names]) \
+            + ' from (select distinct bibcode from {0}.changedrowsm) as changed' \
+              ' join {0}.rowviewm as current on current.bibcode = changed.bibcode' \
+              ' join {1}.rowviewm as baseline on baseline.bibcode = changed.bibcode;'.format(self.schema, baseline_schema)
+        counts = sess.execute(sql_command).first()
+        for column_name, count in zip(column_names, counts):
+            m = 'nonbib delta, number of {} different: {}'.format(column_name, count)
             print m
             self.logger.info(m)
         sess.commit()
         sess.close()
+        if stats_schema:
+            self.save_delta_stats(db_conn, baseline_schema, stats_schema,
+                                  [('total', total)] + zip(column_names, counts))
+
+    def get_delta_stats_table(self, stats_schema, meta=None):
+        """ delta_stats holds the number of changed bibcodes, in total and per column, for each run"""
+        if meta is None:
+            meta = self.meta
+        return Table('delta_stats', meta,
+                     Column('run', DateTime, primary_key=True),
+                     Column('column_name', String, primary_key=True),
+                     Column('changed_count', Integer),
+                     Column('row_view_schema', String),
+                     Column('baseline_schema', String),
+                     schema=stats_schema,
+                     extend_existing=True)
+
+    def save_delta_stats(self, db_conn, baseline_schema, stats_schema, counts):
+        """add a run to delta_stats, counts is a list of (column_name, changed_count)
+
+        the schema and table are created on first use"""
+        db_conn.execute('create schema if not exists {}'.format(stats_schema))
+        temp_meta = MetaData()
+        table = self.get_delta_stats_table(stats_schema, temp_meta)
+        temp_meta.create_all(db_conn, checkfirst=True)
+        run = datetime.utcnow()
+        db_conn.execute(table.insert(), [{'run': run, 'column_name': column_name, 'changed_count': count,
+                                          'row_view_schema': self.schema, 'baseline_schema': baseline_schema}
+                                         for column_name, count in counts])
+        self.logger.info('row_view, saved delta stats for {} to {}.delta_stats'.format(run, stats_schema))
         
 
 
@@ -234,6 +542,7 @@ class NonBib:
         """ return a list of row view datbase objects matching the list of passed bibcodes"""
         Session = sessionmaker()
         sess = Session(bind=db_conn)
+        models.NonBibTable.__table__.schema = self.schema
         query = sess.query(models.NonBibTable).filter(models.NonBibTable.bibcode.in_(bibcodes))
         results = query.all()
         sess.close()
@@ -273,9 +582,9 @@ class NonBib:
                 count += 1
         return count
 
-    create_view_sql =     \
-        'CREATE MATERIALIZED VIEW {0}.rowviewm AS  \
-         select bibcode,  \
+    # the columns of the row view, missing values get defaults
+    row_view_select_sql =     \
+        'select bibcode,  \
 	      id,         \
               coalesce(authors, ARRAY[]::text[]) as authors,    \
               coalesce(refereed, FALSE) as refereed,            \
@@ -294,8 +603,11 @@ class NonBib:
               coalesce(readers, ARRAY[]::text[]) as readers,    \
               coalesce(downloads, ARRAY[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]) as downloads, \
               coalesce(reference, ARRAY[]::text[]) as reference, \
-              coalesce(reads, ARRAY[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]) as reads \
-       from {0}.Canonical natural left join {0}.Author \
+              coalesce(reads, ARRAY[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]) as reads '
+
+    # the column tables joined to canonical to make the row view
+    row_view_joins_sql = \
+       ' natural left join {0}.Author \
        natural left join {0}.Refereed                 \
        natural left join {0}.pub_openaccess           \
        natural left join {0}.private           \
@@ -305,7 +617,69 @@ class NonBib:
        natural left join {0}.Citation  natural left join {0}.Ned   \
        natural left join {0}.Relevance natural left join {0}.Reader \
        natural left join {0}.Download natural left join {0}.Reads   \
-       natural left join {0}.Reference;' 
+       natural left join {0}.Reference'
+
+    # the column tables joined into the row view
+    row_view_from_sql = ' {0}.Canonical' + row_view_joins_sql
+
+    create_view_sql = 'CREATE MATERIALIZED VIEW {0}.rowviewm AS ' \
+        + with_row_hash(row_view_select_sql + ' from ' + row_view_from_sql) + ';'
+
+    # the row view as a regular table, so it can be updated in place by update_joined_rows
+    create_view_table_sql = 'CREATE TABLE {0}.rowviewm AS ' \
+        + with_row_hash(row_view_select_sql + ' from ' + row_view_from_sql) + ';'
+
+    # joined rows for one hash partition, {1} is the remainder and {2} the number of partitions.
+    # canonical is filtered before the joins, so each partition joins just its share of the bibcodes
+    fill_partition_sql = 'insert into {0}.rowviewm_p{1} ' \
+        + with_row_hash(row_view_select_sql + ' from (select * from {0}.Canonical'
+                        + ' where satisfies_hash_partition(\'{0}.rowviewm\'::regclass, {2}, {1}, bibcode)) as Canonical'
+                        + row_view_joins_sql) + ';'
+
+    # joined rows for the bibcodes in changedbibcodes, inserted or replacing the existing row
+    upsert_changed_rows_sql = 'insert into {0}.rowviewm ' \
+        + with_row_hash(row_view_select_sql + ' from {0}.changedbibcodes natural join ' + row_view_from_sql) \
+        + ' on conflict (bibcode) do update set ' \
+        + ', '.join([c + ' = excluded.' + c for c in ('id',) + row_hash_columns + ('row_hash',)]) + ';'
+
+    # column tables joined into the row view after canonical
+    row_view_tables = ('author', 'refereed', 'pub_openaccess', 'private', 'nonarticle', 'ocrabstract',
+                       'simbad', 'grants', 'citation', 'ned', 'relevance', 'reader', 'download',
+                       'reads', 'reference')
+
+    # previous rows of the changed bibcodes, left in the baseline for delta comparisons
+    save_baseline_rows_sql = \
+        'create table {1}.rowviewm as \
+         select {0}.rowviewm.* from {0}.rowviewm natural join {0}.changedbibcodes;'
+
+    # bibcodes in the row view tables that differ between the baseline and current column files
+    file_delta_bibcodes_sql = \
+        'create table {0}.changedbibcodes as \
+         select distinct bibcode from {0}.filedelta where file_type != \'datalinks\';'
+
+    # bibcodes whose row changed or is new, compared with the baseline's row view
+    create_changed_from_previous_sql = \
+        'create table {0}.ChangedRowsM as \
+         select {0}.RowViewM.bibcode, {0}.RowViewM.id \
+         from {0}.RowViewM join {0}.changedbibcodes on {0}.RowViewM.bibcode = {0}.changedbibcodes.bibcode \
+         left join {1}.RowViewM on {0}.RowViewM.bibcode = {1}.RowViewM.bibcode \
+         where {1}.RowViewM.bibcode is null or {0}.RowViewM.row_hash != {1}.RowViewM.row_hash;'
+
+    include_file_delta_datalinks_sql = \
+        'insert into {0}.ChangedRowsM (bibcode) \
+            select distinct bibcode from {0}.filedelta \
+            where file_type = \'datalinks\' \
+              and not exists (select 1 from {0}.ChangedRowsM where {0}.ChangedRowsM.bibcode = {0}.filedelta.bibcode);'
+
+    delete_removed_rows_sql = \
+        'delete from {0}.rowviewm using {0}.changedbibcodes \
+         where {0}.rowviewm.bibcode = {0}.changedbibcodes.bibcode \
+           and not exists (select 1 from {0}.canonical where {0}.canonical.bibcode = {0}.changedbibcodes.bibcode);'
+
+    update_ids_sql = \
+        'update {0}.rowviewm set id = {0}.canonical.id from {0}.canonical \
+         where {0}.rowviewm.bibcode = {0}.canonical.bibcode \
+           and {0}.rowviewm.id != {0}.canonical.id;'
 
     create_changed_sql = \
         'create table {0}.ChangedRowsM as \
@@ -328,7 +702,15 @@ class NonBib:
 	   or {0}.RowViewM.read_count!={1}.RowViewM.read_count \
 	   or {0}.RowViewM.readers!={1}.RowViewM.readers \
 	   or {0}.RowViewM.downloads!={1}.RowViewM.downloads \
-	   or {0}.RowViewM.reads!={1}.RowViewM.reads);'
+	   or {0}.RowViewM.reads!={1}.RowViewM.reads \
+	   or {0}.RowViewM.reference!={1}.RowViewM.reference);'
+
+    # same bibcodes as create_changed_sql, one hash join rather than comparing every column
+    create_changed_hash_sql = \
+        'create table {0}.ChangedRowsM as \
+         select {0}.RowViewM.bibcode, {0}.RowViewM.id \
+         from {0}.RowViewM join {1}.RowViewM on {0}.RowViewM.bibcode={1}.RowViewM.bibcode \
+         where {0}.RowViewM.row_hash!={1}.RowViewM.row_hash;'
 
     # add the new bibcods to the table of changed bibcodes
     include_new_bibcodes_sql = \
@@ -344,7 +726,31 @@ class NonBib:
             where {1}.canonical.bibcode IS NULL;'
 
     # resolver
+    # bibcodes with a datalinks row that is new, has a different digest or was removed.
+    # removed rows only matter for bibcodes still in canonical, changedrowsm holds current rows.
+    # a row loaded before digest was filled in has a null digest and is compared column by column
     include_update_resolver_bibcodes_sql = \
+        'insert into {0}.ChangedRowsM (bibcode) \
+            select distinct datalinks.bibcode from \
+               (select current.bibcode from {0}.datalinks as current \
+                where not exists (select 1 from {1}.datalinks as baseline \
+                                  where baseline.bibcode = current.bibcode and baseline.link_type = current.link_type \
+                                    and baseline.link_sub_type = current.link_sub_type \
+                                    and (baseline.digest = current.digest \
+                                         or ((baseline.digest is null or current.digest is null) \
+                                             and baseline.url is not distinct from current.url \
+                                             and baseline.title is not distinct from current.title \
+                                             and baseline.item_count is not distinct from current.item_count))) \
+                union all \
+                select baseline.bibcode from {1}.datalinks as baseline join {0}.canonical \
+                  on {0}.canonical.bibcode = baseline.bibcode \
+                where not exists (select 1 from {0}.datalinks as current \
+                                  where current.bibcode = baseline.bibcode and current.link_type = baseline.link_type \
+                                    and current.link_sub_type = baseline.link_sub_type)) as datalinks \
+            where not exists (select 1 from {0}.ChangedRowsM where {0}.ChangedRowsM.bibcode = datalinks.bibcode);'
+
+    # for a baseline loaded before datalinks had a digest
+    include_update_resolver_columns_sql = \
         'insert into {0}.ChangedRowsM (bibcode) \
             select distinct on (bibcode) bibcode from \
                (select {0}.datalinks.bibcode from {0}.datalinks left join {1}.datalinks \
@@ -355,7 +761,7 @@ class NonBib:
                 or {0}.datalinks.title != {1}.datalinks.title \
                 or {0}.datalinks.item_count != {1}.datalinks.item_count \
                 or {1}.datalinks.bibcode IS NULL) as datalinks \
-            where not exists (select \'x\' from {0}.ChangedRowsM where {0}.ChangedRowsM.bibcode = bibcode);'
+            where not exists (select \'x\' from {0}.ChangedRowsM where {0}.ChangedRowsM.bibcode = datalinks.bibcode);'
 
     populate_new_resolver_bibcodes_sql = \
         'insert into {0}.newbibcodes (bibcode) \
@@ -365,7 +771,7 @@ class NonBib:
                 and {0}.datalinks.link_type = {1}.datalinks.link_type \
                 and {0}.datalinks.link_sub_type = {1}.datalinks.link_sub_type \
                 where {1}.datalinks.bibcode IS NULL) as datalinks \
-            where not exists (select \'x\' from {0}.newbibcodes where {0}.newbibcodes.bibcode = bibcode);'
+            where not exists (select \'x\' from {0}.newbibcodes where {0}.newbibcodes.bibcode = datalinks.bibcode);'
 
 
 if __name__ == "__main__":
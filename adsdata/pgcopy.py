@@ -0,0 +1,73 @@
+"""encode rows in the Postgres binary COPY format
+
+see the Binary Format section of https://www.postgresql.org/docs/current/static/sql-copy.html
+a binary copy stream is HEADER, then one row per tuple, then TRAILER.
+each field is a 4 byte length followed by the value in the type's binary
+send format.  array elements use the same layout after a small header.
+"""
+
+import struct
+
+
+HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+TRAILER = struct.pack('!h', -1)
+
+# type oids needed for array headers, our String columns are varchar
+INT4_OID = 23
+VARCHAR_OID = 1043
+
+_int4 = struct.Struct('!ii')
+_float8 = struct.Struct('!id')
+_length = struct.Struct('!i')
+_field_count = struct.Struct('!h')
+_array_header = struct.Struct('!iiiii')
+
+
+def row(fields):
+    """return tuple built from already encoded fields"""
+    return _field_count.pack(len(fields)) + ''.join(fields)
+
+
+def text(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _length.pack(len(value)) + value
+
+
+def int4(value):
+    return _int4.pack(4, int(value))
+
+
+def float8(value):
+    return _float8.pack(8, float(value))
+
+
+def boolean(value):
+    return '\x00\x00\x00\x01\x01' if value else '\x00\x00\x00\x01\x00'
+
+
+def text_array(values):
+    """one dimensional varchar array"""
+    if len(values) == 0:
+        return _empty_array(VARCHAR_OID)
+    pack = _length.pack
+    body = ''.join([pack(len(v)) + v for v in values])
+    return _array(VARCHAR_OID, len(values), body)
+
+
+def int4_array(values):
+    """one dimensional int4 array"""
+    if len(values) == 0:
+        return _empty_array(INT4_OID)
+    body = struct.pack('!%di' % (2 * len(values)), *[x for v in values for x in (4, int(v))])
+    return _array(INT4_OID, len(values), body)
+
+
+def _array(oid, count, body):
+    # dimensions, has nulls flag, element type, then size and lower bound of the one dimension
+    header = _array_header.pack(1, 0, oid, count, 1)
+    return _length.pack(len(header) + len(body)) + header + body
+
+
+def _empty_array(oid):
+    return _length.pack(12) + struct.pack('!iii', 0, 0, oid)
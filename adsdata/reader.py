@@ -1,24 +1,150 @@
 
+import os
+import re
+import mmap
+import hashlib
+
 from adsputils import setup_logging, load_config
+import pgcopy
+import compressed
+
+
+class MmapLineStream(object):
+    """read only file like object over a memory mapped column file
+
+    the mapped region is exposed as buf so readers can locate lines and
+    compare keys in place with find, strings are only built for the
+    lines a caller asks for
+    """
+
+    def __init__(self, file_):
+        self._f = open(file_, 'rb')
+        size = os.fstat(self._f.fileno()).st_size
+        # mmap does not accept empty files
+        self.buf = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        self.pos = 0
+        self.end = size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+
+    def seek(self, offset):
+        self.pos = offset
+
+    def readline(self):
+        if self.pos >= self.end:
+            return ''
+        line_end = self.buf.find('\n', self.pos, self.end) + 1 or self.end
+        line = self.buf[self.pos:line_end]
+        self.pos = line_end
+        return line
+
+    def close(self):
+        if self.end:
+            self.buf.close()
+        self._f.close()
+
+
+def collation_key(collation):
+    """return a function giving the sort key of a bibcode in column files sorted with collation
+
+    'C' is byte order, as written by sort with LC_ALL=C.  'nocase' ignores
+    case, as written by sort -f, with ties in byte order"""
+    if collation == 'C':
+        return lambda bibcode: bibcode
+    if collation == 'nocase':
+        return lambda bibcode: (bibcode.lower(), bibcode)
+    raise ValueError('unknown column file collation {}'.format(collation))
+
+
+def shard_offsets(file_, shards):
+    """return shards + 1 byte offsets that split a sorted column file into ranges
+
+    each interior offset is moved forward to the start of the next bibcode so
+    no bibcode's lines are split across shards.  use consecutive pairs as the
+    start_offset and end_offset of a StandardFileReader.  bibcodes are fixed
+    width, ranges may be empty when a bibcode spans several targets
+    """
+    size = os.path.getsize(file_)
+    offsets = [0]
+    with open(file_, 'r') as f:
+        for i in xrange(1, shards):
+            target = max(size * i / shards, offsets[-1])
+            if target >= size:
+                offsets.append(size)
+                continue
+            # finish the line containing the byte before target so we start on a line boundary
+            f.seek(max(target - 1, 0))
+            if target > 0:
+                f.readline()
+            line = f.readline()
+            key = line[:19]
+            offset = f.tell()
+            line = f.readline()
+            while line and line[:19] == key:
+                offset = f.tell()
+                line = f.readline()
+            offsets.append(offset)
+    offsets.append(size)
+    return offsets
 
 
 class ADSClassicInputStream(object):
     """file like object used to read nonbib column data files
 
     provides a useful wrapper around python file object
+
+    backend is 'file' to use a buffered python file object or 'mmap' to
+    memory map the file, default comes from READER_BACKEND in config
+
+    binary produces rows in the Postgres binary COPY format (see pgcopy.py)
+    rather than text rows, use with COPY ... FROM STDIN BINARY
+
+    file_ can be compressed (see compressed.py), when file_ does not exist but
+    a compressed variant of it does the compressed file is read.  compressed
+    files are always read with the file backend
     """
 
-    def __init__(self, file_):
-        self._file = file_
+    def __init__(self, file_, backend=None, binary=False):
+        self._file = compressed.resolve_column_file(file_)
         self.read_count = 0   # needed for logging
         self.logger = setup_logging('AdsDataSqlSync', 'DEBUG')
         self.logger.info('nonbib file ingest, file {}'.format(self._file))
         self.config = {}
         self.config.update(load_config())
 
-        self._iostream = open(file_, 'r')
-        
-        
+        # lines for a bibcode are grouped using a one line lookahead rather than
+        # peeking with tell/readline/seek, so the file is only ever read forward
+        # and a large buffer can be used
+        self._lookahead = None
+        # row that did not fit in the buffer returned by the previous read(size)
+        self._pending = None
+        # key of the first group past the end of this reader's shard, see StandardFileReader
+        self._stop_key = None
+        self.row_count = 0
+        # lines consumed by _read_group and the line number of the first line of the last group
+        self.line_count = 0
+        self.group_line = 0
+        self.binary = binary
+        if binary:
+            # the header goes out with the first buffer, the trailer after the last row
+            self._pending = pgcopy.HEADER
+            self._trailer_sent = False
+        self.backend = backend or self.config.get('READER_BACKEND', 'file')
+        if compressed.is_compressed(self._file):
+            self.backend = 'file'
+            self._iostream = compressed.open_column_file(self._file, self.config.get('DECOMPRESS_AHEAD', 0))
+        elif self.backend == 'mmap':
+            self._iostream = MmapLineStream(self._file)
+        else:
+            self._iostream = open(self._file, 'r', self.config.get('READ_BUFFER_SIZE', -1))
+
 
     def __enter__(self, *args, **kwargs):
         return self
@@ -42,7 +168,40 @@ class ADSClassicInputStream(object):
 
 
     def read(self, size=-1):
-        """called by iterators, use for column files where bibcodes are not repeated"""
+        """called by psycopg copy_from, returns as many complete rows as fit in size bytes
+
+        at least one row is always returned so a row longer than size is not split,
+        with the default size of -1 a single row is returned.  copy_from calls read
+        once per buffer so larger buffers mean fewer calls from libpq into python"""
+        if self._pending is not None:
+            row = self._pending
+            self._pending = None
+        else:
+            row = self._next_row()
+        if size < 0 or len(row) == 0:
+            return row
+        rows = [row]
+        length = len(row)
+        while length < size:
+            row = self._next_row()
+            if len(row) == 0 or length + len(row) > size:
+                # hold the row (or the end of file) for the next call
+                self._pending = row
+                break
+            rows.append(row)
+            length += len(row)
+        return ''.join(rows)
+
+    def _next_row(self):
+        """return the next row, in binary mode the trailer follows the last row"""
+        row = self._read_row()
+        if len(row) == 0 and self.binary and not self._trailer_sent:
+            self._trailer_sent = True
+            return pgcopy.TRAILER
+        return row
+
+    def _read_row(self):
+        """return the next row, use for column files where bibcodes are not repeated"""
         self.read_count += 1
         if self.read_count % 100000 == 0:
             self.logger.debug('nonbib file ingest, count = {}'.format(self.read_count))
@@ -51,6 +210,7 @@ class ADSClassicInputStream(object):
         if len(line) == 0 or (self.config['MAX_ROWS'] > 0 and self.read_count > self.config['MAX_ROWS']):
             self.logger.info('nonbib file ingest, processed {}, contained {} lines'.format(self._file, self.read_count))
             return ''
+        self.row_count += 1
         return self.process_line(line)
     
 
@@ -62,29 +222,104 @@ class ADSClassicInputStream(object):
     
     def process_line(self, line):
         return line
-    
-    
-   
+
+    # matches the run of lines at the start of a buffer that share a grouping key,
+    # the key is the first field including its tab
+    _group_regex = re.compile(r'([^\t\n]*\t)[^\n]*(?:\n|\Z)(?:\1[^\n]*(?:\n|\Z))*')
+
+    def _line_key(self, line):
+        """return the grouping key for line"""
+        return line[:line.find('\t')]
+
+    def _line_value(self, line):
+        """return the value portion of line, the part following the key
+
+        line does not include its trailing newline"""
+        return line[line.find('\t') + 1:]
+
+    def _read_group(self):
+        """return (key, values) for the next run of consecutive lines sharing a key
+
+        column files are sorted by bibcode so all lines for a bibcode are adjacent.
+        the first line of the following group is kept in self._lookahead
+        returns (None, None) at end of file"""
+        if self.backend == 'mmap':
+            return self._read_group_mmap()
+        line = self._lookahead
+        if line is None:
+            line = next(self._iostream, '')
+        if len(line) == 0:
+            self._lookahead = line
+            return None, None
+        line_key = self._line_key
+        line_value = self._line_value
+        key = line_key(line)
+        if key == self._stop_key:
+            return None, None
+        values = [line_value(line[:-1])]
+        self._lookahead = ''
+        for line in self._iostream:
+            if line_key(line) != key:
+                self._lookahead = line
+                break
+            values.append(line_value(line[:-1]))
+        self.group_line = self.line_count + 1
+        self.line_count += len(values)
+        return key, values
+
+    def _read_group_mmap(self):
+        """_read_group for the mmap backend
+
+        the extent of the group is found by matching _group_regex against the
+        mapped region, strings are only created for the lines of that group"""
+        stream = self._iostream
+        if stream.pos >= stream.end:
+            return None, None
+        match = self._group_regex.match(stream.buf, stream.pos)
+        if match:
+            group_end = match.end()
+        else:
+            # line too short to hold a key, return it on its own
+            group_end = stream.buf.find('\n', stream.pos, stream.end) + 1 or stream.end
+        lines = stream.buf[stream.pos:group_end].split('\n')
+        stream.pos = group_end
+        if lines[-1]:
+            # final line of the file has no newline, drop its last character like the file backend
+            lines[-1] = lines[-1][:-1]
+        else:
+            lines.pop()
+        key = self._line_key(lines[0])
+        if key == self._stop_key:
+            return None, None
+        self.group_line = self.line_count + 1
+        self.line_count += len(lines)
+        return key, map(self._line_value, lines)
+
+
 class BibcodeFileReader(ADSClassicInputStream):
     """add id field to bibcode"""
     
-    def __init__(self, file_):
-        super(BibcodeFileReader, self).__init__(file_)
+    def __init__(self, file_, **kwargs):
+        super(BibcodeFileReader, self).__init__(file_, **kwargs)
 
         
     def process_line(self, line):
         bibcode = line[:-1]
+        if self.binary:
+            return pgcopy.row((pgcopy.text(bibcode), pgcopy.int4(self.read_count)))
         row = '{}\t{}\n'.format(bibcode, self.read_count)
         return row
     
  
 class OnlyTrueFileReader(ADSClassicInputStream):
     """adds default True value when reading file with only bibcodes, e.g., refereed column data file"""
-    def __init__(self, file_):
-        super(OnlyTrueFileReader, self).__init__(file_)
+    def __init__(self, file_, **kwargs):
+        super(OnlyTrueFileReader, self).__init__(file_, **kwargs)
         
     def process_line(self, line):
         bibcode = line[:-1]
+        if self.binary:
+            return pgcopy.row((pgcopy.text(bibcode), pgcopy.boolean(True)))
         row = '{}\t{}\n'.format(bibcode, 'T')
         return row
         
@@ -92,10 +327,54 @@ class StandardFileReader(ADSClassicInputStream):
     """reads most nonbib column files
 
     can read files where for a bibcode is on one line or on consecutive lines
+
+    start_offset and end_offset limit the reader to a byte range of the file,
+    both should come from shard_offsets so they fall on a change of bibcode.
+    reading stops at the first group that starts at or after end_offset
+
+    every bibcode is checked by validate before it is formatted.  lines that
+    would abort the copy are skipped and written to a quarantine file in
+    QUARANTINE_PATH with their line number and a reason code, see quarantine.
+    pass quarantine=False to only log them
+
+    collation is how the file is sorted, see collation_key, default comes from
+    COLUMN_FILE_COLLATION in config.  a bibcode sorting before the line above
+    it is still loaded, the file or the collation is wrong and a warning with
+    the count is logged.  pass order_required=True to raise ValueError
+    instead, for readers that merge files and need them sorted
     """
-    def __init__(self, file_type_, file_):
-        super(StandardFileReader, self).__init__(file_)
+
+    # numeric fields checked by validate, lines are the value after the bibcode
+    number_regexes = {'reads': re.compile(r'\t*(\d+(\t\d+)*)?$'),
+                      'download': re.compile(r'\t*(\d+(\t\d+)*)?$'),
+                      'relevance': re.compile(r'\t*-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?(\t-?\d+){3}$')}
+
+    def __init__(self, file_type_, file_, start_offset=0, end_offset=None, quarantine=True, collation=None,
+                 order_required=False, **kwargs):
+        super(StandardFileReader, self).__init__(file_, **kwargs)
         self.file_type = file_type_
+        self.start_offset = start_offset
+        self.quarantine_path = self.config.get('QUARANTINE_PATH') if quarantine else None
+        self.quarantine_count = 0
+        self._quarantine_file = None
+        self.collation = collation or self.config.get('COLUMN_FILE_COLLATION', 'nocase')
+        self.sort_key = collation_key(self.collation)
+        self.order_required = order_required
+        self.out_of_order_count = 0
+        # the last bibcode returned, a repeat of it would abort the copy
+        self._previous_bibcode = ''
+        # the sort key of the group read before this one, valid or not
+        self._previous_key = self.sort_key('')
+        if (start_offset or end_offset is not None) and compressed.is_compressed(self._file):
+            raise ValueError('byte range not supported for compressed file {}'.format(self._file))
+        if start_offset:
+            self._iostream.seek(start_offset)
+        if end_offset is not None:
+            with open(self._file, 'r') as f:
+                f.seek(end_offset)
+                line = f.readline()
+            if line:
+                self._stop_key = self._line_key(line)
         
         # the following lists controls how they are processed
 
@@ -107,139 +386,323 @@ class StandardFileReader(ADSClassicInputStream):
         self.quote_values = ('author','simbad','grants', 'ned', 'datalinks')
         # tab_separator: is the tab a separator in the input data, default is comma
         self.tab_separated_values = ('author', 'download', 'reads')
+        # for binary copy, arrays are varchar[] except these int4[]
+        self.int_array_types = ('download', 'reads')
+        # for binary copy, encoders for files with several values that are not an array
+        self.binary_value_encoders = {'relevance': (pgcopy.float8, pgcopy.int4, pgcopy.int4, pgcopy.int4)}
+
+        # the formatting plan for this file type, computed once rather than for every row
+        self.as_array = self.file_type in self.array_types
+        self.quote_value = self.file_type in self.quote_values
+        self.tab_separator = self.file_type in self.tab_separated_values
+        self.array_encoder = pgcopy.int4_array if self.file_type in self.int_array_types else pgcopy.text_array
         
-    def read(self, size=-1):
+    def _read_row(self):
         """returns the data from the file for the next bibcode
 
-        peeks ahead in file and concatenates data if its bibcode matches
-        makes at least one and potentially multiple readline calls on iostream """
+        consecutive lines with the same bibcode are concatenated into one value"""
+        bibcode, value = self._next_group()
+        if bibcode is None:
+            return ''
+        self.row_count += 1
+        if self.as_array:
+            return self.process_line(bibcode, value)
+        if len(value) > 1:
+            self.logger.error('bibcode {} repeated in file {}, using first value'.format(bibcode, self._file))
+        return self.process_line(bibcode, value[0])
+    
+
+    def _next_group(self):
+        """return (bibcode, values) for the next valid bibcode, (None, None) when done"""
         self.read_count += 1
         if self.read_count % 100000 == 0:
             self.logger.debug('nonbib file ingest, processing {}, count = {}'.format(self.file_type, self.read_count))
-        line = self._iostream.readline()
-        if len(line) == 0  or (self.config['MAX_ROWS'] > 0 and self.read_count > self.config['MAX_ROWS']):
+        bibcode, value = self._read_group()
+        while bibcode is not None:
+            reason = self.validate(bibcode, value)
+            if reason != 'BAD_BIBCODE':
+                self.check_order(bibcode)
+            if reason is None:
+                break
+            self.quarantine(reason, bibcode, value)
+            bibcode, value = self._read_group()
+        if bibcode is None or (self.config['MAX_ROWS'] > 0 and self.read_count > self.config['MAX_ROWS']):
             self.logger.info('nonbib file ingest, processed {}, contained {} lines'.format(self._file, self.read_count))
-            return ''
+            if self.quarantine_count:
+                self.logger.warn('nonbib file ingest, quarantined {} bibcodes from {}'.format(self.quarantine_count,
+                                                                                              self._file))
+            if self.out_of_order_count:
+                self.logger.warn('nonbib file ingest, {} bibcodes out of order in {} for collation {}, '
+                                 'check COLUMN_FILE_COLLATION'.format(self.out_of_order_count, self._file, self.collation))
+            return None, None
+        self._previous_bibcode = bibcode
+        return bibcode, value
+
+    def check_order(self, bibcode):
+        """count a bibcode that sorts before the line above it, raise ValueError if order_required
+
+        the bibcode is not skipped, being out of order only means the file
+        was not sorted in the expected collation"""
+        key = self.sort_key(bibcode)
+        if key < self._previous_key:
+            self.out_of_order_count += 1
+            if self.order_required:
+                raise ValueError('column file {} is not sorted in collation {}, {} at line {}'
+                                 .format(self._file, self.collation, bibcode, self.group_line))
+            if self.out_of_order_count == 1:
+                self.logger.warn('bibcode {} at line {} in file {} is out of order for collation {}'
+                                 .format(bibcode, self.group_line, self._file, self.collation))
+        self._previous_key = key
+
+    def validate(self, bibcode, value):
+        """return a reason code when the lines for bibcode can not be loaded, None when they are fine
+
+        BAD_BIBCODE       bibcode is not 19 characters without spaces or tabs
+        DUPLICATE_BIBCODE bibcode repeats the last one returned, with only invalid lines between,
+                          it would duplicate a key already sent and abort the copy
+        REPEATED_BIBCODE  several lines for a numeric array file, they can not be combined
+        BAD_NUMBER        numeric field in reads, download or relevance does not parse"""
+        if len(bibcode) != 19 or ' ' in bibcode or '\t' in bibcode:
+            return 'BAD_BIBCODE'
+        if bibcode == self._previous_bibcode:
+            return 'DUPLICATE_BIBCODE'
+        number_regex = self.number_regexes.get(self.file_type)
+        if number_regex is not None:
+            if len(value) > 1 and self.as_array:
+                return 'REPEATED_BIBCODE'
+            if number_regex.match(value[0]) is None:
+                return 'BAD_NUMBER'
+        return None
+
+    def quarantine(self, reason, bibcode, value):
+        """log the lines of a group that failed validate and write them to the quarantine file
+
+        each quarantined line is written as: line number, reason, bibcode and value separated by tabs.
+        line numbers count from start_offset, which is noted at the top of the file"""
+        self.quarantine_count += 1
+        bibcode = bibcode.rstrip('\n')
+        self.logger.error('invalid bibcode {} at line {} in file {}, {}'.format(bibcode, self.group_line, self._file, reason))
+        if not self.quarantine_path:
+            return
+        if self._quarantine_file is None:
+            self._quarantine_file = self._open_quarantine()
+        self._quarantine_file.writelines(['{}\t{}\t{}\t{}\n'.format(self.group_line + i, reason, bibcode, v)
+                                          for i, v in enumerate(value)])
+
+    def _open_quarantine(self):
+        """return the quarantine file for this reader, named for the column file and its shard"""
+        try:
+            os.makedirs(self.quarantine_path)
+        except OSError:
+            # already exists, perhaps created by another shard
+            if not os.path.isdir(self.quarantine_path):
+                raise
+        name = '_'.join(self._file.split(os.sep)[-2:])
+        if self.start_offset:
+            name += '.{}'.format(self.start_offset)
+        filename = os.path.join(self.quarantine_path, name + '.quarantine')
+        self.logger.info('nonbib file ingest, quarantining invalid lines from {} to {}'.format(self._file, filename))
+        f = open(filename, 'w')
+        f.write('# {} from byte {}\n'.format(self._file, self.start_offset))
+        return f
 
-        bibcode = line[:19]
-        while ' ' in bibcode or '\t' in bibcode:
-            self.logger.error('invalid bibcode {} in file {}'.format(bibcode, self._file))
-            line = self._iostream.readline()
-            bibcode = line[:19]
-        value = line[20:-1]
-
-        # does the next line match the current bibcode?
-        match = self._bibcode_match(bibcode)
-
-        if self.file_type in (self.array_types):
-            value = [value]
-        while match:
-            line = self._iostream.readline()
-            value.append(line[20:-1])
-            match = self._bibcode_match(bibcode)
-        return self.process_line(bibcode, value)
-    
+    def close(self):
+        super(StandardFileReader, self).close()
+        if self._quarantine_file is not None:
+            self._quarantine_file.close()
+            self._quarantine_file = None
+
+    def group_offsets(self):
+        """yield (bibcode, offset, length) for the lines of each valid bibcode, needs the mmap backend"""
+        if self.backend != 'mmap':
+            raise ValueError('group offsets need the mmap backend and an uncompressed file, {}'.format(self._file))
+        stream = self._iostream
+        while True:
+            offset = stream.pos
+            bibcode, value = self._read_group()
+            if bibcode is None:
+                return
+            if ' ' in bibcode or '\t' in bibcode or len(bibcode) != 19:
+                self.logger.error('invalid bibcode {} in file {}'.format(bibcode, self._file))
+                continue
+            yield bibcode, offset, stream.pos - offset
+
+    def count_rows(self):
+        """return the number of rows read() would return, without formatting them"""
+        count = 0
+        while self._next_group()[0] is not None:
+            count += 1
+        return count
+
+    def groups(self):
+        """yield (bibcode, values) for each valid bibcode, values are the lines after the bibcode, unformatted"""
+        bibcode, value = self._next_group()
+        while bibcode is not None:
+            yield bibcode, value
+            bibcode, value = self._next_group()
 
     def readline(self):
-        return self.read()
+        return self._read_row()
 
         
     def process_line(self, bibcode, value):
-        as_array = self.file_type in self.array_types
-        quote_value = self.file_type in self.quote_values
-        tab_separator = self.file_type in self.tab_separated_values
-        processed_value = self.process_value(value, as_array, quote_value, tab_separator)
-        row = '{}\t{}\n'.format(bibcode, processed_value)
-        return row
+        if self.binary:
+            return self.process_binary_line(bibcode, value)
+        processed_value = self.process_value(value, self.as_array, self.quote_value, self.tab_separator)
+        return ''.join((bibcode, '\t', processed_value, '\n'))
+
+    def process_binary_line(self, bibcode, value):
+        """return binary copy tuple for bibcode and value"""
+        if self.as_array:
+            field = self.array_encoder(self.array_values(value, self.quote_value, self.tab_separator))
+            return pgcopy.row((pgcopy.text(bibcode), field))
+        values = value.lstrip('\t').split('\t')
+        encoders = self.binary_value_encoders.get(self.file_type, (pgcopy.text,) * len(values))
+        return pgcopy.row([pgcopy.text(bibcode)] + [encode(v) for encode, v in zip(encoders, values)])
     
-    def _bibcode_match(self, bibcode):
-        """ peek ahead to next line for bibcode and check for mactch"""
-        file_location = self._iostream.tell()
-        next_line = self._iostream.readline()
-        self._iostream.seek(file_location)
-        next_bib = next_line[:19]
-        if bibcode == next_bib:
-            return True
-        return False
+    _group_regex = re.compile(r'([^\n]{19})[^\n]*(?:\n|\Z)(?:\1[^\n]*(?:\n|\Z))*')
+
+    def _line_key(self, line):
+        """bibcodes are fixed width"""
+        return line[:19]
+
+    def _line_value(self, line):
+        return line[20:]
 
-        
     def process_value(self, value, as_array=False, quote_value=False, tab_separator=False):
-        """convert value to what Postgres will accept"""
-        if '\x00' in value:
-            # postgres does not like nulls in strings
-            self.logger.error('in columnFileIngest.process_value with null value in string: {}', value)
-            value = value.replace('\x00', '')
-    
-        return_value = ''
+        """convert value to what Postgres will accept
+
+        value is either a string, where a tab separates values, or a list of values.
+        output values are separated by commas for arrays and tabs otherwise"""
         if tab_separator and isinstance(value, list) and len(value) == 1:
             value = value[0]
-    
-        output_separator = ','
-        if (as_array == False):
-            output_separator = '\t'
-    
-        if isinstance(value, str) and '\t' in value:
-            # tab separator in string means we need to create a sql array
-            values = value.split('\t')
-            # should check for double quotes in names
-            for v in values:
-                if quote_value and v[0] != '"':
-                    v = '"' + v + '"'
-                if len(return_value) == 0:
-                    return_value = v
-                else:
-                    return_value += output_separator + v
-                
-        elif isinstance(value, list):
-            # array of values to conver to sql
-            for v in value:
-                v = v.replace('\t', ' ')
-                if quote_value and ((len(v) > 0 and v[0] != '"') or (len(v) == 0)):
-                    v = '"' + v + '"'
-                elif not quote_value and len(v) == 0:
-                    v = 0
-                if len(return_value) == 0:
-                    return_value = v 
-                else:
-                    return_value += output_separator + v
+        output_separator = ',' if as_array else '\t'
 
+        if isinstance(value, list):
+            return_value = self._format_list(value, quote_value, output_separator)
         elif isinstance(value, str):
-            if quote_value and value[0] != '"':
-                return_value = '"' + value + '"'
-            else:
-                return_value = value
-    
+            return_value = self._format_string(value, quote_value, output_separator)
+        else:
+            return_value = ''
+
         if as_array:
             # postgres array are contained within curly braces
-            return_value = '{' + return_value + '}'
+            return '{' + return_value + '}'
         return return_value
 
+    def array_values(self, value, quote_value=False, tab_separator=False):
+        """return the list of array elements postgres gets from process_value, for binary copy
+
+        binary arrays need no quoting, values already quoted in the file have their quotes removed"""
+        if tab_separator and isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        if isinstance(value, str):
+            if '\x00' in value:
+                self.logger.error('in columnFileIngest.array_values with null value in string: {}'.format(value))
+                value = value.replace('\x00', '')
+            if not quote_value:
+                # empty leading values are dropped
+                value = value.lstrip('\t')
+                if len(value) == 0:
+                    return []
+            values = value.split('\t')
+        elif isinstance(value, list):
+            values = value
+            all_values = ''.join(values)
+            if '\x00' in all_values:
+                self.logger.error('in columnFileIngest.array_values with null value in string: {}'.format(values))
+                values = [v.replace('\x00', '') for v in values]
+            if '\t' in all_values:
+                values = [v.replace('\t', ' ') for v in values]
+            if not quote_value and '' in values:
+                values = [v or '0' for v in values]
+        else:
+            return []
+        if quote_value and '"' in ''.join(values):
+            values = [v[1:-1] if len(v) > 1 and v[0] == '"' and v[-1] == '"' else v for v in values]
+        return values
+
+    def _format_string(self, value, quote_value, output_separator):
+        """format a string holding tab separated values"""
+        if '\x00' in value:
+            # postgres does not like nulls in strings
+            self.logger.error('in columnFileIngest.process_value with null value in string: {}'.format(value))
+            value = value.replace('\x00', '')
+        if '\t' not in value:
+            if quote_value and value[:1] != '"':
+                return '"' + value + '"'
+            return value
+        if quote_value:
+            # should check for double quotes in names
+            return output_separator.join([v if v[:1] == '"' else '"' + v + '"' for v in value.split('\t')])
+        # empty leading values are dropped
+        value = value.lstrip('\t')
+        if output_separator != '\t':
+            value = value.replace('\t', output_separator)
+        return value
+
+    def _format_list(self, values, quote_value, output_separator):
+        """format a list of values, a tab within a value becomes a space
+
+        the whole list is scanned once for characters that need attention,
+        each value is only visited when one is found"""
+        if len(values) == 0:
+            return ''
+        all_values = ''.join(values)
+        if '\x00' in all_values:
+            self.logger.error('in columnFileIngest.process_value with null value in string: {}'.format(values))
+            values = [v.replace('\x00', '') for v in values]
+        if '\t' in all_values:
+            values = [v.replace('\t', ' ') for v in values]
+        if quote_value:
+            if '"' not in all_values:
+                return '"' + ('"' + output_separator + '"').join(values) + '"'
+            return output_separator.join([v if v[:1] == '"' else '"' + v + '"' for v in values])
+        if '' in values:
+            # postgres needs a value for empty numeric fields
+            values = [v or '0' for v in values]
+        return output_separator.join(values)
+
+def datalinks_digest(link_type, link_sub_type, url_list, title_list, item_count):
+    """md5 of the content of a datalinks row, stored with the row so deltas compare one column
+
+    computed from the values before they are formatted for copy, text and binary rows get the same digest"""
+    content = '\x00'.join((link_type, link_sub_type, '\x01'.join(url_list), '\x01'.join(title_list), str(item_count)))
+    return hashlib.md5(content).hexdigest()
+
+
 # for datalinks table entries that may or may not have a link_sub_type
 # that includes ARTICLE types that do have sub_type and
 # for example PRESENTATION, LIBRARYCATALOG, and INSPIRE	 that do not
 # note that these entries do not have a title
 class DataLinksFileReader(StandardFileReader):
 
-    def __init__(self, file_type_, file_, link_type_, link_sub_type_):
-        super(DataLinksFileReader, self).__init__(file_type_, file_)
+    def __init__(self, file_type_, file_, link_type_, link_sub_type_, **kwargs):
+        super(DataLinksFileReader, self).__init__(file_type_, file_, **kwargs)
         self.link_type = link_type_
         self.link_sub_type = link_sub_type_
 
     def process_line(self, bibcode, value):
-        as_array = self.file_type in self.array_types
-        quote_value = self.file_type in self.quote_values
-        tab_separator = self.file_type in self.tab_separated_values
+        as_array = self.as_array
+        quote_value = self.quote_value
+        tab_separator = self.tab_separator
         value = [v.replace('"', '').replace('\r', '') for v in value]
+        digest = datalinks_digest(self.link_type, self.link_sub_type, value, [], 0)
+        if self.binary:
+            return pgcopy.row((pgcopy.text(bibcode), pgcopy.text(self.link_type), pgcopy.text(self.link_sub_type),
+                               pgcopy.text_array(self.array_values(value, quote_value)),
+                               pgcopy.text_array([]), pgcopy.int4(0), pgcopy.text(digest)))
         processed_url = self.process_value(value, as_array, quote_value, tab_separator)
-        row = '{}\t{}\t{}\t{}\t{}\t{}\n'.format(bibcode, self.link_type, self.link_sub_type, processed_url, "{""}", 0)
+        row = '{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(bibcode, self.link_type, self.link_sub_type, processed_url, "{""}", 0,
+                                                    digest)
         return row
 
 # for datalinks table entries that have titles, but no link_sub_type
 # right now only link_type = ASSOCIATED belongs to this category
 class DataLinksWithTitleFileReader(StandardFileReader):
 
-    def __init__(self, file_type_, file_, link_type_):
-        super(DataLinksWithTitleFileReader, self).__init__(file_type_, file_)
+    def __init__(self, file_type_, file_, link_type_, **kwargs):
+        super(DataLinksWithTitleFileReader, self).__init__(file_type_, file_, **kwargs)
         self.link_type = link_type_
 
     def split(self, value):
@@ -255,13 +718,20 @@ class DataLinksWithTitleFileReader(StandardFileReader):
         return url_list, title_list
 
     def process_line(self, bibcode, value):
-        as_array = self.file_type in self.array_types
-        quote_value = self.file_type in self.quote_values
-        tab_separator = self.file_type in self.tab_separated_values
+        as_array = self.as_array
+        quote_value = self.quote_value
+        tab_separator = self.tab_separator
         [url_list, title_list] = self.split(value)
+        digest = datalinks_digest(self.link_type, 'NA', url_list, title_list, 0)
+        if self.binary:
+            return pgcopy.row((pgcopy.text(bibcode), pgcopy.text(self.link_type), pgcopy.text('NA'),
+                               pgcopy.text_array(self.array_values(url_list, quote_value)),
+                               pgcopy.text_array(self.array_values(title_list, quote_value)), pgcopy.int4(0),
+                               pgcopy.text(digest)))
         processed_url = self.process_value(url_list, as_array, quote_value, tab_separator)
         processed_title = self.process_value(title_list, as_array, quote_value, tab_separator)
-        row = '{}\t{}\t{}\t{}\t{}\t{}\n'.format(bibcode, self.link_type, "NA", processed_url, processed_title, 0)
+        row = '{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(bibcode, self.link_type, "NA", processed_url, processed_title, 0,
+                                                    digest)
         return row
 
 
@@ -269,58 +739,57 @@ class DataLinksWithTitleFileReader(StandardFileReader):
 # that we are calling target, right now only link_type = DATA belongs to this category
 class DataLinksWithTargetFileReader(StandardFileReader):
 
-    def __init__(self, file_type_, file_, link_type_):
-        super(DataLinksWithTargetFileReader, self).__init__(file_type_, file_)
+    def __init__(self, file_type_, file_, link_type_, **kwargs):
+        super(DataLinksWithTargetFileReader, self).__init__(file_type_, file_, **kwargs)
         self.link_type = link_type_
 
-    def _separate(self, line):
-        if (len(line) == 0):
-            return ['','','']
-        parts = line.split('\t', 2)
-        return [parts[0], parts[1], parts[1]+'\t'+parts[2]]
-
-    def _bibcode_linktype_match(self, bibcode, liketype):
-        """ peek ahead to next line for bibcode and check for mactch"""
-        file_location = self._iostream.tell()
-        next_line = self._iostream.readline()
-        self._iostream.seek(file_location)
-        next_bib, next_type, therest = self._separate(next_line)
-        if bibcode == next_bib and liketype == next_type:
-            return True
-        return False
+    _group_regex = re.compile(r'([^\t\n]*\t[^\t\n]*\t)[^\n]*(?:\n|\Z)(?:\1[^\n]*(?:\n|\Z))*')
 
-    def read(self, size=-1):
-        """returns the data from the file for the next bibcode
+    def _line_key(self, line):
+        """lines are grouped on both bibcode and target, the key includes the tab following each"""
+        return line[:line.find('\t', line.find('\t') + 1) + 1]
+
+    def _line_value(self, line):
+        """value starts with the target"""
+        return line[line.find('\t') + 1:]
 
-        peeks ahead in file and concatenates data if its bibcode matches
-        makes at least one and potentially multiple readline calls on iostream """
+    def _read_row(self):
+        """returns the data from the file for the next bibcode and target
+
+        consecutive lines with the same bibcode and target are concatenated into one value"""
         self.read_count += 1
         if self.read_count % 100000 == 0:
             self.logger.debug('nonbib file ingest, processing {}, count = {}'.format(self.file_type, self.read_count))
-        line = self._iostream.readline()
-        if len(line) == 0 or (self.config['MAX_ROWS'] > 0 and self.read_count > self.config['MAX_ROWS']):
+        key, value = self._read_group()
+        bibcode = key.split('\t', 1)[0] if key is not None else None
+        while bibcode is not None:
+            reason = self.validate(bibcode, value)
+            if reason is None:
+                break
+            self.quarantine(reason, bibcode, value)
+            key, value = self._read_group()
+            bibcode = key.split('\t', 1)[0] if key is not None else None
+        if bibcode is None or (self.config['MAX_ROWS'] > 0 and self.read_count > self.config['MAX_ROWS']):
             self.logger.info('nonbib file ingest, processed {}, contained {} lines'.format(self._file, self.read_count))
             return ''
-
-        bibcode, linktype, therest = self._separate(line)
-        while ' ' in bibcode or len(bibcode) != 19:
-            self.logger.error('invalid bibcode {} in file {}'.format(bibcode, self._file))
-            line = self._iostream.readline()
-            bibcode, linktype, therest = self._separate(line)
-        value = therest
-
-        # does the next line match the current bibcode?
-        match = self._bibcode_linktype_match(bibcode, linktype)
-
-        if self.file_type in (self.array_types):
-            value = [value]
-        while match:
-            line = self._iostream.readline()
-            bibcode, linktype, therest = self._separate(line)
-            value.append(therest)
-            match = self._bibcode_linktype_match(bibcode, linktype)
+        self.row_count += 1
         return self.process_line(bibcode, value)
 
+    # target, count, url and title
+    _fields_regex = re.compile(r'[^\t]*\t\d+\t[^\t]*\t')
+
+    def validate(self, bibcode, value):
+        """check bibcode shape and the fields split expects, BAD_FIELDS when a line lacks them
+
+        bibcodes repeat once per target so sort order is not checked"""
+        if len(bibcode) != 19 or ' ' in bibcode:
+            return 'BAD_BIBCODE'
+        fields_regex = self._fields_regex
+        for v in value:
+            if fields_regex.match(v) is None:
+                return 'BAD_FIELDS'
+        return None
+
     def split(self, value):
         # SIMBAD	1	http://$SIMBAD$/simbo.pl?bibcode=1907ApJ....25...59C	SIMBAD Objects (1)
         # value is a list of strings with four elements,
@@ -341,13 +810,20 @@ class DataLinksWithTargetFileReader(StandardFileReader):
         return url_list, title_list, list(target_list), count_list
 
     def process_line(self, bibcode, value):
-        as_array = self.file_type in self.array_types
-        quote_value = self.file_type in self.quote_values
-        tab_separator = self.file_type in self.tab_separated_values
+        as_array = self.as_array
+        quote_value = self.quote_value
+        tab_separator = self.tab_separator
         [url_list, title_list, target_list, count_list] = self.split(value)
-        processed_url = self.process_value(url_list, as_array, quote_value, tab_separator)
-        processed_title = self.process_value(title_list, as_array, quote_value, tab_separator)
         processed_target = self.process_value(target_list, False, False, tab_separator)
         processed_count = self.process_value(count_list, False, False, tab_separator)
-        row = '{}\t{}\t{}\t{}\t{}\t{}\n'.format(bibcode, self.link_type, processed_target, processed_url, processed_title, processed_count)
+        digest = datalinks_digest(self.link_type, processed_target, url_list, title_list, processed_count)
+        if self.binary:
+            return pgcopy.row((pgcopy.text(bibcode), pgcopy.text(self.link_type), pgcopy.text(processed_target),
+                               pgcopy.text_array(self.array_values(url_list, quote_value)),
+                               pgcopy.text_array(self.array_values(title_list, quote_value)),
+                               pgcopy.int4(processed_count), pgcopy.text(digest)))
+        processed_url = self.process_value(url_list, as_array, quote_value, tab_separator)
+        processed_title = self.process_value(title_list, as_array, quote_value, tab_separator)
+        row = '{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(bibcode, self.link_type, processed_target, processed_url, processed_title,
+                                                    processed_count, digest)
         return row
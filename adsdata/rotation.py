@@ -0,0 +1,134 @@
+"""blue/green rotation of the nonbib schemas
+
+rather than renaming the live schema away and loading into an empty one,
+the delta pipeline builds the new column tables and row view in a staging
+schema while the live schema is still readable.  once the staging schema
+is verified, one transaction renames every generation down a slot and the
+staging schema to the live name, readers see either the old or the new
+schema and never a partly built one.
+
+    generation 0   nonbib          live
+    generation 1   nonbibstaging   baseline for the delta
+    generation 2   nonbibstaging_2
+    ...
+    staging        nonbib_next     being built
+
+the generation pushed past SCHEMA_GENERATIONS is renamed to a retired
+schema and dropped on a background thread, dropping a large schema takes
+a while and nothing waits on it.
+"""
+
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from adsputils import setup_logging
+
+import nonbib
+
+
+class SchemaRotation(object):
+
+    def __init__(self, schema, baseline_schema, generations=2):
+        """generations counts the live schema, at least 2 are kept since the delta needs the baseline"""
+        self.schema = schema
+        self.baseline_schema = baseline_schema
+        self.generations = max(generations, 2)
+        self.staging_schema = schema + '_next'
+        self.logger = setup_logging('AdsDataSqlSync', 'INFO')
+
+    def generation_names(self):
+        """schema names from live to oldest"""
+        names = [self.schema, self.baseline_schema]
+        names.extend('{}_{}'.format(self.baseline_schema, i) for i in range(2, self.generations))
+        return names
+
+    def retired_prefix(self):
+        return self.schema + '_retired_'
+
+    def prepare(self, db_engine):
+        """drop any staging schema left by a failed run, return NonBib to build the staging schema with"""
+        staging_sql_sync = nonbib.NonBib(self.staging_schema)
+        staging_sql_sync.drop_column_tables(db_engine)
+        return staging_sql_sync
+
+    def verify(self, db_conn):
+        """raise ValueError unless the staging row view has a row for every bibcode in canonical"""
+        staging_sql_sync = nonbib.NonBib(self.staging_schema)
+        if staging_sql_sync.get_relation_kind(db_conn, self.staging_schema, 'rowviewm') is None:
+            raise ValueError('schema rotation, no row view in staging schema {}'.format(self.staging_schema))
+        rows = db_conn.execute('select count(*) from {}.rowviewm'.format(self.staging_schema)).scalar()
+        bibcodes = db_conn.execute('select count(*) from {}.canonical'.format(self.staging_schema)).scalar()
+        if rows == 0 or rows != bibcodes:
+            raise ValueError('schema rotation, staging schema {} has {} rows in its row view and {} bibcodes in canonical'
+                             .format(self.staging_schema, rows, bibcodes))
+        self.logger.info('schema rotation, verified staging schema {} with {} rows'.format(self.staging_schema, rows))
+
+    def swap(self, db_conn):
+        """make the staging schema live and move every generation down a slot, in one transaction
+
+        returns the name the oldest generation was retired to, None if there was none"""
+        existing = self.get_schemas(db_conn)
+        retired = None
+        if self.generation_names()[-1] in existing:
+            retired = self.retired_prefix() + datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        Session = sessionmaker()
+        sess = Session(bind=db_conn)
+        for sql_command in self.swap_sql(existing, retired):
+            sess.execute(sql_command)
+        sess.commit()
+        sess.close()
+        self.logger.info('schema rotation, {} is live, generations {}, retired {}'
+                         .format(self.staging_schema, self.generation_names(), retired))
+        return retired
+
+    def swap_sql(self, existing, retired=None):
+        """return the renames for swap, oldest first so no two schemas share a name"""
+        names = self.generation_names()
+        sql = []
+        if retired and names[-1] in existing:
+            sql.append('alter schema {} rename to {}'.format(names[-1], retired))
+        for older, newer in reversed(zip(names[1:], names[:-1])):
+            if newer in existing:
+                sql.append('alter schema {} rename to {}'.format(newer, older))
+        sql.append('alter schema {} rename to {}'.format(self.staging_schema, self.schema))
+        return sql
+
+    def retire(self, db_conn, schema):
+        """rename schema so it is dropped by drop_retired, returns the new name"""
+        if schema not in self.get_schemas(db_conn):
+            return None
+        retired = self.retired_prefix() + datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        db_conn.execute('alter schema {} rename to {}'.format(schema, retired))
+        self.logger.info('schema rotation, retired {} as {}'.format(schema, retired))
+        return retired
+
+    def drop_retired(self, db_engine, wait=False):
+        """drop the retired schemas on a background thread over its own connection
+
+        the thread is not a daemon, the process waits for it before exiting"""
+        thread = threading.Thread(target=self._drop_retired, args=(str(db_engine.url),), name='drop_retired')
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def _drop_retired(self, connection_string):
+        engine = create_engine(connection_string, poolclass=NullPool)
+        try:
+            conn = engine.connect()
+            for schema in sorted(self.get_schemas(conn)):
+                if schema.startswith(self.retired_prefix()):
+                    self.logger.info('schema rotation, dropping retired schema {}'.format(schema))
+                    conn.execute('drop schema if exists {} cascade'.format(schema))
+            conn.close()
+            self.logger.info('schema rotation, dropped retired schemas')
+        except Exception:
+            self.logger.exception('schema rotation, failed to drop retired schemas, they are dropped after the next swap')
+        finally:
+            engine.dispose()
+
+    def get_schemas(self, db_conn):
+        return set(row[0] for row in db_conn.execute('select nspname from pg_namespace'))
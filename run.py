@@ -3,16 +3,27 @@ import sys
 import re
 import argparse
 import os
+import shutil
+import tempfile
+import multiprocessing
+import threading
+import Queue
 from sqlalchemy.orm import sessionmaker, load_only
 from sqlalchemy.sql import select
 from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 
 from adsdata import nonbib
 from adsdata import metrics
 from adsdata import reader
+from adsdata import compressed
+from adsdata import column_index
+from adsdata import diff
+from adsdata.rotation import SchemaRotation
 from adsdata import models
 from adsputils import load_config, setup_logging
 from adsmsg import NonBibRecord, NonBibRecordList, MetricsRecord, MetricsRecordList
+from adsmsg.protobuf import metrics_pb2
 from adsdata.tasks import task_output_results, task_output_metrics
 
 logger = None
@@ -27,61 +38,418 @@ nonbib_to_master_select_fields = ('bibcode', 'boost', 'citation_count',
 nonbib_to_master_property_fields = ('nonarticle', 'ocrabstract', 'private', 'pub_openaccess',
                                     'refereed')
 
-def load_column_files(config, nonbib_db_engine, nonbib_db_conn, sql_sync):
+def load_column_files(config, nonbib_db_engine, nonbib_db_conn, sql_sync, baseline_schema=None, copy_baseline=False):
     """ use psycopg.copy_from to data from column file to postgres
     
-    after data has been loaded, join to create a unified row view 
+    after data has been loaded, join to create a unified row view.  with
+    ROW_VIEW_INCREMENTAL and a baseline schema the row view is carried forward
+    from the baseline and only the changed bibcodes are joined
+
+    when COPY_WORKERS is more than 1 column files are loaded in parallel, each
+    worker process uses its own database connection.  the column tables are
+    independent until they are joined so files can be loaded in any order, the
+    largest files are started first so the total time is close to the time
+    needed for the largest file.  files listed in COPY_SHARDS are also split
+    into byte ranges that are loaded by separate workers.  ValueError is
+    raised, before the row view is built, when the shards of a file did not
+    load all of its rows
     """
-    raw_conn = nonbib_db_engine.raw_connection()
-    cur = raw_conn.cursor()
-    
+    jobs = column_file_jobs(config, sql_sync.schema)
+    workers = config.get('COPY_WORKERS', 1)
+    if workers > 1:
+        connection_string = str(nonbib_db_engine.url)
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            result = pool.map_async(load_column_file_worker, [(connection_string,) + job for job in jobs], chunksize=1)
+            # count the rows in sharded files while the workers load them
+            expected = sharded_row_counts(jobs)
+            row_counts = result.get()
+        finally:
+            pool.close()
+            pool.join()
+        if not verify_shards(jobs, row_counts, expected):
+            # the row view would be built with the missing rows
+            raise ValueError('sharded load into schema {} is missing rows, see the log'.format(sql_sync.schema))
+    else:
+        raw_conn = nonbib_db_engine.raw_connection()
+        cur = raw_conn.cursor()
+        for job in jobs:
+            load_column_file(raw_conn, cur, *job)
+        cur.close()
+        raw_conn.close()
+    record_column_files(config, nonbib_db_conn, sql_sync.schema)
+    create_joined_rows(config, nonbib_db_conn, sql_sync, baseline_schema, copy_baseline)
+
+
+def create_joined_rows(config, nonbib_db_conn, sql_sync, baseline_schema=None, copy_baseline=False):
+    """create the row view, incrementally from the baseline when ROW_VIEW_INCREMENTAL is set
+
+    with ROW_VIEW_PARTITIONS the row view is a table partitioned by hash of bibcode.
+    copy_baseline leaves the baseline's row view in place, see NonBib.update_joined_rows"""
+    partitions = config.get('ROW_VIEW_PARTITIONS', 0)
+    if not config.get('ROW_VIEW_INCREMENTAL', False):
+        sql_sync.create_joined_rows(nonbib_db_conn, partitions=partitions)
+    elif baseline_schema:
+        sql_sync.update_joined_rows(nonbib_db_conn, baseline_schema, partitions=partitions, copy_baseline=copy_baseline)
+    else:
+        sql_sync.create_joined_rows(nonbib_db_conn, as_table=True, partitions=partitions)
+
+
+def ingest_delta(config, nonbib_db_engine, nonbib_db_conn, sql_sync, baseline_schema):
+    """load today's column files and find the bibcodes that changed from the baseline
+
+    every column file is loaded into a staging schema while the current
+    schema stays readable, then the staging schema is swapped in and the
+    current schema becomes the baseline (see rotation.py).  when
+    use_file_delta allows, the staging schema instead starts as a copy of
+    the current column tables and row view, which are updated from a diff of
+    the column files.  a column file the diff can not merge loads every
+    file.  schemas pushed out of the SCHEMA_GENERATIONS kept are dropped on a
+    background thread.  the column files are then copied to
+    BASELINE_DATA_PATH for the next file delta"""
+    rotation = SchemaRotation(sql_sync.schema, baseline_schema, config.get('SCHEMA_GENERATIONS', 2))
+    file_delta = use_file_delta(config, nonbib_db_conn, sql_sync)
+    if file_delta:
+        staging_sql_sync = rotation.prepare(nonbib_db_engine)
+        staging_sql_sync.create_column_tables(nonbib_db_engine)
+        staging_sql_sync.copy_column_tables(nonbib_db_conn, sql_sync.schema)
+        staging_sql_sync.copy_row_view(nonbib_db_conn, sql_sync.schema)
+        try:
+            load_column_file_deltas(config, nonbib_db_engine, nonbib_db_conn, staging_sql_sync, sql_sync.schema)
+            record_column_files(config, nonbib_db_conn, staging_sql_sync.schema)
+        except ValueError as e:
+            # raised by diff before anything is written for a file that is not sorted
+            logger.error('file delta, {}, loading all column files'.format(e))
+            file_delta = False
+    if not file_delta:
+        # create the new and populate, compared with the current schema which is still live
+        staging_sql_sync = rotation.prepare(nonbib_db_engine)
+        staging_sql_sync.create_column_tables(nonbib_db_engine)
+        load_column_files(config, nonbib_db_engine, nonbib_db_conn, staging_sql_sync, sql_sync.schema,
+                          copy_baseline=True)
+        # compute delta between old and new
+        staging_sql_sync.create_delta_rows(nonbib_db_conn, sql_sync.schema)
+    rotation.verify(nonbib_db_conn)
+    # the current becomes the baseline (for later comparison)
+    rotation.swap(nonbib_db_conn)
+    rotation.drop_retired(nonbib_db_engine)
+    if config.get('BASELINE_DATA_PATH'):
+        update_baseline_files(config)
+    sql_sync.log_delta_reasons(nonbib_db_conn, baseline_schema, config.get('DELTA_STATS_SCHEMA'))
+
+
+def use_file_delta(config, nonbib_db_conn, sql_sync):
+    """return True if the column tables can be updated from a diff of the column files
+
+    needs ROW_VIEW_INCREMENTAL, BASELINE_DATA_PATH holding the column files
+    the current tables were loaded from and a row view table with row_hash.
+    the baseline files must have the size and modification time recorded
+    by record_column_files when the current tables were loaded, a stale
+    baseline would hide a value that changed and changed back"""
+    baseline_path = config.get('BASELINE_DATA_PATH')
+    if not baseline_path:
+        return False
+    if not config.get('ROW_VIEW_INCREMENTAL', False):
+        logger.warn('file delta, BASELINE_DATA_PATH needs ROW_VIEW_INCREMENTAL, loading all column files')
+        return False
+    loaded = loaded_column_files(nonbib_db_conn, sql_sync.schema)
+    if not loaded or loaded != column_file_signatures(config, baseline_path):
+        logger.warn('file delta, column files in {} are not the files schema {} was loaded from, loading all column files'
+                    .format(baseline_path, sql_sync.schema))
+        return False
+    if sql_sync.get_relation_kind(nonbib_db_conn, sql_sync.schema, 'rowviewm') not in ('r', 'p') \
+            or not sql_sync.has_column(nonbib_db_conn, sql_sync.schema, 'rowviewm', 'row_hash'):
+        logger.info('file delta, row view in schema {} is not a table with row_hash, loading all column files'
+                    .format(sql_sync.schema))
+        return False
+    return True
+
+
+def column_file_signatures(config, data_path):
+    """return dict of column file name, relative to data_path, to (size, modification time in whole seconds)
+
+    files that do not exist are left out"""
+    signatures = {}
+    for job in column_file_jobs(dict(config, DATA_PATH=data_path, COPY_WORKERS=1), 'nonbib'):
+        filename = job[2]
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            signatures[filename[len(data_path):]] = (stat.st_size, int(stat.st_mtime))
+    return signatures
+
+
+def record_column_files(config, nonbib_db_conn, schema):
+    """save the signatures of the column files in DATA_PATH that were loaded into schema, see use_file_delta"""
+    nonbib_db_conn.execute('drop table if exists {0}.column_files; '
+                           'create table {0}.column_files (filename varchar primary key, size bigint, mtime bigint)'
+                           .format(schema))
+    signatures = column_file_signatures(config, config['DATA_PATH'])
+    if signatures:
+        nonbib_db_conn.execute('insert into {}.column_files (filename, size, mtime) values (%s, %s, %s)'.format(schema),
+                               [(name,) + signature for name, signature in sorted(signatures.items())])
+
+
+def loaded_column_files(nonbib_db_conn, schema):
+    """return the signatures saved by record_column_files for schema, None when there are none"""
+    if nonbib_db_conn.execute("select to_regclass('{}.column_files')".format(schema)).scalar() is None:
+        return None
+    return dict((name, (size, mtime)) for name, size, mtime in
+                nonbib_db_conn.execute('select filename, size, mtime from {}.column_files'.format(schema)))
+
+
+def update_baseline_files(config):
+    """copy the column files in DATA_PATH to BASELINE_DATA_PATH, the baseline for the next file delta
+
+    each file is copied to a temporary name and renamed.  copy2 keeps the
+    modification time, so the copies match the recorded signatures"""
+    for name in sorted(column_file_signatures(config, config['DATA_PATH'])):
+        target = config['BASELINE_DATA_PATH'] + name
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        shutil.copy2(config['DATA_PATH'] + name, target + '.tmp')
+        os.rename(target + '.tmp', target)
+    logger.info('file delta, copied column files from {} to {}'.format(config['DATA_PATH'], config['BASELINE_DATA_PATH']))
+
+
+def load_column_file_deltas(config, nonbib_db_engine, nonbib_db_conn, sql_sync, baseline_schema):
+    """update the column tables of sql_sync from the differences between the baseline and current column files
+
+    the column tables and row view of sql_sync start as copies of the
+    baseline schema's (see ingest_delta).  each column file is compared with
+    its version in BASELINE_DATA_PATH (see diff.py), ValueError is raised
+    before anything is written when one can not be compared.  the lines of
+    added and changed bibcodes are written to a small delta column file and
+    every bibcode that differs to the filedelta table.  rows of every bibcode
+    that differs are deleted from the column table and the delta file is
+    loaded with the usual reader.  canonical is reloaded in
+    full when it changes since its id is a line number.  the row view is then
+    updated for just the changed bibcodes"""
+    jobs = column_file_jobs(dict(config, COPY_WORKERS=1), sql_sync.schema)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        deltas = []
+        bibcodes_filename = os.path.join(tmp_dir, 'bibcodes.delta')
+        with open(bibcodes_filename, 'w') as bibcodes_file:
+            for i, job in enumerate(jobs):
+                table_name, file_type, filename = job[:3]
+                baseline_filename = config['BASELINE_DATA_PATH'] + filename[len(config['DATA_PATH']):]
+                lines_filename = os.path.join(tmp_dir, '{}.delta'.format(i))
+                with open(lines_filename, 'w') as lines_file:
+                    counts = diff.write_column_file_delta(file_type, baseline_filename, filename,
+                                                          lines_file, bibcodes_file, '{}\t{}'.format(i, file_type))
+                logger.info('file delta, {} compared to {}: {}'.format(filename, baseline_filename, counts))
+                deltas.append((i, job, lines_filename, sum(counts.values())))
+
+        raw_conn = nonbib_db_engine.raw_connection()
+        cur = raw_conn.cursor()
+        cur.execute('drop table if exists {0}.filedelta; '
+                    'create table {0}.filedelta (job integer, file_type varchar, action varchar, bibcode varchar)'
+                    .format(sql_sync.schema))
+        with open(bibcodes_filename) as f:
+            cur.copy_from(f, sql_sync.schema + '.filedelta', size=config.get('COPY_BUFFER_SIZE', 8192))
+        cur.execute('create index on {}.filedelta (job, bibcode)'.format(sql_sync.schema))
+        raw_conn.commit()
+        for i, job, lines_filename, count in deltas:
+            if count == 0:
+                continue
+            table_name, file_type, filename, link_type, link_sub_type = job[:5]
+            if file_type == 'canonical':
+                cur.execute('truncate {}'.format(table_name))
+                load_column_file(raw_conn, cur, *job)
+                continue
+            # the delete and the load of the delta file are committed together by load_column_file.
+            # added bibcodes are deleted too, a rerun after a failure may find them already loaded
+            sql_command = 'delete from {0} using {1}.filedelta where {0}.bibcode = {1}.filedelta.bibcode ' \
+                          'and {1}.filedelta.job = %s'.format(table_name, sql_sync.schema)
+            params = [i]
+            if file_type == 'datalinks':
+                # several files load datalinks, only delete the rows from this one
+                sql_command += ' and {}.link_type = %s'.format(table_name)
+                params.append(link_type)
+                if link_type != 'DATA':
+                    sql_command += ' and {}.link_sub_type = %s'.format(table_name)
+                    params.append(link_sub_type)
+            cur.execute(sql_command, params)
+            load_column_file(raw_conn, cur, table_name, file_type, lines_filename, link_type, link_sub_type)
+        cur.close()
+        raw_conn.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    sql_sync.update_changed_rows(nonbib_db_conn, baseline_schema)
+
+
+def column_file_jobs(config, schema):
+    """return list of (table_name, file_type, filename, link_type, link_sub_type, start_offset, end_offset)
+
+    there is one entry per column file, datalinks has several files all loaded into the same table.
+    file names are resolved to compressed variants when only those exist.
+    when loading in parallel, uncompressed files in COPY_SHARDS have one entry per shard.
+    entries are sorted by the number of bytes to load, largest first"""
+    shards = config.get('COPY_SHARDS', {}) if config.get('COPY_WORKERS', 1) > 1 and config['MAX_ROWS'] < 0 else {}
+    jobs = []
     for t in nonbib.NonBib.all_types:
-        table_name = sql_sync.schema + '.' + t
-        logger.info('processing {}'.format(table_name))
-        # here we have to read multiple files, information in config file are in a list
+        table_name = schema + '.' + t
         if t == 'datalinks':
-            load_column_files_datalinks_table(config[t.upper()], table_name, t, raw_conn, cur)
+            # from_config is a list of lines that could have one the following two formats
+            # path,link_type,link_sub_type (i.e., config/links/eprint_html/all.links,ARTICLE,EPRINT_HTML) or
+            # path,link_type (i.e., config/links/video/all.links,PRESENTATION)
+            for oneLinkType in config[t.upper()]:
+                if (oneLinkType.count(',') == 1):
+                    [filename, linktype] = oneLinkType.split(',')
+                    linksubtype = 'NA'
+                elif (oneLinkType.count(',') == 2):
+                    [filename, linktype, linksubtype] = oneLinkType.split(',')
+                else:
+                    break
+                filename = compressed.resolve_column_file(config['DATA_PATH'] + filename)
+                jobs.append((table_name, t, filename, linktype, linksubtype, 0, None))
         else:
-            filename = config['DATA_PATH'] + config[t.upper()]
-            if t == 'canonical':
-                r = reader.BibcodeFileReader(filename)
-            elif t in ('refereed', 'pub_openaccess', 'private', 'ocrabstract', 'nonarticle'):
-                r = reader.OnlyTrueFileReader(filename)
+            filename = compressed.resolve_column_file(config['DATA_PATH'] + config[t.upper()])
+            if shards.get(t, 1) > 1 and os.path.exists(filename) and not compressed.is_compressed(filename):
+                # byte ranges of a compressed file can not be read independently
+                offsets = reader.shard_offsets(filename, shards[t])
+                for start_offset, end_offset in zip(offsets, offsets[1:]):
+                    jobs.append((table_name, t, filename, None, None, start_offset, end_offset))
             else:
-                r = reader.StandardFileReader(t, filename)
-            if r:
-                cur.copy_from(r, table_name)
-                raw_conn.commit()
-
-    cur.close()
-    raw_conn.close()
-    sql_sync.create_joined_rows(nonbib_db_conn)
-
-
-def load_column_files_datalinks_table(from_config, table_name, file_type, raw_conn, cur):
-
-    # from_config is a list of lines that could have one the following two formats
-    # path,link_type,link_sub_type (i.e., config/links/eprint_html/all.links,ARTICLE,EPRINT_HTML) or
-    # path,link_type (i.e., config/links/video/all.links,PRESENTATION)
-    for oneLinkType in from_config:
-        if (oneLinkType.count(',') == 1):
-            [filename, linktype] = oneLinkType.split(',')
-            linksubtype = 'NA'
-        elif (oneLinkType.count(',') == 2):
-            [filename, linktype, linksubtype] = oneLinkType.split(',')
-        else:
-            return
+                jobs.append((table_name, t, filename, None, None, 0, None))
+    jobs.sort(key=lambda job: (job[6] if job[6] is not None else column_file_size(job[2])) - job[5], reverse=True)
+    return jobs
+
 
-        if linktype == 'ASSOCIATED':
-            r = reader.DataLinksWithTitleFileReader(file_type, config['DATA_PATH'] + filename, linktype)
-        elif linktype == 'DATA':
-            r = reader.DataLinksWithTargetFileReader(file_type, config['DATA_PATH'] + filename, linktype)
+def standard_column_files(config):
+    """return list of (file_type, filename) for the column files read by StandardFileReader"""
+    files = []
+    for t in nonbib.NonBib.all_types:
+        if t in ('canonical', 'refereed', 'pub_openaccess', 'private', 'ocrabstract', 'nonarticle', 'datalinks'):
+            continue
+        files.append((t, compressed.resolve_column_file(config['DATA_PATH'] + config[t.upper()])))
+    return files
+
+
+def create_column_indexes(config):
+    """write a sidecar bibcode index for each uncompressed standard column file"""
+    for file_type, filename in standard_column_files(config):
+        if compressed.is_compressed(filename):
+            logger.warn('column index, skipping compressed file {}'.format(filename))
+            continue
+        index = column_index.ColumnIndex.build(file_type, filename)
+        logger.info('column index, wrote {} with {} bibcodes'.format(index.save(), len(index)))
+
+
+def lookup_column_indexes(config, bibcodes):
+    """print the lines each indexed column file holds for the passed bibcodes"""
+    for file_type, filename in standard_column_files(config):
+        try:
+            index = column_index.ColumnIndex.load(filename)
+        except (IOError, ValueError) as e:
+            logger.warn('column index, not using index for {}: {}'.format(filename, e))
+            continue
+        for bibcode in bibcodes:
+            for line in index.lookup(bibcode):
+                print '{}\t{}'.format(file_type, line)
+
+
+def column_file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def column_file_reader(file_type, filename, link_type=None, link_sub_type=None, start_offset=0, end_offset=None,
+                       binary=False):
+    """return the reader for the passed column file, offsets are only supported for standard files"""
+    if file_type == 'canonical':
+        return reader.BibcodeFileReader(filename, binary=binary)
+    elif file_type in ('refereed', 'pub_openaccess', 'private', 'ocrabstract', 'nonarticle'):
+        return reader.OnlyTrueFileReader(filename, binary=binary)
+    elif file_type == 'datalinks':
+        if link_type == 'ASSOCIATED':
+            return reader.DataLinksWithTitleFileReader(file_type, filename, link_type, binary=binary)
+        elif link_type == 'DATA':
+            return reader.DataLinksWithTargetFileReader(file_type, filename, link_type, binary=binary)
+        return reader.DataLinksFileReader(file_type, filename, link_type, link_sub_type, binary=binary)
+    return reader.StandardFileReader(file_type, filename, start_offset=start_offset, end_offset=end_offset,
+                                     binary=binary)
+
+
+def load_column_file(raw_conn, cur, table_name, file_type, filename, link_type=None, link_sub_type=None,
+                     start_offset=0, end_offset=None):
+    """copy a single column file (or a byte range of one) into its table and commit
+
+    with COPY_BINARY the readers produce the binary copy format, postgres then
+    does not have to parse array literals
+    returns the number of rows copied"""
+    logger.info('processing {} from {} bytes {} to {}'.format(table_name, filename, start_offset, end_offset))
+    binary = config.get('COPY_BINARY', False)
+    r = column_file_reader(file_type, filename, link_type, link_sub_type, start_offset, end_offset, binary)
+    if r:
+        if binary:
+            cur.copy_expert('COPY {} FROM STDIN BINARY'.format(table_name), r, size=config.get('COPY_BUFFER_SIZE', 8192))
         else:
-            r = reader.DataLinksFileReader(file_type, config['DATA_PATH'] + filename, linktype, linksubtype)
+            cur.copy_from(r, table_name, size=config.get('COPY_BUFFER_SIZE', 8192))
+        raw_conn.commit()
+        r.close()
+        return r.row_count
+    return 0
+
+
+def load_column_file_worker(args):
+    """entry point for process pool, loads one column file over a new connection"""
+    connection_string = args[0]
+    engine = create_engine(connection_string, poolclass=NullPool)
+    raw_conn = engine.raw_connection()
+    try:
+        cur = raw_conn.cursor()
+        row_count = load_column_file(raw_conn, cur, *args[1:])
+        cur.close()
+    finally:
+        raw_conn.close()
+        engine.dispose()
+    return row_count
+
+
+def sharded_row_counts(jobs):
+    """return dict of filename to the number of rows a single reader returns for each sharded file"""
+    sharded = set((job[1], job[2]) for job in jobs if job[5] > 0)
+    counts = {}
+    for file_type, filename in sharded:
+        r = reader.StandardFileReader(file_type, filename, quarantine=False)
+        counts[filename] = r.count_rows()
+        r.close()
+    return counts
+
+
+def verify_shards(jobs, row_counts, expected):
+    """confirm the rows loaded from the shards of each file add up to the rows in the file
+
+    returns False and logs an error if any file does not match"""
+    totals = dict((filename, 0) for filename in expected)
+    for job, row_count in zip(jobs, row_counts):
+        if job[2] in totals:
+            totals[job[2]] += row_count
+    valid = True
+    for filename, total in totals.items():
+        if total != expected[filename]:
+            logger.error('sharded load of {} copied {} rows, expected {}'.format(filename, total, expected[filename]))
+            valid = False
+        else:
+            logger.info('sharded load of {} copied {} rows'.format(filename, total))
+    return valid
+
 
-        if r:
-            cur.copy_from(r, table_name)
-            raw_conn.commit()
+def populate_metrics(config, m, metrics_db_engine, metrics_db_conn, nonbib_db_engine, nonbib_db_conn, row_view_schema):
+    """compute metrics for every row view row, in METRICS_WORKERS processes when more than 1
+
+    the parallel run checkpoints each range of METRICS_RANGE_SIZE ids, after a
+    failure populateMetricsTable finishes the remaining ranges"""
+    workers = config.get('METRICS_WORKERS', 1)
+    # the sql engine runs in parallel inside postgres
+    if workers > 1 and config.get('METRICS_ENGINE') != 'sql':
+        m.update_metrics_parallel(metrics_db_engine, nonbib_db_engine, row_view_schema, workers,
+                                  config.get('METRICS_RANGE_SIZE', 1000000))
+    else:
+        m.update_metrics_all(metrics_db_conn, nonbib_db_conn, row_view_schema)
 
 
 def nonbib_to_master_dict(row):
@@ -163,26 +531,61 @@ def add_data_link_extra_properties(current_row):
        current_row['property'].append('OPENACCESS')
     return current_row
 
-def add_data_link(session, current_row):
-    """populate property, esource, data, total_link_counts, and data_links_rows fields"""
-
-    q = config['PROPERTY_QUERY'].format(db='nonbib', bibcode=current_row['bibcode'])
-    result = session.execute(q)
-    current_row['property'] = fetch_data_link_elements(result.fetchone())
+def split_data_link_elements(values):
+    """return the elements fetch_data_link_elements gives for string_agg(values, ','), nulls are skipped"""
+    values = [v for v in values if v is not None]
+    if not values:
+        return []
+    return ','.join(values).split(',')
+
+
+def add_data_links(session, rows):
+    """populate property, esource, data, total_link_counts, and data_links_rows fields for a page of rows
+
+    one query reads the datalinks rows of every bibcode in the page, the
+    fields are then computed as the per bibcode queries in config did"""
+    links = {}
+    if rows:
+        q = config['DATALINKS_PAGE_QUERY'].format(db='nonbib')
+        for link in session.execute(q, {'bibcodes': [current_row['bibcode'] for current_row in rows]}):
+            links.setdefault(link[0], []).append(tuple(link[1:]))
+    for current_row in rows:
+        current_links = links.get(current_row['bibcode'], [])
+        # string_agg(distinct link_type) is sorted
+        current_row['property'] = split_data_link_elements(sorted(set(l[0] for l in current_links)))
+        current_row['esource'] = split_data_link_elements([l[1] for l in current_links if l[0] == 'ESOURCE'])
+        current_row = add_data_link_extra_properties(current_row)
+        data = [l for l in current_links if l[0] == 'DATA']
+        current_row['data'] = split_data_link_elements([l[1] + ':' + str(l[4]) for l in data
+                                                        if l[1] is not None and l[4] is not None])
+        current_row['total_link_counts'] = 0
+        if current_row['data']:
+            current_row['total_link_counts'] = sum(l[4] for l in data if l[4] is not None)
+        current_row['data_links_rows'] = fetch_data_link_record(current_links)
+    return rows
 
-    q = config['ESOURCE_QUERY'].format(db='nonbib', bibcode=current_row['bibcode'])
-    result = session.execute(q)
-    current_row['esource'] = fetch_data_link_elements(result.fetchone())
 
-    current_row = add_data_link_extra_properties(current_row)
-
-    q = config['DATA_QUERY'].format(db='nonbib', bibcode=current_row['bibcode'])
-    result = session.execute(q)
-    current_row['data'],current_row['total_link_counts'] = fetch_data_link_elements_counts(result.fetchone())
-
-    q = config['DATALINKS_QUERY'].format(db='nonbib', bibcode=current_row['bibcode'])
-    result = session.execute(q)
-    current_row['data_links_rows'] = fetch_data_link_record(result.fetchall())
+def add_data_link(session, current_row):
+    """populate property, esource, data, total_link_counts, and data_links_rows fields"""
+    add_data_links(session, [current_row])
+
+
+def nonbib_master_records(session, rows):
+    """yield the protobuf NonBibRecord for each row view row
+
+    datalinks are read for DATALINKS_PAGE_SIZE rows at a time by add_data_links"""
+    page_size = config.get('DATALINKS_PAGE_SIZE', 1000)
+    page = []
+    for row in rows:
+        page.append(nonbib_to_master_dict(row))
+        if len(page) >= page_size:
+            for current_row in add_data_links(session, page):
+                cleanup_for_master(current_row)
+                yield NonBibRecord(**current_row)._data
+            page = []
+    for current_row in add_data_links(session, page):
+        cleanup_for_master(current_row)
+        yield NonBibRecord(**current_row)._data
 
 
 def cleanup_for_master(r):
@@ -201,12 +604,8 @@ def nonbib_to_master_pipeline(nonbib_engine, schema, batch_size=1):
     i = 0
     max_rows = config['MAX_ROWS']
     q = session.query(models.NonBibTable).options(load_only(*nonbib_to_master_select_fields))
-    for current_row in q.yield_per(100):
-        current_row = nonbib_to_master_dict(current_row)
-        add_data_link(session, current_row)
-        cleanup_for_master(current_row)
-        rec = NonBibRecord(**current_row)
-        tmp.append(rec._data)
+    for rec in nonbib_master_records(session, q.yield_per(100)):
+        tmp.append(rec)
         i += 1
         if max_rows > 0 and i >= max_rows:
             break
@@ -238,13 +637,8 @@ def nonbib_delta_to_master_pipeline(nonbib_engine, schema, batch_size=1):
     i = 0
     n = nonbib.NonBib(schema)
     max_rows = config['MAX_ROWS']
-    for current_delta in session.query(models.NonBibDeltaTable).yield_per(100):
-        row = n.get_by_bibcode(nonbib_engine, current_delta.bibcode, nonbib_to_master_select_fields)
-        row = nonbib_to_master_dict(row)
-        add_data_link(session, row)
-        cleanup_for_master(row)
-        rec = NonBibRecord(**row)
-        tmp.append(rec._data)
+    for rec in nonbib_master_records(session, nonbib_delta_rows(session, n, nonbib_engine)):
+        tmp.append(rec)
         i += 1
         if max_rows > 0 and i > max_rows:
             break
@@ -262,58 +656,162 @@ def nonbib_delta_to_master_pipeline(nonbib_engine, schema, batch_size=1):
         task_output_results.delay(recs)
 
 
+def nonbib_delta_rows(session, n, nonbib_engine):
+    """yield the row view rows of the changed bibcodes, read DATALINKS_PAGE_SIZE bibcodes at a time"""
+    page_size = config.get('DATALINKS_PAGE_SIZE', 1000)
+    bibcodes = []
+    for current_delta in session.query(models.NonBibDeltaTable).yield_per(100):
+        bibcodes.append(current_delta.bibcode)
+        if len(bibcodes) >= page_size:
+            for row in n.get_by_bibcodes(nonbib_engine, bibcodes):
+                yield row
+            bibcodes = []
+    if bibcodes:
+        for row in n.get_by_bibcodes(nonbib_engine, bibcodes):
+            yield row
+
+
 def nonbib_bibs_to_master_pipeline(nonbib_engine, schema, bibcodes):
     """send data for the passed bibcodes to master"""
     Session = sessionmaker(bind=nonbib_engine)
     session = Session()
     session.execute('set search_path to {}'.format(schema))
     n = nonbib.NonBib(schema)
-    tmp = [] 
+    rows = []
     for bibcode in bibcodes:
         row = n.get_by_bibcode(nonbib_engine, bibcode, nonbib_to_master_select_fields)
         if row:
-            row = nonbib_to_master_dict(row)
-            add_data_link(session, row)
-            cleanup_for_master(row)
-            rec = NonBibRecord(**row)
-            tmp.append(rec._data)
+            rows.append(row)
         else:
             print 'unknown bibcode ', bibcode
+    tmp = list(nonbib_master_records(session, rows))
     recs = NonBibRecordList()
     recs.nonbib_records.extend(tmp)
     logger.debug("Calling 'app.forward_message' for '%s' bibcodes", len(recs.nonbib_records))
     task_output_results.delay(recs)
 
 
+# metrics table columns sent to master, everything but the id
+metrics_to_master_select_fields = tuple(c.name for c in models.MetricsTable.__table__.columns if c.name != 'id')
+
+
+def metrics_record_plan(columns=metrics_to_master_select_fields):
+    """return (index, field name, kind) for each column, how it is set on a protobuf MetricsRecord
+
+    computed once per export so filling a record is a loop over the plan rather
+    than the per value type checks MetricsRecord(**dict) makes"""
+    fields = metrics_pb2.MetricsRecord.DESCRIPTOR.fields_by_name
+    plan = []
+    for i, name in enumerate(columns):
+        field = fields[name]
+        repeated = field.label == field.LABEL_REPEATED
+        if field.message_type is not None and field.message_type.GetOptions().map_entry:
+            kind = 'map'
+        elif field.message_type is not None and repeated:
+            kind = 'messages'
+        elif field.message_type is not None:
+            kind = 'timestamp'
+        elif repeated:
+            kind = 'repeated'
+        else:
+            kind = 'scalar'
+        plan.append((i, name, kind))
+    return tuple(plan)
+
+
+def fill_metrics_record(record, row, plan):
+    """set the fields of protobuf MetricsRecord record from a row of column values, nulls are left unset"""
+    for i, name, kind in plan:
+        value = row[i]
+        if value is None:
+            continue
+        if kind == 'scalar':
+            setattr(record, name, value)
+        elif kind == 'repeated':
+            getattr(record, name).extend(value)
+        elif kind == 'messages':
+            add = getattr(record, name).add
+            for current in value:
+                add(**current)
+        elif kind == 'map':
+            getattr(record, name).update(value)
+        else:
+            getattr(record, name).FromDatetime(value)
+    return record
+
+
+def send_metrics_batches(batches, errors):
+    """sender thread for metrics_to_master_pipeline, queues each MetricsRecordList from batches until None
+
+    after a failure batches are still read so the producer never blocks, the
+    exception is left in errors for the producer to raise"""
+    while True:
+        recs = batches.get()
+        if recs is None:
+            return
+        if errors:
+            continue
+        try:
+            task_output_metrics.delay(recs)
+        except Exception as e:
+            logger.exception('sending metrics to master failed')
+            errors.append(e)
+
+
 def metrics_to_master_pipeline(metrics_engine, schema, batch_size=1):
-    """send all metrics data to queue for delivery to master pipeline"""
+    """send all metrics data to queue for delivery to master pipeline
+
+    rows are read over a server side cursor, METRICS_EXPORT_FETCH_SIZE at a
+    time, and set directly on the protobuf records of the batch being built.
+    a batch is sent when its records reach METRICS_EXPORT_BATCH_BYTES
+    serialized bytes, or batch_size records when that is 0.  batches are
+    handed to a sender thread so reading the table overlaps with queuing"""
     global config
-    Session = sessionmaker(bind=metrics_engine)
-    session = Session()
-    session.execute('set search_path to {}'.format(schema))
-    tmp = []
-    i = 0
     max_rows = config['MAX_ROWS']
-    for current_row in session.query(models.MetricsTable).yield_per(100):
-        current_row = row2dict(current_row)
-        current_row.pop('id')
-        rec = MetricsRecord(**current_row)
-        tmp.append(rec._data)
-        i += 1
-        if max_rows > 0 and i > max_rows:
-            break
-        if len(tmp) >= batch_size:
-            recs = MetricsRecordList()
-            recs.metrics_records.extend(tmp)
-            logger.info("Calling metrics 'app.forward_message' count = '%s'", i)
-            task_output_metrics.delay(recs)
-            tmp = []
-
-    if len(tmp) > 0:
-        recs = MetricsRecordList()
-        recs.metrics_records.extend(tmp)
-        logger.debug("Calling metrics 'app.forward_message' with count = '%s'", i)
-        task_output_metrics.delay(recs)
+    batch_bytes = config.get('METRICS_EXPORT_BATCH_BYTES', 1000000)
+    fetch_size = config.get('METRICS_EXPORT_FETCH_SIZE', 10000)
+    plan = metrics_record_plan()
+    batches = Queue.Queue(maxsize=config.get('METRICS_EXPORT_QUEUE_SIZE', 4))
+    errors = []
+    sender = threading.Thread(target=send_metrics_batches, args=(batches, errors), name='send_metrics_batches')
+    sender.start()
+
+    conn = metrics_engine.connect().execution_options(stream_results=True)
+    rows = conn.execute('select {} from {}.metrics'.format(', '.join(metrics_to_master_select_fields), schema))
+    recs = MetricsRecordList()
+    count = 0
+    size = 0
+    i = 0
+    try:
+        while not errors:
+            fetched = rows.fetchmany(fetch_size)
+            if not fetched:
+                break
+            for row in fetched:
+                record = fill_metrics_record(recs.metrics_records.add(), row, plan)
+                size += record.ByteSize()
+                count += 1
+                i += 1
+                if (batch_bytes > 0 and size >= batch_bytes) or (batch_bytes <= 0 and count >= batch_size):
+                    logger.info("Calling metrics 'app.forward_message' count = '%s'", i)
+                    batches.put(recs)
+                    recs = MetricsRecordList()
+                    count = 0
+                    size = 0
+                if max_rows > 0 and i >= max_rows:
+                    break
+            if max_rows > 0 and i >= max_rows:
+                break
+        if count > 0 and not errors:
+            logger.debug("Calling metrics 'app.forward_message' with count = '%s'", i)
+            batches.put(recs)
+    finally:
+        batches.put(None)
+        sender.join()
+        rows.close()
+        conn.close()
+    if errors:
+        raise errors[0]
 
 
 def metrics_delta_to_master_pipeline(metrics_engine, metrics_schema, nonbib_engine, nonbib_schema,  batch_size=1):
@@ -454,7 +952,8 @@ def main():
                         + ' | runRowViewPipelineDelta | runMetricsPipelineDelta '\
                         + ' | runPipelines | runPipelinesDelta | nonbibToMasterPipeline | nonbibDeltaToMasterPipeline'
                         + ' | metricsToMasterPipeline | metricsDeltaToMasterPipeline | metricsCompare'
-                        + ' | resetNonbib')
+                        + ' | resetNonbib | createColumnIndex | lookupColumnIndex | updateJoinedRows'
+                        + ' | metricsEngineCompare')
 
     args = parser.parse_args()
 
@@ -486,6 +985,12 @@ def main():
             print 'reset complete'
         else:
             print 'merged output table found, reset not needed'
+    elif args.command == 'createColumnIndex':
+        create_column_indexes(config)
+
+    elif args.command == 'lookupColumnIndex' and args.bibcodes:
+        lookup_column_indexes(config, args.bibcodes.split(','))
+
     elif args.command == 'createIngestTables':
         sql_sync.create_column_tables(nonbib_db_engine)
 
@@ -493,7 +998,15 @@ def main():
         sql_sync.drop_column_tables(nonbib_db_engine)
 
     elif args.command == 'createJoinedRows':
-        sql_sync.create_joined_rows(nonbib_db_conn)
+        create_joined_rows(config, nonbib_db_conn, sql_sync)
+
+    elif args.command == 'updateJoinedRows' and args.rowViewSchemaName and args.rowViewBaselineSchemaName:
+        # create_joined_rows would quietly do a full rebuild, an explicit update should not
+        if config.get('ROW_VIEW_INCREMENTAL', False):
+            create_joined_rows(config, nonbib_db_conn, sql_sync, args.rowViewBaselineSchemaName)
+        else:
+            logger.error('updateJoinedRows needs ROW_VIEW_INCREMENTAL, row view in schema {} not updated, '
+                         'use createJoinedRows for a full rebuild'.format(args.rowViewSchemaName))
 
     elif args.command == 'createMetricsTable' and args.metricsSchemaName:
         m = metrics.Metrics(args.metricsSchemaName)
@@ -512,8 +1025,9 @@ def main():
                     m.update_metrics_bibcode(bibcode, metrics_db_conn, nonbib_db_conn)
 
     elif args.command == 'populateMetricsTable' and args.rowViewSchemaName and args.metricsSchemaName:
-        m = metrics.Metrics()
-        m.update_metrics_all(metrics_db_conn, nonbib_db_conn, args.rowViewSchemaName)
+        m = metrics.Metrics(args.metricsSchemaName)
+        populate_metrics(config, m, metrics_db_engine, metrics_db_conn, nonbib_db_engine, nonbib_db_conn,
+                         args.rowViewSchemaName)
 
     elif args.command == 'populateMetricsTableDelta' and args.rowViewSchemaName and args.metricsSchemaName:
         m = metrics.Metrics(args.metricsSchemaName)
@@ -529,7 +1043,7 @@ def main():
         sql_sync.build_new_bibcodes(nonbib_db_conn, args.rowViewBaselineSchemaName)
 
     elif args.command == 'logDeltaReasons' and args.rowViewSchemaName and args.rowViewBaselineSchemaName:
-        sql_sync.log_delta_reasons(nonbib_db_conn, args.rowViewBaselineSchemaName)
+        sql_sync.log_delta_reasons(nonbib_db_conn, args.rowViewBaselineSchemaName, config.get('DELTA_STATS_SCHEMA'))
 
     elif args.command == 'runRowViewPipeline' and args.rowViewSchemaName:
         # drop tables, create tables, load data, create joined view
@@ -541,22 +1055,12 @@ def main():
         m = metrics.Metrics(args.metricsSchemaName)
         m.drop_metrics_table(metrics_db_engine)
         m.create_metrics_table(metrics_db_engine)
-        m.update_metrics_all(metrics_db_conn, nonbib_db_conn, args.rowViewSchemaName)
+        populate_metrics(config, m, metrics_db_engine, metrics_db_conn, nonbib_db_engine, nonbib_db_conn,
+                         args.rowViewSchemaName)
 
     elif args.command == 'runRowViewPipelineDelta' and args.rowViewSchemaName and args.rowViewBaselineSchemaName:
-        # we delete the old data
-        baseline_sql_sync = nonbib.NonBib(args.rowViewBaselineSchemaName)
-        baseline_engine = create_engine(nonbib_connection_string)
-        baseline_sql_sync.drop_column_tables(baseline_engine)
-        # rename the current to be the old (for later comparison)
-        sql_sync.rename_schema(nonbib_db_conn, args.rowViewBaselineSchemaName)
-        # create the new and populate
-        baseline_sql_sync = None
-        sql_sync.create_column_tables(nonbib_db_engine)
-        load_column_files(config, nonbib_db_engine, nonbib_db_conn, sql_sync)
-        # compute delta between old and new
-        sql_sync.create_delta_rows(nonbib_db_conn, args.rowViewBaselineSchemaName)
-        sql_sync.log_delta_reasons(nonbib_db_conn, args.rowViewBaselineSchemaName)
+        # we delete the old data, load the new and compute the delta between old and new
+        ingest_delta(config, nonbib_db_engine, nonbib_db_conn, sql_sync, args.rowViewBaselineSchemaName)
 
     elif args.command == 'runMetricsPipelineDelta' and args.rowViewSchemaName and args.metricsSchemaName:
         m = metrics.Metrics(args.metricsSchemaName)
@@ -571,21 +1075,12 @@ def main():
         m = metrics.Metrics(args.metricsSchemaName)
         m.drop_metrics_table(metrics_db_engine)
         m.create_metrics_table(metrics_db_engine)
-        m.update_metrics_all(metrics_db_conn, nonbib_db_conn, args.rowViewSchemaName)
+        populate_metrics(config, m, metrics_db_engine, metrics_db_conn, nonbib_db_engine, nonbib_db_conn,
+                         args.rowViewSchemaName)
 
     elif args.command == 'runPipelinesDelta' and args.rowViewSchemaName and args.metricsSchemaName and args.rowViewBaselineSchemaName:
         # drop tables, rename schema, create tables, load data, compute delta, compute metrics
-        baseline_sql_sync = nonbib.NonBib(args.rowViewBaselineSchemaName)
-        baseline_engine = create_engine(nonbib_connection_string)
-        baseline_sql_sync.drop_column_tables(baseline_engine)
-        sql_sync.rename_schema(nonbib_db_conn, args.rowViewBaselineSchemaName)
-
-        baseline_sql_sync = None
-        sql_sync.create_column_tables(nonbib_db_engine)
-        load_column_files(config, nonbib_db_engine, nonbib_db_conn, sql_sync)
-
-        sql_sync.create_delta_rows(nonbib_db_conn, args.rowViewBaselineSchemaName)
-        sql_sync.log_delta_reasons(nonbib_db_conn, args.rowViewBaselineSchemaName)
+        ingest_delta(config, nonbib_db_engine, nonbib_db_conn, sql_sync, args.rowViewBaselineSchemaName)
 
         m = metrics.Metrics(args.metricsSchemaName)
         m.update_metrics_changed(metrics_db_conn, nonbib_db_conn, args.rowViewSchemaName)
@@ -663,6 +1158,21 @@ def main():
         session.close()
         session2.close()
 
+    elif args.command == 'metricsEngineCompare' and args.rowViewSchemaName and args.metricsSchemaName:
+        # spot check the metrics table, however it was computed, against row_view_to_metrics
+        metrics_logger = setup_logging('metricsCompare', 'INFO')
+        m = metrics.Metrics(args.metricsSchemaName)
+        if args.bibcodes:
+            bibcodes = args.bibcodes.split(',')
+        else:
+            bibcodes = [row[0] for row in metrics_db_conn.execute('select bibcode from {}.metrics order by random() limit {}'
+                                                                   .format(args.metricsSchemaName,
+                                                                           int(config.get('METRICS_COMPARE_SAMPLE', 1000))))]
+        mismatches = m.compare_engines(metrics_db_conn, nonbib_db_conn, bibcodes, args.rowViewSchemaName, metrics_logger)
+        for bibcode in sorted(mismatches):
+            print '{} MISMATCHED FIELDS: {}'.format(bibcode, mismatches[bibcode])
+        print 'compared {} bibcodes, {} mismatched'.format(len(bibcodes), len(mismatches))
+
     else:
         print 'app.py: illegal command or missing argument, command = ', args.command
         print '  row view schema name = ', args.rowViewSchemaName
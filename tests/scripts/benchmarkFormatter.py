@@ -0,0 +1,104 @@
+"""benchmark StandardFileReader.process_value against the original formatter
+
+usage: python tests/scripts/benchmarkFormatter.py [group_size]
+
+the citation and reference values from tests/data/data1 are combined into
+groups of group_size values, like a bibcode with many citations, and each
+group is formatted with the current process_value and with a copy of the
+original that built the result with repeated string concatenation.  the
+output of the two is compared and values per second is reported for each.
+"""
+
+import os
+import sys
+import time
+
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+
+from adsputils import load_config
+from adsdata import reader
+
+
+def concatenating_process_value(value, as_array=False, quote_value=False, tab_separator=False):
+    """the original StandardFileReader.process_value, kept here for comparison"""
+    if '\x00' in value:
+        value = value.replace('\x00', '')
+
+    return_value = ''
+    if tab_separator and isinstance(value, list) and len(value) == 1:
+        value = value[0]
+
+    output_separator = ','
+    if (as_array == False):
+        output_separator = '\t'
+
+    if isinstance(value, str) and '\t' in value:
+        values = value.split('\t')
+        for v in values:
+            if quote_value and v[0] != '"':
+                v = '"' + v + '"'
+            if len(return_value) == 0:
+                return_value = v
+            else:
+                return_value += output_separator + v
+
+    elif isinstance(value, list):
+        for v in value:
+            v = v.replace('\t', ' ')
+            if quote_value and ((len(v) > 0 and v[0] != '"') or (len(v) == 0)):
+                v = '"' + v + '"'
+            elif not quote_value and len(v) == 0:
+                v = 0
+            if len(return_value) == 0:
+                return_value = v
+            else:
+                return_value += output_separator + v
+
+    elif isinstance(value, str):
+        if quote_value and value[0] != '"':
+            return_value = '"' + value + '"'
+        else:
+            return_value = value
+
+    if as_array:
+        return_value = '{' + return_value + '}'
+    return return_value
+
+
+def groups(config, file_type, group_size):
+    """return the values from a test column file split into lists of group_size values"""
+    filename = os.path.join(PROJECT_HOME, config['TEST_DATA_PATH'], 'data1', config[file_type.upper()])
+    with open(filename) as f:
+        values = [line[20:-1] for line in f]
+    return [values[i:i + group_size] for i in xrange(0, len(values), group_size)]
+
+
+def time_formatter(formatter, values, quote_value):
+    """return (values/sec, output) for formatting every group"""
+    start = time.time()
+    output = [formatter(v, True, quote_value, False) for v in values]
+    elapsed = time.time() - start
+    return sum(len(v) for v in values) / max(elapsed, 1e-9), output
+
+
+def main():
+    group_size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    config = load_config(PROJECT_HOME)
+    print '{:<16} {:>10} {:>16} {:>16} {:>8}'.format('file', 'groups', 'old values/s', 'values/s', 'speedup')
+    for file_type, quote_value in (('citation', False), ('reference', False), ('citation', True)):
+        r = reader.StandardFileReader(file_type, os.path.join(PROJECT_HOME, config['TEST_DATA_PATH'], 'data1',
+                                                              config[file_type.upper()]))
+        values = groups(config, file_type, group_size)
+        old_rate, old_output = time_formatter(concatenating_process_value, values, quote_value)
+        new_rate, new_output = time_formatter(r.process_value, values, quote_value)
+        r.close()
+        if old_output != new_output:
+            print 'output mismatch for {}'.format(file_type)
+        label = file_type + (' quoted' if quote_value else '')
+        print '{:<16} {:>10} {:>16.0f} {:>16.0f} {:>7.1f}x'.format(label, len(values), old_rate, new_rate,
+                                                                   new_rate / old_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""benchmark the batch metrics engine against row_view_to_metrics
+
+usage: python tests/scripts/benchmarkMetrics.py [papers] [citations_per_paper]
+
+builds a random CitationGraph in memory, no database needed, then computes
+the metrics of every paper with Metrics.row_view_to_metrics using the graph
+and with MetricsBatch.  rn_citations of the two are compared and papers per
+second is reported for each.  only the numbers are timed, not writing rows.
+"""
+
+import os
+import sys
+import time
+import random
+from array import array
+
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+
+from adsdata.citation_graph import CitationGraph
+from adsdata.metrics_batch import MetricsBatch
+from adsdata.metrics import Metrics
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def random_graph(papers, citations_per_paper):
+    random.seed(1)
+    bibcodes = ''.join('{:04d}ApJ...{:08d}X'.format(random.randint(1900, 2018), i) for i in xrange(papers))
+    offsets = array('L', [0])
+    targets = array('i')
+    for i in xrange(papers):
+        targets.extend(random.sample(xrange(papers), min(papers, random.randint(0, 2 * citations_per_paper))))
+        offsets.append(len(targets))
+    citation_counts = array('i', [offsets[i + 1] - offsets[i] for i in xrange(papers)])
+    return CitationGraph(bibcodes, array('b', [random.randint(0, 1) for i in xrange(papers)]),
+                         array('i', [random.randint(0, 60) for i in xrange(papers)]), offsets, targets,
+                         citation_counts, array('i', [random.randint(1, 10) for i in xrange(papers)]))
+
+
+def main():
+    papers = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    citations_per_paper = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    graph = random_graph(papers, citations_per_paper)
+    rows = [Row(id=i, bibcode=graph.bibcode(i), refereed=False, reads=[], downloads=[],
+                citations=['x'] * graph.citation_counts[i], authors=['a'] * graph.author_counts[i],
+                reference=['r'] * graph.reference_counts[i])
+            for i in xrange(papers)]
+    print 'papers = {}, citations = {}'.format(papers, len(graph.targets))
+
+    met = Metrics()
+    start = time.time()
+    expected = [met.row_view_to_metrics(row, None, graph=graph).rn_citations for row in rows]
+    elapsed = time.time() - start
+    print 'row_view_to_metrics: {:.2f} seconds, {:.0f} papers/second'.format(elapsed, papers / elapsed)
+
+    start = time.time()
+    batch = MetricsBatch(graph)
+    block_size = 100000
+    computed = []
+    for block_start in xrange(0, papers, block_size):
+        block = batch.compute(block_start, min(block_start + block_size, papers))
+        computed.extend(block.rn_citations.tolist())
+    elapsed = time.time() - start
+    print 'MetricsBatch:        {:.2f} seconds, {:.0f} papers/second'.format(elapsed, papers / elapsed)
+
+    mismatches = sum(1 for x, y in zip(expected, computed) if abs(x - y) > 1e-9)
+    print 'rn_citations mismatches = {}'.format(mismatches)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""benchmark Metrics.flush against the original ORM flush
+
+usage: python tests/scripts/benchmarkMetricsWriter.py [records] [flush_size]
+
+needs the postgres database in METRICS_DATABASE.  a scratch schema,
+metricsbenchmark, is created and dropped.  the same synthetic metrics
+records are written with the original flush, one session add per record,
+and with the current flush, a copy to a temporary table merged with
+insert ... on conflict.  the current flush runs twice, the second time every
+bibcode is already in the table so the merge updates.  records per second
+is reported for each.
+"""
+
+import os
+import sys
+import time
+
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from adsputils import load_config
+from adsdata.metrics import Metrics
+from adsdata import models
+
+SCHEMA = 'metricsbenchmark'
+
+
+def orm_flush(metrics, db_conn):
+    """the original Metrics.flush, kept here for comparison"""
+    Session = sessionmaker()
+    sess = Session(bind=db_conn)
+    sess.execute('set search_path to {}'.format(SCHEMA))
+    for current in metrics.upserts:
+        sess.add(current)
+    sess.commit()
+    sess.close()
+    metrics.upserts = []
+
+
+def records(count, suffix):
+    for i in xrange(count):
+        m = models.MetricsTable()
+        m.bibcode = '2000ApJ...{:08d}{}'.format(i, suffix)
+        m.refereed = i % 2 == 0
+        m.rn_citations = 0.2 * (i % 7)
+        m.rn_citation_data = [{'bibcode': '2001ApJ...00000001X', 'ref_norm': 0.2, 'auth_norm': 0.5,
+                               'pubyear': 2000, 'cityear': 2001}] * (i % 5)
+        m.rn_citations_hist = {'2001': 0.2 * (i % 5)}
+        m.downloads = [0] * 21
+        m.reads = [1] * 21
+        m.an_citations = 0.1
+        m.refereed_citation_num = i % 5
+        m.citation_num = i % 5
+        m.reference_num = 10
+        m.citations = ['2001ApJ...00000001X'] * (i % 5)
+        m.refereed_citations = ['2001ApJ...00000001X'] * (i % 3)
+        m.author_num = 2
+        m.an_refereed_citations = 0.1
+        m.modtime = '2018-01-01 00:00:00'
+        yield m
+
+
+def run(label, metrics, db_conn, count, flush_size, suffix, flush):
+    start = time.time()
+    for i, m in enumerate(records(count, suffix)):
+        metrics.upserts.append(m)
+        if (i + 1) % flush_size == 0:
+            flush(db_conn)
+    flush(db_conn)
+    elapsed = time.time() - start
+    print '{}: {:.2f} seconds, {:.0f} records/second'.format(label, elapsed, count / elapsed)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    flush_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    config = load_config()
+    engine = create_engine(config.get('METRICS_DATABASE', 'postgresql://postgres@localhost:5432/postgres'))
+    metrics = Metrics(SCHEMA)
+    metrics.drop_metrics_table(engine)
+    metrics.create_metrics_table(engine)
+    db_conn = engine.connect()
+    try:
+        print 'records = {}, flush size = {}'.format(count, flush_size)
+        run('orm flush          ', metrics, db_conn, count, flush_size, 'O', lambda conn: orm_flush(metrics, conn))
+        run('copy merge, insert ', metrics, db_conn, count, flush_size, 'C', metrics.flush)
+        run('copy merge, update ', metrics, db_conn, count, flush_size, 'C', metrics.flush)
+        print 'rows = {}'.format(db_conn.execute('select count(*) from {}.metrics'.format(SCHEMA)).scalar())
+    finally:
+        db_conn.close()
+        metrics.drop_metrics_table(engine)
+
+
+if __name__ == '__main__':
+    main()
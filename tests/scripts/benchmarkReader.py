@@ -0,0 +1,98 @@
+"""benchmark column file readers against scaled up test data
+
+usage: python tests/scripts/benchmarkReader.py [scale]
+
+each test file from tests/data/data1 is repeated scale times into a
+temporary file, the file is read with the current readers (file and
+mmap backends) and with a copy of the original reader that peeked at
+the next line using tell/readline/seek.  lines per second is reported
+for each.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+
+from adsputils import load_config
+from adsdata import reader
+
+
+class PeekingFileReader(reader.StandardFileReader):
+    """the original StandardFileReader.read, kept here for comparison"""
+
+    def read(self, size=-1):
+        self.read_count += 1
+        line = self._iostream.readline()
+        if len(line) == 0:
+            return ''
+        bibcode = line[:19]
+        value = line[20:-1]
+        match = self._bibcode_match(bibcode)
+        if self.file_type in self.array_types:
+            value = [value]
+        while match:
+            line = self._iostream.readline()
+            value.append(line[20:-1])
+            match = self._bibcode_match(bibcode)
+        return self.process_line(bibcode, value)
+
+    def _bibcode_match(self, bibcode):
+        file_location = self._iostream.tell()
+        next_line = self._iostream.readline()
+        self._iostream.seek(file_location)
+        return bibcode == next_line[:19]
+
+
+def scale_file(filename, scale, tmp_dir):
+    """return name of a new file holding scale copies of filename"""
+    scaled = os.path.join(tmp_dir, os.path.basename(os.path.dirname(filename)) + '.links')
+    with open(filename, 'r') as f:
+        data = f.read()
+    with open(scaled, 'w') as f:
+        for i in xrange(scale):
+            f.write(data)
+    return scaled
+
+
+def time_reader(reader_class, file_type, filename, **kwargs):
+    """return (lines/sec, rows) for reading the entire file"""
+    lines = sum(1 for line in open(filename))
+    r = reader_class(file_type, filename, **kwargs)
+    rows = 0
+    start = time.time()
+    while r.read():
+        rows += 1
+    elapsed = time.time() - start
+    r.close()
+    return lines / max(elapsed, 1e-9), rows
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    config = load_config(PROJECT_HOME)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print '{:<12} {:>10} {:>14} {:>14} {:>8} {:>14} {:>8}'.format('file', 'lines', 'peek lines/s', 'lines/s',
+                                                                   'speedup', 'mmap lines/s', 'speedup')
+        for file_type in ('reference', 'citation', 'reader', 'author', 'reads'):
+            filename = scale_file(os.path.join(PROJECT_HOME, config['TEST_DATA_PATH'], 'data1',
+                                               config[file_type.upper()]), scale, tmp_dir)
+            lines = sum(1 for line in open(filename))
+            old_rate, old_rows = time_reader(PeekingFileReader, file_type, filename)
+            new_rate, new_rows = time_reader(reader.StandardFileReader, file_type, filename, backend='file')
+            mmap_rate, mmap_rows = time_reader(reader.StandardFileReader, file_type, filename, backend='mmap')
+            if not old_rows == new_rows == mmap_rows:
+                print 'row count mismatch for {}: {} {} {}'.format(file_type, old_rows, new_rows, mmap_rows)
+            print '{:<12} {:>10} {:>14.0f} {:>14.0f} {:>7.1f}x {:>14.0f} {:>7.1f}x'.format(
+                file_type, lines, old_rate, new_rate, new_rate / old_rate, mmap_rate, mmap_rate / old_rate)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import os, sys
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+import unittest
+import shutil
+import tempfile
+from collections import defaultdict
+from adsputils import load_config
+from adsdata import reader
+from adsdata.column_index import ColumnIndex
+
+class test_column_index(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {}
+        self.config.update(load_config())
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        """verify every bibcode in the file is found with its lines and row"""
+        for file_type in ('citation', 'author', 'relevance'):
+            filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config[file_type.upper()]
+            index_filename = os.path.join(self.tmp_dir, file_type + '.idx')
+            ColumnIndex.build(file_type, filename).save(index_filename)
+            index = ColumnIndex.load(filename, index_filename)
+
+            lines = defaultdict(list)
+            with open(filename) as f:
+                for line in f:
+                    lines[line[:19]].append(line[:-1])
+            r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
+            rows = list(iter(r.read, ''))
+            r.close()
+            self.assertEqual(len(lines), len(index))
+            for i, row in enumerate(rows):
+                bibcode = row[:19]
+                self.assertEqual(lines[bibcode], index.lookup(bibcode))
+                if i % 100 == 0 or i == len(rows) - 1:
+                    # creating a reader per row is slow, spot check
+                    self.assertEqual(row, index.row(bibcode))
+            self.assertEqual([], index.lookup('1000NotInFile......'))
+            self.assertEqual('', index.row('1000NotInFile......'))
+            self.assertFalse('1000NotInFile......' in index)
+
+    def test_stale_index(self):
+        """verify an index is rejected after its column file changes"""
+        source = self.config['TEST_DATA_PATH'] + 'data1/' + self.config['READS']
+        filename = os.path.join(self.tmp_dir, 'reads.links')
+        shutil.copy(source, filename)
+        ColumnIndex.build('reads', filename).save()
+        self.assertTrue(os.path.exists(filename + '.idx'))
+        ColumnIndex.load(filename)
+        with open(filename, 'a') as f:
+            f.write('9999zzzz.........Z\t1\t2\n')
+        self.assertRaises(ValueError, ColumnIndex.load, filename)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
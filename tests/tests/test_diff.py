@@ -0,0 +1,106 @@
+import os, sys
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+import unittest
+import shutil
+import tempfile
+from collections import OrderedDict
+from StringIO import StringIO
+from adsputils import load_config
+from adsdata import diff, reader
+
+class test_diff(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {}
+        self.config.update(load_config())
+
+    def file_groups(self, filename):
+        """dict of bibcode to the lines after the bibcode, read without the diff code"""
+        groups = OrderedDict()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    groups.setdefault(line[:19], []).append(line[20:-1])
+        return groups
+
+    def test_diff_column_file(self):
+        """verify the diff of the data1 and data2 column files against comparing them in memory"""
+        collation = self.config['TEST_DATA_COLLATION']
+        for file_type in ('reads', 'citation', 'relevance', 'author', 'refereed'):
+            baseline_filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config[file_type.upper()]
+            filename = self.config['TEST_DATA_PATH'] + 'data2/' + self.config[file_type.upper()]
+            baseline = self.file_groups(baseline_filename)
+            current = self.file_groups(filename)
+            expected = set()
+            for bibcode in set(baseline) | set(current):
+                if bibcode not in baseline:
+                    expected.add((diff.ADDED, bibcode))
+                elif bibcode not in current:
+                    expected.add((diff.REMOVED, bibcode))
+                elif baseline[bibcode] != current[bibcode]:
+                    expected.add((diff.CHANGED, bibcode))
+            actual = [(action, bibcode) for action, bibcode, values in
+                      diff.diff_column_file(file_type, baseline_filename, filename, collation)]
+            self.assertEqual(expected, set(actual), file_type)
+            self.assertEqual(len(expected), len(actual))
+            self.assertEqual([], list(diff.diff_column_file(file_type, filename, filename, collation)))
+
+    def test_write_column_file_delta(self):
+        """verify the delta file holds the current lines of added and changed bibcodes"""
+        baseline_filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config['READS']
+        filename = self.config['TEST_DATA_PATH'] + 'data2/' + self.config['READS']
+        collation = self.config['TEST_DATA_COLLATION']
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            lines_filename = os.path.join(tmp_dir, 'reads.delta')
+            bibcodes_file = StringIO()
+            with open(lines_filename, 'w') as lines_file:
+                counts = diff.write_column_file_delta('reads', baseline_filename, filename, lines_file, bibcodes_file, 3,
+                                                      collation)
+            bibcodes = [line.split('\t') for line in bibcodes_file.getvalue().splitlines()]
+            self.assertEqual(sum(counts.values()), len(bibcodes))
+            self.assertEqual(set(['3']), set(b[0] for b in bibcodes))
+            with open(filename) as f:
+                current = dict((line[:19], line) for line in f)
+            updated = [b[2] for b in bibcodes if b[1] != diff.REMOVED]
+            with open(lines_filename) as f:
+                self.assertEqual([current[bibcode] for bibcode in updated], f.readlines())
+            # the delta is read like any column file
+            r = reader.StandardFileReader('reads', lines_filename, collation=collation)
+            self.assertEqual(len(updated), len(list(iter(r.read, ''))))
+            r.close()
+
+            # without a baseline everything is added
+            with open(lines_filename, 'w') as lines_file:
+                counts = diff.write_column_file_delta('reads', os.path.join(tmp_dir, 'missing'), filename,
+                                                      lines_file, StringIO(), collation=collation)
+            self.assertEqual({diff.ADDED: len(current), diff.REMOVED: 0, diff.CHANGED: 0}, counts)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_unsorted_file(self):
+        """verify a file not sorted in the collation stops the diff rather than giving a wrong delta"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            baseline_filename = os.path.join(tmp_dir, 'baseline.links')
+            filename = os.path.join(tmp_dir, 'reads.links')
+            # the baseline is in byte order, the current file ignores case
+            with open(baseline_filename, 'w') as f:
+                f.write('1972JChPh..56.5899C\t1\n1972JaJAP..11..411M\t1\n')
+            with open(filename, 'w') as f:
+                f.write('1972JaJAP..11..411M\t2\n1972JChPh..56.5899C\t1\n')
+            for collation in ('C', 'nocase'):
+                self.assertRaises(ValueError, list, diff.diff_column_file('reads', baseline_filename, filename, collation))
+            # sorted the same way the files are merged
+            with open(baseline_filename, 'w') as f:
+                f.write('1972JaJAP..11..411M\t1\n1972JChPh..56.5899C\t1\n')
+            self.assertEqual([(diff.CHANGED, '1972JaJAP..11..411M')],
+                             [(action, bibcode) for action, bibcode, values in
+                              diff.diff_column_file('reads', baseline_filename, filename, 'nocase')])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
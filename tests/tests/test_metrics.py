@@ -8,6 +8,8 @@ import unittest
 from datetime import datetime
 from mock import Mock, patch
 from adsdata.metrics import Metrics
+from adsdata.citation_graph import CitationGraph
+from adsdata.metrics_batch import MetricsBatch
 from adsdata.models import NonBibTable
 
 class metrics_test(unittest.TestCase):
@@ -98,6 +100,316 @@ class metrics_test(unittest.TestCase):
             self.assertAlmostEqual(metrics_dict.an_refereed_citations, 2. / t2_age, 5, 'an refereed citations')
             self.assertAlmostEqual(metrics_dict.rn_citations, .6, 5, 'rn citations')
 
+    def test_with_citation_graph(self):
+        """citation graph gives the same metrics as the per bibcode query"""
+
+        # the row view, t2 is id 3 and cited by ids 1, 2 and 5, id 4 is not in the row view
+        nodes = [(1, "1994BoLMe..71..393V", True, 1, 0, 1),
+                 (2, "1994GPC.....9...53M", False, 1, 0, 2),
+                 (3, "1997BoLMe..85..475M", True, 3, 3, 5),
+                 (5, "1997BoLMe..85...81M", 't', 1, 0, 1)]
+        edges = [(3, [1, 2, 5, 2])]
+        conn = Mock()
+        conn.execution_options.return_value.execute.side_effect = [nodes, edges]
+        graph = CitationGraph.build(conn, 'nonbib')
+        self.assertEqual(6, len(graph))
+        self.assertEqual("1997BoLMe..85..475M", graph.bibcode(3))
+        self.assertEqual([], graph.citing(1))
+        self.assertEqual([], graph.citing(4))
+
+        m = Mock()
+        m.execute.return_value = (
+            [True, 1, "1994BoLMe..71..393V"],
+            [False, 1, "1994GPC.....9...53M"],
+            [True, 1, "1997BoLMe..85...81M"])
+        with patch('sqlalchemy.create_engine'):
+            met = Metrics()
+            expected = met.row_view_to_metrics(metrics_test.t2, m)
+            metrics_dict = met.row_view_to_metrics(metrics_test.t2, None, graph=graph)
+            for field in ('refereed_citations', 'refereed_citation_num', 'rn_citations', 'rn_citation_data',
+                          'rn_citations_hist', 'an_refereed_citations'):
+                self.assertEqual(getattr(expected, field), getattr(metrics_dict, field), field)
+
+    def test_batch_metrics(self):
+        """batch engine computes the same metrics as the row by row engine"""
+        nodes = [(1, "1994BoLMe..71..393V", True, 1, 0, 1),
+                 (2, "1994GPC.....9...53M", False, 7, 1, 2),
+                 (3, "1997BoLMe..85..475M", True, 3, 3, 5),
+                 (5, "1997BoLMe..85...81M", 't', 1, 0, 0),
+                 (11, "1998PPGeo..22..553A", False, 1, 0, 1)]
+        edges = [(2, [3]), (3, [1, 2, 5, 11])]
+        conn = Mock()
+        conn.execution_options.return_value.execute.side_effect = [nodes, edges]
+        graph = CitationGraph.build(conn, 'nonbib')
+        block = MetricsBatch(graph).compute(0, len(graph))
+
+        with patch('sqlalchemy.create_engine'):
+            met = Metrics()
+            for row in (metrics_test.t2, metrics_test.t1):
+                expected = met.row_view_to_metrics(row, None, graph=graph)
+                metrics_dict = block.metrics_dict(row.id, row.bibcode)
+                for field in ('refereed_citations', 'refereed_citation_num', 'citation_num', 'reference_num',
+                              'author_num', 'rn_citation_data', 'rn_citations', 'an_citations',
+                              'an_refereed_citations', 'rn_citations_hist'):
+                    self.assertEqual(getattr(expected, field), metrics_dict[field], field)
+
+            metrics_dict.update(id=11, bibcode=metrics_test.t1.bibcode, refereed=False, citations=[], reads=[1, 2],
+                                downloads=[0, 1])
+            self.assertEqual(len(Metrics.copy_columns), len(met.to_sql(metrics_dict).split('\t')))
+
+    def test_batch_metrics_block(self):
+        """batch engine floats are identical to the row engine for every paper of a block"""
+        years = [1990, 1991, 1993, 1994, 1997, 1998, 2001, 2003, 2007, 2011, 2015, 2019]
+        reference_counts = [3, 7, 11, 13, 6, 17, 9, 23, 29, 31, 19, 37]
+        # paper i is cited by the papers after it, skipping some so the blocks differ
+        citing = dict((i, [c for c in range(i + 1, len(years)) if (c * 7 + i) % 5]) for i in range(len(years)))
+        rows = []
+        for i, year in enumerate(years):
+            row = NonBibTable()
+            row.id = i
+            row.bibcode = '{}ApJ...{:03d}..{:03d}A'.format(year, i, i * 3)
+            row.refereed = i % 3 != 0
+            row.authors = ['Author, {}'.format(a) for a in range(i % 4 + 1)]
+            row.reads = []
+            row.downloads = []
+            row.citations = ['citation'] * len(citing[i])
+            row.reference = ['reference'] * reference_counts[i]
+            rows.append(row)
+        nodes = [(row.id, row.bibcode, row.refereed, len(row.reference), len(row.citations), len(row.authors))
+                 for row in rows]
+        edges = [(i, citing[i]) for i in range(len(years)) if citing[i]]
+        conn = Mock()
+        conn.execution_options.return_value.execute.side_effect = [nodes, edges]
+        graph = CitationGraph.build(conn, 'nonbib')
+
+        with patch('sqlalchemy.create_engine'):
+            met = Metrics()
+            for start, end in ((0, len(rows)), (0, 5), (5, len(rows))):
+                block = MetricsBatch(graph).compute(start, end)
+                for row in rows[start:end]:
+                    expected = met.row_view_to_metrics(row, None, graph=graph)
+                    metrics_dict = block.metrics_dict(row.id, row.bibcode)
+                    for field in ('rn_citations', 'rn_citations_hist', 'rn_citation_data', 'an_citations',
+                                  'an_refereed_citations', 'refereed_citation_num', 'refereed_citations'):
+                        self.assertEqual(getattr(expected, field), metrics_dict[field], (row.id, field))
+
+    def test_copy_metrics_range(self):
+        """batch and row engines copy the same rows for a range of ids"""
+        nodes = [(1, "1994BoLMe..71..393V", True, 1, 0, 1),
+                 (3, "1997BoLMe..85..475M", True, 3, 3, 5),
+                 (11, "1998PPGeo..22..553A", False, 1, 0, 1)]
+        edges = [(3, [1, 11])]
+        conn = Mock()
+        conn.execution_options.return_value.execute.side_effect = [nodes, edges]
+        graph = CitationGraph.build(conn, 'nonbib')
+
+        copied = {}
+        for engine, batch in (('row', None), ('batch', MetricsBatch(graph))):
+            nonbib_conn = Mock()
+            nonbib_conn.execution_options.return_value.execute.return_value = [metrics_test.t2, metrics_test.t1]
+            cur = Mock()
+            lines = []
+            cur.copy_from.side_effect = lambda f, table, columns: lines.extend(f.read().splitlines())
+            with patch('sqlalchemy.create_engine'):
+                met = Metrics('metricstest')
+                met.config['METRICS_BATCH_SIZE'] = 1
+                self.assertEqual(2, met.copy_metrics_range(cur, nonbib_conn, 'nonbib', graph, 3, 12, batch))
+            self.assertEqual(2, cur.copy_from.call_count)
+            self.assertEqual('metricstest.metrics', cur.copy_from.call_args[0][1])
+            self.assertEqual((3, 12), nonbib_conn.execution_options.return_value.execute.call_args[0][1:])
+            # modtime differs
+            copied[engine] = [line.rsplit('\t', 1)[0].split('\t') for line in lines]
+        self.assertEqual(['3', '1997BoLMe..85..475M'], copied['row'][0][:2])
+        for row_line, batch_line in zip(copied['row'], copied['batch']):
+            self.assertEqual(row_line[:3], batch_line[:3])
+            self.assertAlmostEqual(float(row_line[3]), float(batch_line[3]), 5)
+            self.assertEqual(row_line[6:], batch_line[6:])
+
+    def test_flush_after_copy(self):
+        """after the batch engine copies rows with their row view ids, flush does not reuse ids"""
+        db_conn = Mock()
+        raw_conn = db_conn.connection
+        cur = raw_conn.cursor.return_value
+        calls = []
+        cur.execute.side_effect = lambda sql: calls.append(sql)
+        raw_conn.commit.side_effect = lambda: calls.append('commit')
+        cur.copy_from.side_effect = lambda f, table, columns: calls.append((table, columns))
+        with patch('sqlalchemy.create_engine'), patch('adsdata.metrics.CitationGraph.build'), \
+                patch('adsdata.metrics_batch.MetricsBatch'):
+            met = Metrics('metricstest')
+            with patch.object(met, 'copy_metrics_range', return_value=2) as copy_metrics_range:
+                met.update_metrics_all_batch(db_conn, Mock(), 'nonbib')
+            self.assertEqual(cur, copy_metrics_range.call_args[0][0])
+            self.assertEqual(["select setval(pg_get_serial_sequence('metricstest.metrics', 'id'), max(id)) "
+                              "from metricstest.metrics", 'commit'], calls)
+
+            del calls[:]
+            met.upserts.append(met.row_view_to_metrics(metrics_test.t1, None, graph=CitationGraph('', [], [], [0], [])))
+            met.flush(db_conn)
+        # the id column is left to the sequence
+        self.assertEqual(('metrics_staging', Metrics.copy_columns[1:]), calls[1])
+        self.assertTrue(calls[2].startswith('insert into metricstest.metrics (bibcode, refereed,'), calls[2])
+
+    def test_update_metrics_parallel(self):
+        """workers get the graph from the pool initializer, batch only with the batch engine"""
+        conn = Mock()
+        conn.execution_options.return_value.execute.side_effect = [[(4, "1997BoLMe..85..475M", True, 3, 0, 5)], []]
+        graph = CitationGraph.build(conn, 'nonbib')
+
+        class Pool(object):
+            """runs the initializer and the ranges in this process"""
+            def __init__(self, workers, initializer, initargs):
+                initializer(*initargs)
+            def imap_unordered(self, func, args):
+                return [func(a) for a in args]
+            def close(self):
+                pass
+            def join(self):
+                pass
+
+        def update_metrics_range(args):
+            from adsdata import metrics
+            ranges.append((args[4], args[5], metrics._worker['graph'], metrics._worker['batch']))
+            return args[4], args[5], args[5] - args[4]
+
+        for engine in ('row', 'batch'):
+            ranges = []
+            db_engine = Mock()
+            # create the checkpoint table, no checkpoints, an empty metrics table, advance the sequence
+            db_engine.execute.side_effect = [None, [], Mock(**{'scalar.return_value': False}), None]
+            with patch('sqlalchemy.create_engine'), patch('adsdata.metrics.CitationGraph.build', return_value=graph), \
+                    patch('adsdata.metrics.multiprocessing.Pool', Pool), \
+                    patch('adsdata.metrics.update_metrics_range', update_metrics_range):
+                met = Metrics('metricstest')
+                met.config['METRICS_ENGINE'] = engine
+                met.update_metrics_parallel(db_engine, Mock(), 'nonbib', workers=2, range_size=2)
+            self.assertEqual([(0, 2), (2, 4), (4, 5)], [r[:2] for r in ranges])
+            self.assertTrue(all(r[2] is graph for r in ranges))
+            if engine == 'row':
+                self.assertTrue(all(r[3] is None for r in ranges))
+            else:
+                self.assertTrue(all(isinstance(r[3], MetricsBatch) for r in ranges))
+            # the workers copied rows with ids, the sequence is moved past them last
+            self.assertEqual("select setval(pg_get_serial_sequence('metricstest.metrics', 'id'), max(id)) "
+                             "from metricstest.metrics", db_engine.execute.call_args[0][0])
+
+    def test_flush(self):
+        """flush copies buffered records to a temporary table and merges them on bibcode"""
+        db_conn = Mock()
+        cur = db_conn.connection.cursor.return_value
+        lines = []
+        cur.copy_from.side_effect = lambda f, table, columns: lines.extend(f.read().splitlines())
+        with patch('sqlalchemy.create_engine'):
+            met = Metrics('metricstest')
+            met.flush(db_conn)
+            self.assertFalse(cur.execute.called)
+            for record, citation_num in ((metrics_test.t2, 3), (metrics_test.t1, 0), (metrics_test.t2, 4)):
+                m = met.row_view_to_metrics(record, None, graph=CitationGraph('', [], [], [0], []))
+                m.citation_num = citation_num
+                met.upserts.append(m)
+            met.flush(db_conn)
+        self.assertEqual([], met.upserts)
+        self.assertEqual(('metrics_staging',), cur.copy_from.call_args[0][1:])
+        self.assertEqual(Metrics.copy_columns[1:], cur.copy_from.call_args[1]['columns'])
+        # the second record for a bibcode replaces the first
+        self.assertEqual([metrics_test.t1.bibcode, metrics_test.t2.bibcode], [line.split('\t')[0] for line in lines])
+        self.assertEqual('4', lines[1].split('\t')[9])
+        merge = cur.execute.call_args[0][0]
+        self.assertTrue(merge.startswith('insert into metricstest.metrics'))
+        self.assertTrue('on conflict (bibcode) do update set refereed = excluded.refereed' in merge)
+        self.assertTrue(db_conn.connection.commit.called)
+
+    def test_update_metrics_page(self):
+        """a page of changed bibcodes is read with two queries and written with one flush"""
+        nonbib_conn = Mock()
+        # citing papers of t2 as (bibcode, citing bibcode, refereed, len(reference)), one is listed twice
+        nonbib_conn.execute.return_value = [
+            ("1997BoLMe..85..475M", "1994BoLMe..71..393V", True, 1),
+            ("1997BoLMe..85..475M", "1994GPC.....9...53M", False, 1),
+            ("1997BoLMe..85..475M", "1994GPC.....9...53M", False, 1),
+            ("1997BoLMe..85..475M", "1997BoLMe..85...81M", 't', 1)]
+        with patch('sqlalchemy.create_engine'), \
+                patch('adsdata.nonbib.NonBib.get_by_bibcodes', return_value=[metrics_test.t1, metrics_test.t2]) as rows:
+            met = Metrics('metricstest')
+            with patch.object(met, 'flush') as flush:
+                bibcodes = [metrics_test.t1.bibcode, metrics_test.t2.bibcode, "2000ApJ...000..000X"]
+                self.assertEqual(2, met.update_metrics_page(Mock(), nonbib_conn, bibcodes, 'nonbib'))
+        self.assertEqual(1, rows.call_count)
+        self.assertEqual(1, nonbib_conn.execute.call_count)
+        self.assertEqual({'bibcodes': bibcodes}, nonbib_conn.execute.call_args[1])
+        self.assertEqual(1, flush.call_count)
+        t1_metrics, t2_metrics = met.upserts
+        self.assertEqual(0, t1_metrics.citation_num)
+        self.assertEqual([], t1_metrics.rn_citation_data)
+        self.assertEqual(["1994BoLMe..71..393V", "1997BoLMe..85...81M"], t2_metrics.refereed_citations)
+        self.assertEqual(3, len(t2_metrics.rn_citation_data))
+        self.assertAlmostEqual(.6, t2_metrics.rn_citations, 5)
+
+    def test_update_metrics_all_sql(self):
+        """the sql engine runs its statements in one transaction with the schemas and year filled in"""
+        db_conn = Mock()
+        with patch('sqlalchemy.create_engine'):
+            met = Metrics('metricstest')
+            met.config['METRICS_SQL_WORKERS'] = 2
+            met.update_metrics_all_sql(db_conn, 'nonbibtest', year=2018)
+        statements = [c[0][0] for c in db_conn.execute.call_args_list]
+        self.assertEqual('set local max_parallel_workers_per_gather = 2', statements[0])
+        self.assertEqual(len(Metrics.metrics_sql) + 4, len(statements))
+        for statement in statements[2:-3]:
+            self.assertFalse('{' in statement.replace("'{}'", ''), statement)
+        insert = statements[-4]
+        self.assertTrue(insert.startswith('insert into metricstest.metrics'))
+        self.assertTrue('from nonbibtest.rowviewm as r' in insert)
+        self.assertTrue('greatest(1, 2018 - substr(r.bibcode, 1, 4)::int + 1)' in insert)
+        self.assertTrue(statements[-3].startswith('drop table metricstest.metrics_sql_edges'))
+        # the inserted rows have the row view ids, the sequence is moved past them
+        self.assertEqual("select setval(pg_get_serial_sequence('metricstest.metrics', 'id'), max(id)) "
+                         "from metricstest.metrics", statements[-2])
+        self.assertTrue(db_conn.begin.return_value.commit.called)
+
+        # a failed statement rolls back, dropping the work tables
+        db_conn = Mock()
+        db_conn.execute.side_effect = [None, None, None, ValueError('failed')]
+        with patch('sqlalchemy.create_engine'):
+            met = Metrics('metricstest')
+            self.assertRaises(ValueError, met.update_metrics_all_sql, db_conn, 'nonbibtest', year=2018)
+        self.assertTrue(db_conn.begin.return_value.rollback.called)
+        self.assertFalse(db_conn.begin.return_value.commit.called)
+
+    def test_compare_engines(self):
+        """compare_engines reports the fields where the metrics table differs from row_view_to_metrics"""
+        graph = CitationGraph('', [], [], [0], [])
+        nonbib_conn = Mock()
+        nonbib_conn.execute.return_value = []
+        with patch('sqlalchemy.create_engine'), \
+                patch('adsdata.nonbib.NonBib.get_by_bibcodes', return_value=[metrics_test.t1]):
+            met = Metrics('metricstest')
+            stored = met.row_view_to_metrics(metrics_test.t1, None, graph=graph)
+            with patch.object(met, 'get_by_bibcode', return_value=stored):
+                self.assertEqual({}, met.compare_engines(Mock(), nonbib_conn, [metrics_test.t1.bibcode]))
+                stored.author_num = 4
+                stored.refereed = True
+                self.assertEqual({metrics_test.t1.bibcode: ['refereed', 'author_num']},
+                                 met.compare_engines(Mock(), nonbib_conn, [metrics_test.t1.bibcode]))
+            with patch.object(met, 'get_by_bibcode', return_value=None):
+                self.assertEqual(['BibcodeNotFoundFirstDatabase:' + metrics_test.t1.bibcode],
+                                 met.compare_engines(Mock(), nonbib_conn, [metrics_test.t1.bibcode])[metrics_test.t1.bibcode])
+
+    def test_compare_engines_citation_order(self):
+        """the running totals in rn_citations_hist depend on citation order, compare_engines reads them in order"""
+        citing = [("1997BoLMe..85...81M", True, 1), ("1994BoLMe..71..393V", True, 1), ("1994GPC.....9...53M", False, 1)]
+        nonbib_conn = Mock()
+        nonbib_conn.execute.return_value = [(metrics_test.t2.bibcode,) + c for c in citing]
+        with patch('sqlalchemy.create_engine'), \
+                patch('adsdata.nonbib.NonBib.get_by_bibcodes', return_value=[metrics_test.t2]):
+            met = Metrics('metricstest')
+            stored = met.row_view_to_metrics(metrics_test.t2, None, citing=citing)
+            reordered = met.row_view_to_metrics(metrics_test.t2, None, citing=citing[::-1])
+            self.assertNotEqual(stored.rn_citations_hist, reordered.rn_citations_hist)
+            with patch.object(met, 'get_by_bibcode', return_value=stored):
+                self.assertEqual({}, met.compare_engines(Mock(), nonbib_conn, [metrics_test.t2.bibcode]))
+        self.assertTrue('order by r.bibcode, u.n' in str(nonbib_conn.execute.call_args[0][0]))
+
     def test_validate_lists(self):
         """test validation code for lists
 
@@ -0,0 +1,286 @@
+import sys
+import os
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.append(PROJECT_HOME)
+
+import re
+import unittest
+from mock import Mock, patch
+from sqlalchemy import MetaData
+from adsdata.nonbib import NonBib, row_hash_columns, with_row_hash
+
+
+class nonbib_test(unittest.TestCase):
+
+    """tests for the sql that builds the row view and finds changed rows"""
+
+    def session(self, mock_sessionmaker):
+        """return the session NonBib will get from sessionmaker"""
+        sess = Mock()
+        mock_sessionmaker.return_value.return_value = sess
+        return sess
+
+    def executed(self, sess):
+        """return the sql strings passed to sess.execute, in order"""
+        return [str(c[0][0]) for c in sess.execute.call_args_list]
+
+    def squash(self, sql):
+        """collapse the whitespace left by the backslash continued sql strings"""
+        return ' '.join(sql.split())
+
+    def test_row_hash(self):
+        # every content column is hashed, so a change to any of them changes row_hash
+        content = re.findall(r' as (\w+)', NonBib.row_view_select_sql)
+        self.assertEqual(sorted(content), sorted(row_hash_columns))
+        sql = with_row_hash('select bibcode, id, authors from nonbib.canonical')
+        self.assertTrue(sql.startswith('select joined.*, md5(row(joined.authors, joined.refereed, '))
+        self.assertTrue(sql.endswith(')::text)::uuid as row_hash from (select bibcode, id, authors from nonbib.canonical) as joined'))
+        # id is renumbered when bibcodes are added or removed, it must not make an unchanged row look changed
+        self.assertFalse('joined.id' in sql)
+        self.assertFalse('joined.bibcode' in sql)
+
+    def test_create_changed_hash_sql(self):
+        sql = self.squash(NonBib.create_changed_hash_sql.format('nonbibnew', 'nonbib'))
+        # a bibcode in both schemas is flagged only when its hash differs, an unchanged row has the same hash
+        self.assertEqual('create table nonbibnew.ChangedRowsM as select nonbibnew.RowViewM.bibcode, nonbibnew.RowViewM.id '
+                         'from nonbibnew.RowViewM join nonbib.RowViewM on nonbibnew.RowViewM.bibcode=nonbib.RowViewM.bibcode '
+                         'where nonbibnew.RowViewM.row_hash!=nonbib.RowViewM.row_hash;', sql)
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_create_delta_rows(self, mock_sessionmaker):
+        sess = self.session(mock_sessionmaker)
+        nonbib = NonBib('nonbibnew')
+        with patch.object(nonbib, 'has_column', return_value=True):
+            nonbib.create_delta_rows('conn', 'nonbib')
+        self.assertEqual(NonBib.create_changed_hash_sql.format('nonbibnew', 'nonbib'), self.executed(sess)[0])
+
+        # a baseline row view built before row_hash is compared column by column
+        sess = self.session(mock_sessionmaker)
+        with patch.object(nonbib, 'has_column', side_effect=lambda conn, schema, name, column: schema == 'nonbibnew'):
+            nonbib.create_delta_rows('conn', 'nonbib')
+        self.assertEqual(NonBib.create_changed_sql.format('nonbibnew', 'nonbib'), self.executed(sess)[0])
+
+    def partition_bounds(self, partitions):
+        """return what get_partition_bounds gives for the hash partitions named partitions"""
+        return [(p, 'FOR VALUES WITH (modulus {}, remainder {})'.format(len(partitions), i)) for i, p in enumerate(partitions)]
+
+    def update_joined_rows(self, mock_sessionmaker, kind='r', partitions=(), copy_baseline=False):
+        """run update_joined_rows against a baseline row view table, return the sql it executed"""
+        sess = self.session(mock_sessionmaker)
+        nonbib = NonBib('nonbibnew')
+        with patch.object(nonbib, 'get_relation_kind', return_value=kind), \
+                patch.object(nonbib, 'has_column', return_value=True), \
+                patch.object(nonbib, 'get_partition_names', return_value=list(partitions)), \
+                patch.object(nonbib, 'get_partition_bounds', return_value=self.partition_bounds(partitions)), \
+                patch.object(nonbib, 'create_joined_rows') as create_joined_rows:
+            nonbib.update_joined_rows('conn', 'nonbib', copy_baseline=copy_baseline)
+        return self.executed(sess), create_joined_rows
+
+    def test_changed_bibcodes_sql(self):
+        sql = NonBib('nonbibnew').changed_bibcodes_sql().format('nonbibnew', 'nonbib')
+        self.assertTrue(sql.startswith('create table nonbibnew.changedbibcodes as ('))
+        # added bibcodes are in the new canonical only, removed bibcodes in the baseline's only
+        self.assertTrue('(select bibcode from nonbibnew.canonical except select bibcode from nonbib.canonical)' in sql)
+        self.assertTrue('(select bibcode from nonbib.canonical except select bibcode from nonbibnew.canonical)' in sql)
+        # a changed bibcode has a row in some column table that differs, either direction catches
+        # a row that was added, removed or updated
+        for t in NonBib.row_view_tables:
+            self.assertTrue('select bibcode from (select * from nonbibnew.{0} except select * from nonbib.{0}) as {0}_diff'
+                            .format(t) in sql)
+            self.assertTrue('select bibcode from (select * from nonbib.{0} except select * from nonbibnew.{0}) as {0}_diff'
+                            .format(t) in sql)
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_update_joined_rows(self, mock_sessionmaker):
+        executed, create_joined_rows = self.update_joined_rows(mock_sessionmaker)
+        self.assertFalse(create_joined_rows.called)
+        self.assertEqual([NonBib('nonbibnew').changed_bibcodes_sql().format('nonbibnew', 'nonbib'),
+                          'alter table nonbibnew.changedbibcodes add primary key (bibcode)',
+                          'select count(*) from nonbibnew.changedbibcodes',
+                          'alter table nonbib.rowviewm set schema nonbibnew',
+                          NonBib.save_baseline_rows_sql.format('nonbibnew', 'nonbib'),
+                          'alter table nonbib.rowviewm add primary key (bibcode)',
+                          NonBib.delete_removed_rows_sql.format('nonbibnew'),
+                          NonBib.upsert_changed_rows_sql.format('nonbibnew'),
+                          NonBib.update_ids_sql.format('nonbibnew'),
+                          'analyze nonbibnew.rowviewm'], executed)
+
+        # removed bibcodes: changed and no longer in canonical
+        removed = self.squash(NonBib.delete_removed_rows_sql.format('nonbibnew'))
+        self.assertEqual('delete from nonbibnew.rowviewm using nonbibnew.changedbibcodes '
+                         'where nonbibnew.rowviewm.bibcode = nonbibnew.changedbibcodes.bibcode '
+                         'and not exists (select 1 from nonbibnew.canonical '
+                         'where nonbibnew.canonical.bibcode = nonbibnew.changedbibcodes.bibcode);', removed)
+        # added and changed bibcodes: rejoined from canonical, inserted or replacing the carried forward row
+        upsert = self.squash(NonBib.upsert_changed_rows_sql.format('nonbibnew'))
+        self.assertTrue(upsert.startswith('insert into nonbibnew.rowviewm select joined.*, md5(row('))
+        self.assertTrue('from nonbibnew.changedbibcodes natural join nonbibnew.Canonical natural left join' in upsert)
+        self.assertTrue(' on conflict (bibcode) do update set id = excluded.id, authors = excluded.authors, ' in upsert)
+        self.assertTrue(upsert.endswith(', reads = excluded.reads, row_hash = excluded.row_hash;'))
+        # bibcodes added or removed before a row shift its id
+        self.assertEqual('update nonbibnew.rowviewm set id = nonbibnew.canonical.id from nonbibnew.canonical '
+                         'where nonbibnew.rowviewm.bibcode = nonbibnew.canonical.bibcode '
+                         'and nonbibnew.rowviewm.id != nonbibnew.canonical.id;',
+                         self.squash(NonBib.update_ids_sql.format('nonbibnew')))
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_update_joined_rows_partitioned(self, mock_sessionmaker):
+        executed, create_joined_rows = self.update_joined_rows(mock_sessionmaker, 'p', ['rowviewm_p0', 'rowviewm_p1'])
+        self.assertFalse(create_joined_rows.called)
+        self.assertEqual(['alter table nonbib.rowviewm_p0 set schema nonbibnew',
+                          'alter table nonbib.rowviewm_p1 set schema nonbibnew',
+                          'alter table nonbib.rowviewm set schema nonbibnew'], executed[3:6])
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_update_joined_rows_copy(self, mock_sessionmaker):
+        executed, create_joined_rows = self.update_joined_rows(mock_sessionmaker, copy_baseline=True)
+        self.assertFalse(create_joined_rows.called)
+        # the baseline is still being read, it keeps its row view
+        self.assertEqual(['create table nonbibnew.rowviewm as select * from nonbib.rowviewm',
+                          'alter table nonbibnew.rowviewm add primary key (bibcode)',
+                          'create index on nonbibnew.rowviewm (id)',
+                          NonBib.delete_removed_rows_sql.format('nonbibnew')], executed[3:7])
+        self.assertFalse([sql for sql in executed if 'set schema' in sql])
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_update_joined_rows_rebuild(self, mock_sessionmaker):
+        # a materialized view can not be carried forward
+        executed, create_joined_rows = self.update_joined_rows(mock_sessionmaker, 'm')
+        self.assertEqual([], executed)
+        create_joined_rows.assert_called_once_with('conn', as_table=True, partitions=0)
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_update_joined_rows_copy_partitioned(self, mock_sessionmaker):
+        # a partitioned row view is copied partition by partition, not rebuilt
+        executed, create_joined_rows = self.update_joined_rows(mock_sessionmaker, 'p', ['rowviewm_p0', 'rowviewm_p1'],
+                                                               copy_baseline=True)
+        self.assertFalse(create_joined_rows.called)
+        self.assertEqual(['create table nonbibnew.rowviewm (like nonbib.rowviewm) partition by hash (bibcode)',
+                          'create table nonbibnew.rowviewm_p0 partition of nonbibnew.rowviewm '
+                          'FOR VALUES WITH (modulus 2, remainder 0)',
+                          'insert into nonbibnew.rowviewm_p0 select * from nonbib.rowviewm_p0',
+                          'create table nonbibnew.rowviewm_p1 partition of nonbibnew.rowviewm '
+                          'FOR VALUES WITH (modulus 2, remainder 1)',
+                          'insert into nonbibnew.rowviewm_p1 select * from nonbib.rowviewm_p1',
+                          'create unique index on nonbibnew.rowviewm (bibcode)',
+                          'create index on nonbibnew.rowviewm (id)',
+                          NonBib.delete_removed_rows_sql.format('nonbibnew'),
+                          NonBib.upsert_changed_rows_sql.format('nonbibnew')], executed[3:12])
+        self.assertFalse([sql for sql in executed if 'set schema' in sql])
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_update_changed_rows(self, mock_sessionmaker):
+        sess = self.session(mock_sessionmaker)
+        NonBib('nonbib_next').update_changed_rows('conn', 'nonbib')
+        # the baseline is the live schema, it is compared with and never changed
+        self.assertEqual(['drop table if exists nonbib_next.changedbibcodes; drop table if exists nonbib_next.changedrowsm',
+                          NonBib.file_delta_bibcodes_sql.format('nonbib_next'),
+                          'alter table nonbib_next.changedbibcodes add primary key (bibcode)',
+                          NonBib.delete_removed_rows_sql.format('nonbib_next'),
+                          NonBib.upsert_changed_rows_sql.format('nonbib_next'),
+                          NonBib.update_ids_sql.format('nonbib_next'),
+                          NonBib.create_changed_from_previous_sql.format('nonbib_next', 'nonbib'),
+                          NonBib.include_file_delta_datalinks_sql.format('nonbib_next'),
+                          'analyze nonbib_next.rowviewm'], self.executed(sess))
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_copy_column_tables(self, mock_sessionmaker):
+        sess = self.session(mock_sessionmaker)
+        nonbib = NonBib('nonbib_next')
+        # a live datalinks table loaded before the digest was added
+        with patch.object(nonbib, 'has_column', side_effect=lambda conn, schema, name, column: column != 'digest'):
+            nonbib.copy_column_tables('conn', 'nonbib')
+        executed = self.executed(sess)
+        self.assertTrue('insert into nonbib_next.canonical (bibcode, id) select bibcode, id from nonbib.canonical' in executed)
+        datalinks = [sql for sql in executed if sql.startswith('insert into nonbib_next.datalinks ')][0]
+        self.assertFalse('digest' in datalinks)
+        self.assertTrue('analyze nonbib_next.reference' in executed)
+
+    @patch('adsdata.nonbib.create_engine')
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_fill_partition(self, mock_sessionmaker, mock_create_engine):
+        sess = self.session(mock_sessionmaker)
+        nonbib = NonBib('nonbibnew')
+        nonbib.fill_partition(('postgresql://localhost/data', 4, 2))
+        insert, unique_index, id_index = [self.squash(sql) for sql in self.executed(sess)]
+        self.assertTrue(insert.startswith('insert into nonbibnew.rowviewm_p2 select joined.*, md5(row('))
+        # the partition's share of canonical drives the join, the rest of canonical is never joined
+        self.assertTrue("from (select * from nonbibnew.Canonical where "
+                        "satisfies_hash_partition('nonbibnew.rowviewm'::regclass, 4, 2, bibcode)) as Canonical "
+                        "natural left join nonbibnew.Author natural left join nonbibnew.Refereed" in insert)
+        self.assertEqual(1, insert.count('satisfies_hash_partition'))
+        self.assertTrue(insert.endswith('natural left join nonbibnew.Reference) as joined;'))
+        self.assertEqual('create unique index on nonbibnew.rowviewm_p2 (bibcode)', unique_index)
+        self.assertEqual('create index on nonbibnew.rowviewm_p2 (id)', id_index)
+        sess.commit.assert_called_once_with()
+        mock_create_engine.return_value.dispose.assert_called_once_with()
+
+        # the full row view still joins all of canonical
+        self.assertEqual(self.squash(' nonbibnew.Canonical' + NonBib.row_view_joins_sql.format('nonbibnew')),
+                         self.squash(NonBib.row_view_from_sql.format('nonbibnew')))
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_resolver_digest(self, mock_sessionmaker):
+        sess = self.session(mock_sessionmaker)
+        nonbib = NonBib('nonbibnew')
+        with patch.object(nonbib, 'has_column', return_value=True):
+            nonbib.create_delta_rows('conn', 'nonbib')
+        sql = self.squash(self.executed(sess)[2])
+        self.assertEqual(self.squash(NonBib.include_update_resolver_bibcodes_sql.format('nonbibnew', 'nonbib')), sql)
+        # rows with digests match on the digest, a baseline loaded before digest was filled in
+        # has null digests and falls back to the columns rather than flagging every row
+        self.assertTrue('and (baseline.digest = current.digest or ((baseline.digest is null or current.digest is null) '
+                        'and baseline.url is not distinct from current.url '
+                        'and baseline.title is not distinct from current.title '
+                        'and baseline.item_count is not distinct from current.item_count)))' in sql)
+
+        # a baseline without the digest column uses the column comparison
+        sess = self.session(mock_sessionmaker)
+        with patch.object(nonbib, 'has_column', side_effect=lambda conn, schema, name, column: column != 'digest'):
+            nonbib.create_delta_rows('conn', 'nonbib')
+        self.assertEqual(NonBib.include_update_resolver_columns_sql.format('nonbibnew', 'nonbib'), self.executed(sess)[2])
+
+    @patch('adsdata.nonbib.sessionmaker')
+    def test_log_delta_reasons(self, mock_sessionmaker):
+        sess = self.session(mock_sessionmaker)
+        total = Mock()
+        total.scalar.return_value = 3
+        counts = Mock()
+        counts.first.return_value = range(14)
+        sess.execute.side_effect = [total, counts]
+        nonbib = NonBib('nonbibnew')
+        with patch.object(nonbib, 'save_delta_stats') as save_delta_stats:
+            nonbib.log_delta_reasons('conn', 'nonbib', 'nonbibstats')
+        sql = self.executed(sess)[1]
+        # a column going from null to a value is a change
+        self.assertTrue('count(*) filter (where current.authors is distinct from baseline.authors)' in sql)
+        self.assertFalse('!=' in sql)
+        self.assertTrue('from (select distinct bibcode from nonbibnew.changedrowsm) as changed' in sql)
+        self.assertTrue('join nonbib.rowviewm as baseline on baseline.bibcode = changed.bibcode' in sql)
+        rows = save_delta_stats.call_args[0][3]
+        self.assertEqual(('total', 3), rows[0])
+        self.assertEqual(('authors', 0), rows[1])
+        self.assertEqual(('ned_objects', 13), rows[-1])
+
+    def test_save_delta_stats(self):
+        nonbib = NonBib('nonbibnew')
+        conn = Mock()
+        with patch.object(MetaData, 'create_all') as create_all:
+            nonbib.save_delta_stats(conn, 'nonbib', 'nonbibstats', [('total', 3), ('authors', 2), ('reads', 0)])
+        self.assertEqual('create schema if not exists nonbibstats', conn.execute.call_args_list[0][0][0])
+        create_all.assert_called_once_with(conn, checkfirst=True)
+        insert, rows = conn.execute.call_args_list[1][0]
+        self.assertEqual('nonbibstats.delta_stats', insert.table.fullname)
+        self.assertEqual([('total', 3), ('authors', 2), ('reads', 0)],
+                         [(r['column_name'], r['changed_count']) for r in rows])
+        for r in rows:
+            self.assertEqual('nonbibnew', r['row_view_schema'])
+            self.assertEqual('nonbib', r['baseline_schema'])
+            # every row of a run shares the run's timestamp, it is part of the primary key
+            self.assertEqual(rows[0]['run'], r['run'])
+        self.assertEqual(set(['run', 'column_name']),
+                         set([c.name for c in nonbib.get_delta_stats_table('nonbibstats').primary_key]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,12 @@ import os, sys
 PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
 sys.path.append(PROJECT_HOME)
 import unittest
+import struct
+import gzip
+import shutil
+import tempfile
 from adsputils import load_config, setup_logging
-from adsdata import reader
+from adsdata import reader, pgcopy, compressed
 
 class test_rowview_ingest(unittest.TestCase):
 
@@ -150,7 +154,7 @@ class test_rowview_ingest(unittest.TestCase):
         """
         filename = self.config['TEST_DATA_PATH'] + data_dir + self.config[file_type.upper()]
         lines_in_file = sum(1 for line in open(filename))
-        r = reader.StandardFileReader(file_type, filename)
+        r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
         bibcode_count = 0
         line = r.read()
         spot_checks_found = []
@@ -183,6 +187,150 @@ class test_rowview_ingest(unittest.TestCase):
             self.assertEqual(lines_in_file, bibcode_count, 
                              '{} standard reader returned wrong number of lines'.format(file_type))    
 
+    def test_grouped_lines(self):
+        """verify consecutive lines for a bibcode are returned as one row"""
+        for file_type in ('citation', 'reference', 'reader'):
+            filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config[file_type.upper()]
+            with open(filename) as f:
+                lines = [line[:19] for line in f]
+            bibcodes = [b for i, b in enumerate(lines) if i == 0 or lines[i - 1] != b]
+            r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
+            rows = []
+            line = r.read()
+            while line:
+                rows.append(line[:19])
+                line = r.read()
+            r.close()
+            self.assertEqual(bibcodes, rows, '{} reader did not group lines by bibcode'.format(file_type))
+
+    def test_mmap_backend(self):
+        """verify the mmap backend returns the same rows as the file backend"""
+        for data_dir, file_type in (('data1/', 'citation'), ('data1/', 'author'), ('data1/', 'relevance'),
+                                    ('dataInvalid/', 'download')):
+            filename = self.config['TEST_DATA_PATH'] + data_dir + self.config[file_type.upper()]
+            rows = {}
+            for backend in ('file', 'mmap'):
+                r = reader.StandardFileReader(file_type, filename, backend=backend, quarantine=False,
+                                              collation=self.config['TEST_DATA_COLLATION'])
+                rows[backend] = list(iter(r.read, ''))
+                r.close()
+            self.assertTrue(len(rows['file']) > 0)
+            self.assertEqual(rows['file'], rows['mmap'], 'mmap backend differs for {}'.format(file_type))
+
+    def test_read_size(self):
+        """verify read(size) packs whole rows into each buffer"""
+        for file_type, size in (('canonical', 100), ('author', 100), ('reference', 4096), ('reference', 1)):
+            filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config[file_type.upper()]
+            if file_type == 'canonical':
+                r = reader.BibcodeFileReader(filename)
+            else:
+                r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
+            rows = list(iter(r.read, ''))
+            r.close()
+            if file_type == 'canonical':
+                r = reader.BibcodeFileReader(filename)
+            else:
+                r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
+            buffers = list(iter(lambda: r.read(size), ''))
+            r.close()
+            self.assertTrue(len(buffers) < len(rows) or size == 1)
+            for b in buffers:
+                self.assertEqual('\n', b[-1], 'buffer should end with a complete row')
+                self.assertTrue(len(b) <= size or b.count('\n') == 1, 'buffer larger than size')
+            self.assertEqual(''.join(rows), ''.join(buffers), '{} rows differ when read in buffers'.format(file_type))
+
+    def test_sharded_reads(self):
+        """verify reading a file in shards returns the same rows as reading it in one pass"""
+        for file_type in ('citation', 'reference', 'author'):
+            filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config[file_type.upper()]
+            r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
+            rows = list(iter(r.read, ''))
+            r.close()
+            for shards in (2, 5, 200):
+                offsets = reader.shard_offsets(filename, shards)
+                self.assertEqual(shards + 1, len(offsets))
+                self.assertEqual(os.path.getsize(filename), offsets[-1])
+                sharded_rows = []
+                for start_offset, end_offset in zip(offsets, offsets[1:]):
+                    r = reader.StandardFileReader(file_type, filename, start_offset=start_offset, end_offset=end_offset,
+                                                  collation=self.config['TEST_DATA_COLLATION'])
+                    sharded_rows.extend(iter(r.read, ''))
+                    r.close()
+                self.assertEqual(rows, sharded_rows, '{} rows differ when read in {} shards'.format(file_type, shards))
+            r = reader.StandardFileReader(file_type, filename, collation=self.config['TEST_DATA_COLLATION'])
+            self.assertEqual(len(rows), r.count_rows())
+            r.close()
+
+    def test_process_value(self):
+        """verify values are formatted for postgres, including edge cases"""
+        filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config['CITATION']
+        r = reader.StandardFileReader('citation', filename)
+        r.close()
+        checks = ((['a', 'b'], True, False, False, '{a,b}'),
+                  (['a\tb', 'c'], True, False, False, '{a b,c}'),
+                  (['a', '', 'c'], True, False, False, '{a,0,c}'),
+                  ([], True, True, False, '{}'),
+                  (['a', '"b"', ''], True, True, False, '{"a","b",""}'),
+                  (['a b'], True, True, False, '{"a b"}'),
+                  (['0\t1\t2'], True, False, True, '{0,1,2}'),
+                  ('\t\t1\t2', True, False, True, '{1,2}'),
+                  ('Chao, C\t"Ross, G"', True, True, True, '{"Chao, C","Ross, G"}'),
+                  ('Chao, C', True, True, True, '{"Chao, C"}'),
+                  ('0.32\t0\t25\t0', False, False, False, '0.32\t0\t25\t0'),
+                  ('a\x00b', False, False, False, 'ab'),
+                  ([''], False, False, False, '0'))
+        for value, as_array, quote_value, tab_separator, expected in checks:
+            self.assertEqual(expected, r.process_value(value, as_array, quote_value, tab_separator),
+                             'bad value for {}'.format(repr(value)))
+
+    def test_binary_copy(self):
+        """verify binary copy output holds the same values as the text rows"""
+        filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config['CANONICAL']
+        r = reader.BibcodeFileReader(filename, binary=True)
+        data = ''.join(iter(lambda: r.read(4096), ''))
+        r.close()
+        with open(filename) as f:
+            bibcode = f.readline()[:-1]
+        self.assertTrue(data.startswith(pgcopy.HEADER))
+        self.assertTrue(data.endswith(pgcopy.TRAILER))
+        self.assertEqual(struct.pack('!hi19sii', 2, 19, bibcode, 4, 1), data[len(pgcopy.HEADER):len(pgcopy.HEADER) + 33])
+
+        filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config['READS']
+        r = reader.StandardFileReader('reads', filename, collation=self.config['TEST_DATA_COLLATION'])
+        text_row = r.read()
+        r.close()
+        r = reader.StandardFileReader('reads', filename, binary=True, collation=self.config['TEST_DATA_COLLATION'])
+        self.assertEqual(pgcopy.HEADER, r.read())
+        row = r.read()
+        r.close()
+        values = [int(v) for v in text_row[21:-2].split(',')]
+        # field count, bibcode, array length and header, then length and value for each element
+        self.assertEqual(struct.pack('!hi19si5i', 2, 19, text_row[:19], 20 + 8 * len(values), 1, 0, pgcopy.INT4_OID, len(values), 1),
+                         row[:49])
+        self.assertEqual(values, list(struct.unpack('!' + 'xxxxi' * len(values), row[49:])))
+
+    def test_compressed_file(self):
+        """verify a gzip column file is found and returns the same rows as the uncompressed file"""
+        filename = self.config['TEST_DATA_PATH'] + 'data1/' + self.config['CITATION']
+        r = reader.StandardFileReader('citation', filename, collation=self.config['TEST_DATA_COLLATION'])
+        rows = list(iter(r.read, ''))
+        r.close()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            compressed_filename = os.path.join(tmp_dir, 'all.links')
+            with open(filename) as f, gzip.open(compressed_filename + '.gz', 'wb') as g:
+                g.write(f.read())
+            self.assertEqual(compressed_filename + '.gz', compressed.resolve_column_file(compressed_filename))
+            r = reader.StandardFileReader('citation', compressed_filename, collation=self.config['TEST_DATA_COLLATION'])
+            self.assertEqual(rows, list(iter(r.read, '')))
+            r.close()
+            for ahead in (0, 2):
+                f = compressed.open_column_file(compressed_filename + '.gz', ahead)
+                self.assertEqual(open(filename).readlines(), list(f))
+                f.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_bad_bibcode(self):
         """bad bicode in input file should be logged and skipped and rest of file processed
 
@@ -190,7 +338,7 @@ class test_rowview_ingest(unittest.TestCase):
         file_type = 'download'
         filename = self.config['TEST_DATA_PATH'] + 'dataInvalid/'+ self.config[file_type.upper()]
         lines_in_file = sum(1 for line in open(filename))
-        r = reader.StandardFileReader(file_type, filename)
+        r = reader.StandardFileReader(file_type, filename, quarantine=False, collation=self.config['TEST_DATA_COLLATION'])
         bibcode_count = 0
         line = r.read()
         while line:
@@ -198,6 +346,92 @@ class test_rowview_ingest(unittest.TestCase):
             line = r.read()
         self.assertEqual(bibcode_count, lines_in_file-1, 'bad bibcode in file not skipped')
 
+    def test_quarantine(self):
+        """verify invalid lines are skipped and written to the quarantine file with line number and reason"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'relevance.tab')
+            with open(filename, 'w') as f:
+                f.write('2003ASPC..295..361M\t0.1\t1\t0\t3\n'
+                        '2003ASPC 295..361N\t0.1\t1\t0\t3\n'
+                        '2003AstL...29..561S\tabc\t1\t0\t3\n'
+                        '2003ASPC..295..361M\t0.2\t1\t0\t3\n'
+                        '2004ApJ...600..100A\t1e-3\t2\t0\t4\n'
+                        '2004apJ...600..101B\t.5\t2\t0\t4\n'
+                        '2003Ap.....46...88P\t0.3\t1\t0\t3\n')
+            for backend in ('file', 'mmap'):
+                r = reader.StandardFileReader('relevance', filename, backend=backend)
+                r.quarantine_path = os.path.join(tmp_dir, 'quarantine')
+                rows = list(iter(r.read, ''))
+                r.close()
+                # the bibcode out of order on the last line is loaded, the repeat of the first is not
+                self.assertEqual(['2003ASPC..295..361M', '2004ApJ...600..100A', '2004apJ...600..101B',
+                                  '2003Ap.....46...88P'], [row[:19] for row in rows])
+                self.assertEqual(3, r.quarantine_count)
+                self.assertEqual(2, r.out_of_order_count)
+                with open(os.path.join(tmp_dir, 'quarantine', tmp_dir.split(os.sep)[-1] + '_relevance.tab.quarantine')) as f:
+                    lines = f.readlines()
+                self.assertEqual('# {} from byte 0\n'.format(filename), lines[0])
+                self.assertEqual([['2', 'BAD_BIBCODE'], ['3', 'BAD_NUMBER'], ['4', 'DUPLICATE_BIBCODE']],
+                                 [line.split('\t')[:2] for line in lines[1:]])
+                self.assertEqual('4\tDUPLICATE_BIBCODE\t2003ASPC..295..361M\t0.2\t1\t0\t3\n', lines[3])
+
+            filename = os.path.join(tmp_dir, 'reads.links')
+            with open(filename, 'w') as f:
+                f.write('2003ASPC..295..361M\t1\t2\t3\n'
+                        '2003ASPC..295..361M\t4\t5\t6\n'
+                        '2003ApJ...593..561S\t1\tx\t3\n'
+                        '2004ApJ...600..100A\t\t1\t2\n')
+            r = reader.StandardFileReader('reads', filename, quarantine=False)
+            rows = list(iter(r.read, ''))
+            r.close()
+            self.assertEqual(['2004ApJ...600..100A\t{1,2}\n'], rows)
+            self.assertEqual(2, r.quarantine_count)
+            self.assertEqual(4, r.line_count)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_collation(self):
+        """verify mixed case neighbours are in order in the collation the file was sorted with"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            byte_sorted = ['1972JChPh..56.5899C', '1972JaJAP..11..411M', '1972Jabcd..11..411M']
+            filename = os.path.join(tmp_dir, 'reads.links')
+            with open(filename, 'w') as f:
+                f.writelines(['{}\t1\t2\n'.format(bibcode) for bibcode in byte_sorted])
+            # a collation that does not match the file still loads every row, and counts those out of order
+            for collation, out_of_order in (('C', 0), ('nocase', 2)):
+                r = reader.StandardFileReader('reads', filename, quarantine=False, collation=collation)
+                self.assertEqual(byte_sorted, [row[:19] for row in iter(r.read, '')])
+                self.assertEqual(0, r.quarantine_count)
+                self.assertEqual(out_of_order, r.out_of_order_count)
+                r.close()
+            r = reader.StandardFileReader('reads', filename, quarantine=False, collation='nocase', order_required=True)
+            self.assertRaises(ValueError, r.count_rows)
+            r.close()
+            # the default comes from config, column files are sorted ignoring case
+            r = reader.StandardFileReader('reads', filename, quarantine=False)
+            self.assertEqual('nocase', r.collation)
+            r.close()
+
+            # one bibcode sorting high does not affect the lines after it
+            with open(filename, 'w') as f:
+                f.writelines(['{}\t1\t2\n'.format(bibcode) for bibcode in
+                              ['1972JChPh..56.5899C', '2020ApJ...900..100A', '1972JaJAP..11..411M', '1972Jabcd..11..411M']])
+            r = reader.StandardFileReader('reads', filename, quarantine=False, collation='C')
+            self.assertEqual(4, r.count_rows())
+            self.assertEqual(1, r.out_of_order_count)
+            r.close()
+
+            with open(filename, 'w') as f:
+                f.writelines(['{}\t1\t2\n'.format(bibcode) for bibcode in sorted(byte_sorted, key=str.lower)])
+            r = reader.StandardFileReader('reads', filename, quarantine=False, collation='nocase')
+            self.assertEqual(3, r.count_rows())
+            r.close()
+            self.assertRaises(ValueError, reader.StandardFileReader, 'reads', filename, collation='fr_FR')
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
     # test entries with target (sub_type) and no title
     def test_eprint_reader(self):
@@ -243,6 +477,27 @@ class test_rowview_ingest(unittest.TestCase):
         self.datalinks_reader_test('datalinks', spot_checks, 'DATA')
 
 
+    def test_datalinks_digest(self):
+        """verify text and binary rows carry the same digest and it follows the content"""
+        filename = self.config['TEST_DATA_PATH'] + 'data1/' + \
+            [f for f in self.config['DATALINKS'] if f.endswith(',ASSOCIATED')][0].split(',')[0]
+        r = reader.DataLinksWithTitleFileReader('datalinks', filename, 'ASSOCIATED')
+        row = r.read()
+        r.close()
+        digest = row.rstrip('\n').split('\t')[-1]
+        self.assertEqual(32, len(digest))
+        r = reader.DataLinksWithTitleFileReader('datalinks', filename, 'ASSOCIATED', binary=True)
+        # the first read returns the copy header
+        r.read()
+        binary_row = r.read()
+        r.close()
+        self.assertTrue(binary_row.endswith(digest))
+        self.assertEqual(digest, reader.datalinks_digest('ASSOCIATED', 'NA', ['1825AN......4..241B', '2010AN....331..852K'],
+                                                         ['Main Paper', 'Translation'], 0))
+        self.assertNotEqual(digest, reader.datalinks_digest('ASSOCIATED', 'NA', ['1825AN......4..241B', '2010AN....331..852K'],
+                                                            ['Main Paper', 'Translated'], 0))
+
+
     def datalinks_reader_test(self, file_type, spot_checks, datalinks_file_type='', data_dir='data1/'):
         """verify standard reader creates the correct sql value
 
@@ -266,7 +521,8 @@ class test_rowview_ingest(unittest.TestCase):
         elif datalinks_file_type_main == 'DATA':
             r = reader.DataLinksWithTargetFileReader(file_type, filename, datalinks_file_type_main)
         else:
-            r = reader.DataLinksFileReader(file_type, filename, datalinks_file_type_main, datalinks_file_type_sub)
+            r = reader.DataLinksFileReader(file_type, filename, datalinks_file_type_main, datalinks_file_type_sub,
+                                           collation=self.config['TEST_DATA_COLLATION'])
         bibcode_count = 0
         line = r.read()
         spot_checks_found = []
@@ -3,10 +3,17 @@ import os, sys
 PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
 sys.path.append(PROJECT_HOME)
 import unittest
-from mock import Mock
+import shutil
+import tempfile
+from datetime import datetime
+from mock import Mock, patch
+from adsmsg import MetricsRecord, MetricsRecordList
 from adsputils import load_config, setup_logging
 from adsdata import reader
-from run import cleanup_for_master, nonbib_to_master_dict
+from adsdata.rotation import SchemaRotation
+import run
+from run import cleanup_for_master, nonbib_to_master_dict, column_file_jobs, create_joined_rows
+from run import metrics_to_master_select_fields, metrics_record_plan, fill_metrics_record, add_data_links
 
 class test_run(unittest.TestCase):
     """currently, run.py has too much code but we test it in place for now"""
@@ -34,5 +41,237 @@ class test_run(unittest.TestCase):
         d = nonbib_to_master_dict(row)
         self.assertAlmostEqual(5/2., d['citation_count_norm'], places=5)
 
+    def test_column_file_jobs(self):
+        """every column file is loaded once, largest file first"""
+        config = load_config()
+        config['DATA_PATH'] = config['TEST_DATA_PATH'] + 'data1/'
+        jobs = column_file_jobs(config, 'nonbibtest')
+        self.assertEqual(len(config['DATALINKS']) + 16, len(jobs))
+        self.assertEqual(('nonbibtest.canonical', 'canonical', config['DATA_PATH'] + config['CANONICAL'], None, None, 0, None),
+                         [job for job in jobs if job[1] == 'canonical'][0])
+        sizes = [os.path.getsize(job[2]) if os.path.exists(job[2]) else 0 for job in jobs]
+        self.assertEqual(sorted(sizes, reverse=True), sizes)
+
+        config['COPY_WORKERS'] = 4
+        config['COPY_SHARDS'] = {'citation': 3}
+        jobs = column_file_jobs(config, 'nonbibtest')
+        citation = [job for job in jobs if job[1] == 'citation']
+        self.assertEqual(3, len(citation))
+        offsets = sorted((job[5], job[6]) for job in citation)
+        self.assertEqual(0, offsets[0][0])
+        self.assertEqual(os.path.getsize(citation[0][2]), offsets[-1][1])
+        for (start, end), (next_start, next_end) in zip(offsets, offsets[1:]):
+            self.assertEqual(end, next_start)
+
+    def test_load_column_files_shards(self):
+        """a sharded file that did not load all of its rows stops the load before the row view is built"""
+        jobs = [('nonbib.citation', 'citation', 'citation.links', None, None, 0, 10),
+                ('nonbib.citation', 'citation', 'citation.links', None, None, 10, None)]
+        engine = Mock()
+        engine.url = 'postgresql://localhost/data'
+        sql_sync = Mock()
+        sql_sync.schema = 'nonbib_next'
+        with patch.object(run, 'column_file_jobs', return_value=jobs), patch.object(run, 'logger'), \
+                patch.object(run.multiprocessing, 'Pool') as pool, \
+                patch.object(run, 'sharded_row_counts', return_value={'citation.links': 5}), \
+                patch.object(run, 'record_column_files') as record_column_files, \
+                patch.object(run, 'create_joined_rows') as create_joined_rows:
+            pool.return_value.map_async.return_value.get.return_value = [2, 2]
+            self.assertRaises(ValueError, run.load_column_files, {'COPY_WORKERS': 2}, engine, 'conn', sql_sync)
+            self.assertFalse(record_column_files.called)
+            self.assertFalse(create_joined_rows.called)
+
+            pool.return_value.map_async.return_value.get.return_value = [2, 3]
+            run.load_column_files({'COPY_WORKERS': 2}, engine, 'conn', sql_sync)
+            create_joined_rows.assert_called_once_with({'COPY_WORKERS': 2}, 'conn', sql_sync, None, False)
+
+    def test_create_joined_rows(self):
+        """the row view is only updated incrementally when configured and there is a baseline"""
+        sql_sync = Mock()
+        create_joined_rows({'ROW_VIEW_INCREMENTAL': False}, 'conn', sql_sync, 'nonbibstaging')
+        sql_sync.create_joined_rows.assert_called_once_with('conn', partitions=0)
+        self.assertFalse(sql_sync.update_joined_rows.called)
+
+        sql_sync = Mock()
+        create_joined_rows({'ROW_VIEW_INCREMENTAL': True, 'ROW_VIEW_PARTITIONS': 8}, 'conn', sql_sync, 'nonbibstaging')
+        sql_sync.update_joined_rows.assert_called_once_with('conn', 'nonbibstaging', partitions=8, copy_baseline=False)
+        self.assertFalse(sql_sync.create_joined_rows.called)
+
+        sql_sync = Mock()
+        create_joined_rows({'ROW_VIEW_INCREMENTAL': True}, 'conn', sql_sync)
+        sql_sync.create_joined_rows.assert_called_once_with('conn', as_table=True, partitions=0)
+
+    def test_use_file_delta(self):
+        """the file delta needs ROW_VIEW_INCREMENTAL and the baseline files the current tables were loaded from"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            config = dict(load_config(), DATA_PATH=os.path.join(tmp_dir, 'current/'),
+                          BASELINE_DATA_PATH=os.path.join(tmp_dir, 'baseline/'), ROW_VIEW_INCREMENTAL=True)
+            os.makedirs(config['DATA_PATH'] + 'links/reads')
+            with open(config['DATA_PATH'] + config['CANONICAL'], 'w') as f:
+                f.write('2003ASPC..295..361M\n')
+            with open(config['DATA_PATH'] + config['READS'], 'w') as f:
+                f.write('2003ASPC..295..361M\t1\t2\n')
+            signatures = run.column_file_signatures(config, config['DATA_PATH'])
+            self.assertEqual(set([config['CANONICAL'], config['READS']]), set(signatures))
+            sql_sync = Mock()
+            sql_sync.get_relation_kind.return_value = 'r'
+            with patch.object(run, 'logger'), patch.object(run, 'loaded_column_files', return_value=signatures):
+                # no baseline files yet
+                self.assertFalse(run.use_file_delta(config, 'conn', sql_sync))
+                # copied after a successful run, they match what was loaded
+                run.update_baseline_files(config)
+                self.assertEqual(signatures, run.column_file_signatures(config, config['BASELINE_DATA_PATH']))
+                self.assertTrue(run.use_file_delta(config, 'conn', sql_sync))
+                self.assertFalse(run.use_file_delta(dict(config, ROW_VIEW_INCREMENTAL=False), 'conn', sql_sync))
+                # a baseline file that is not the one loaded, e.g. left from an earlier day
+                os.utime(config['BASELINE_DATA_PATH'] + config['READS'], (0, 0))
+                self.assertFalse(run.use_file_delta(config, 'conn', sql_sync))
+            with patch.object(run, 'logger'), patch.object(run, 'loaded_column_files', return_value=None):
+                run.update_baseline_files(config)
+                self.assertFalse(run.use_file_delta(config, 'conn', sql_sync))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_ingest_file_delta(self):
+        """the file delta is applied to copies in the staging schema, which is verified and swapped in"""
+        sql_sync = Mock()
+        sql_sync.schema = 'nonbib'
+        config = {'BASELINE_DATA_PATH': '', 'DELTA_STATS_SCHEMA': ''}
+        with patch.object(run, 'SchemaRotation') as rotation_class, patch.object(run, 'logger'), \
+                patch.object(run, 'use_file_delta', return_value=True), \
+                patch.object(run, 'load_column_file_deltas') as load_column_file_deltas, \
+                patch.object(run, 'record_column_files'), patch.object(run, 'load_column_files') as load_column_files:
+            rotation = rotation_class.return_value
+            staging = rotation.prepare.return_value
+            staging.schema = 'nonbib_next'
+            run.ingest_delta(config, 'engine', 'conn', sql_sync, 'nonbibstaging')
+            staging.copy_column_tables.assert_called_once_with('conn', 'nonbib')
+            staging.copy_row_view.assert_called_once_with('conn', 'nonbib')
+            load_column_file_deltas.assert_called_once_with(config, 'engine', 'conn', staging, 'nonbib')
+            self.assertFalse(load_column_files.called)
+            rotation.verify.assert_called_once_with('conn')
+            rotation.swap.assert_called_once_with('conn')
+            # the live schema is only read
+            self.assertEqual([], [c for c in sql_sync.method_calls if c[0] != 'log_delta_reasons'])
+
+            # a file the diff can not merge loads every file into a fresh staging schema
+            load_column_file_deltas.side_effect = ValueError('column file not sorted')
+            rotation.reset_mock()
+            run.ingest_delta(config, 'engine', 'conn', sql_sync, 'nonbibstaging')
+            self.assertEqual(2, rotation.prepare.call_count)
+            load_column_files.assert_called_once_with(config, 'engine', 'conn', staging, 'nonbib', copy_baseline=True)
+            staging.create_delta_rows.assert_called_once_with('conn', 'nonbib')
+            rotation.swap.assert_called_once_with('conn')
+
+    def test_record_column_files(self):
+        """the size and modification time of each loaded column file is saved with the schema"""
+        conn = Mock()
+        config = dict(load_config())
+        config['DATA_PATH'] = config['TEST_DATA_PATH'] + 'data1/'
+        run.record_column_files(config, conn, 'nonbib_next')
+        self.assertTrue(conn.execute.call_args_list[0][0][0].startswith('drop table if exists nonbib_next.column_files; '))
+        sql_command, rows = conn.execute.call_args_list[1][0]
+        self.assertEqual('insert into nonbib_next.column_files (filename, size, mtime) values (%s, %s, %s)', sql_command)
+        self.assertEqual(sorted(run.column_file_signatures(config, config['DATA_PATH']).items()),
+                         [(name, (size, mtime)) for name, size, mtime in rows])
+        self.assertTrue((config['CANONICAL'], os.path.getsize(config['DATA_PATH'] + config['CANONICAL'])) in
+                        [row[:2] for row in rows])
+
+    def test_schema_rotation(self):
+        """generations move down a slot, oldest first, and the staging schema becomes live"""
+        rotation = SchemaRotation('nonbib', 'nonbibstaging', 3)
+        self.assertEqual(['nonbib', 'nonbibstaging', 'nonbibstaging_2'], rotation.generation_names())
+        self.assertEqual(['alter schema nonbibstaging_2 rename to nonbib_retired_1',
+                          'alter schema nonbibstaging rename to nonbibstaging_2',
+                          'alter schema nonbib rename to nonbibstaging',
+                          'alter schema nonbib_next rename to nonbib'],
+                         rotation.swap_sql(set(['nonbib', 'nonbibstaging', 'nonbibstaging_2']), 'nonbib_retired_1'))
+        # first run, nothing to move but the live schema
+        self.assertEqual(['alter schema nonbib rename to nonbibstaging',
+                          'alter schema nonbib_next rename to nonbib'],
+                         rotation.swap_sql(set(['nonbib'])))
+        # the baseline is always kept
+        self.assertEqual(['nonbib', 'nonbibstaging'], SchemaRotation('nonbib', 'nonbibstaging', 1).generation_names())
+
+    metrics_row = {'bibcode': '1997BoLMe..85..475M', 'refereed': True, 'rn_citations': 0.5,
+                   'rn_citation_data': [{'bibcode': '1998PPGeo..22..553A', 'ref_norm': 0.2, 'auth_norm': 0.2,
+                                         'pubyear': 1997, 'cityear': 1998}],
+                   'rn_citations_hist': {'1998': 0.2}, 'downloads': [0, 1, 2], 'reads': [3, 4, 5],
+                   'an_citations': 0.1, 'refereed_citation_num': 1, 'citation_num': 3, 'reference_num': 3,
+                   'citations': ['2006QJRMS.132..779R', '1998PPGeo..22..553A'], 'refereed_citations': [],
+                   'author_num': 5, 'an_refereed_citations': 0.05, 'modtime': datetime(2018, 1, 2, 3, 4, 5)}
+
+    def test_fill_metrics_record(self):
+        """the field plan builds the same protobuf as MetricsRecord from a dict"""
+        row = tuple(self.metrics_row[c] for c in metrics_to_master_select_fields)
+        recs = MetricsRecordList()
+        record = fill_metrics_record(recs.metrics_records.add(), row, metrics_record_plan())
+        self.assertEqual(MetricsRecord(**dict(self.metrics_row))._data.SerializeToString(), record.SerializeToString())
+        # nulls are left unset
+        row = tuple(None if c in ('reads', 'refereed') else self.metrics_row[c] for c in metrics_to_master_select_fields)
+        record = fill_metrics_record(recs.metrics_records.add(), row, metrics_record_plan())
+        self.assertEqual([], list(record.reads))
+        self.assertFalse(record.refereed)
+
+    def test_metrics_to_master_pipeline(self):
+        """metrics rows are streamed and sent in batches sized by bytes"""
+        row = tuple(self.metrics_row[c] for c in metrics_to_master_select_fields)
+        size = MetricsRecord(**dict(self.metrics_row))._data.ByteSize()
+        engine = Mock()
+        rows = engine.connect.return_value.execution_options.return_value.execute.return_value
+        rows.fetchmany.side_effect = [[row] * 4, [row] * 3, []]
+        sent = []
+        with patch.object(run, 'task_output_metrics') as task, patch.object(run, 'logger'), \
+                patch.dict(run.config, {'MAX_ROWS': -1, 'METRICS_EXPORT_BATCH_BYTES': size * 3,
+                                        'METRICS_EXPORT_FETCH_SIZE': 4}):
+            task.delay.side_effect = lambda recs: sent.append(len(recs.metrics_records))
+            run.metrics_to_master_pipeline(engine, 'metricstest')
+        self.assertEqual([3, 3, 1], sent)
+        engine.connect.return_value.execution_options.assert_called_with(stream_results=True)
+        self.assertTrue(rows.close.called)
+
+        # a failed send stops the export and is raised
+        rows.fetchmany.side_effect = [[row] * 4, [row] * 3, []]
+        with patch.object(run, 'task_output_metrics') as task, patch.object(run, 'logger'), \
+                patch.dict(run.config, {'MAX_ROWS': -1, 'METRICS_EXPORT_BATCH_BYTES': size * 3}):
+            task.delay.side_effect = IOError('broker down')
+            self.assertRaises(IOError, run.metrics_to_master_pipeline, engine, 'metricstest')
+
+
+    def test_add_data_links(self):
+        """datalinks fields for a page of bibcodes come from one query"""
+        session = Mock()
+        session.execute.return_value = [
+            ('2004MNRAS.354L..31M', 'ESOURCE', 'ADS_PDF', ['http://articles.adsabs.harvard.edu/pdf/1825AN......4..241B'], [], 0),
+            ('1903BD....C......0A', 'DATA', 'CDS', ['http://cds'], [], 1),
+            ('2004MNRAS.354L..31M', 'ASSOCIATED', 'NA', ['1825AN......4..241B', '2010AN....331..852K'],
+             ['Main Paper', 'Translation'], 0),
+            ('1903BD....C......0A', 'DATA', 'Vizier', ['http://vizier'], [], 1),
+            ('2004MNRAS.354L..31M', 'INSPIRE', 'NA', [], [], 0),
+            ('1903BD....C......0A', 'ESOURCE', 'EPRINT_PDF', ['http://arxiv'], [], 0)]
+        flags = {'nonarticle': False, 'refereed': True, 'pub_openaccess': False, 'private': False, 'ocrabstract': False}
+        rows = [dict(flags, bibcode=bibcode) for bibcode in ('2004MNRAS.354L..31M', '1903BD....C......0A', '2018xxxx.....1..1X')]
+        with patch.dict(run.config, load_config()):
+            add_data_links(session, rows)
+        self.assertEqual(1, session.execute.call_count)
+        self.assertEqual({'bibcodes': [r['bibcode'] for r in rows]}, session.execute.call_args[0][1])
+        links, data, empty = rows
+        self.assertEqual(['ASSOCIATED', 'ESOURCE', 'INSPIRE', 'ARTICLE', 'REFEREED', 'ADS_OPENACCESS', 'OPENACCESS'],
+                         links['property'])
+        self.assertEqual(['ADS_PDF'], links['esource'])
+        self.assertEqual(([], 0), (links['data'], links['total_link_counts']))
+        self.assertEqual([{'url': ['http://articles.adsabs.harvard.edu/pdf/1825AN......4..241B'], 'title': [],
+                           'item_count': 0, 'link_type': 'ESOURCE', 'link_sub_type': 'ADS_PDF'},
+                          {'url': ['1825AN......4..241B', '2010AN....331..852K'], 'title': ['Main Paper', 'Translation'],
+                           'item_count': 0, 'link_type': 'ASSOCIATED', 'link_sub_type': 'NA'},
+                          {'url': [], 'title': [], 'item_count': 0, 'link_type': 'INSPIRE', 'link_sub_type': 'NA'}],
+                         links['data_links_rows'])
+        self.assertEqual((['CDS:1', 'Vizier:1'], 2), (data['data'], data['total_link_counts']))
+        self.assertEqual(['DATA', 'ESOURCE', 'ARTICLE', 'REFEREED', 'EPRINT_OPENACCESS', 'OPENACCESS'], data['property'])
+        self.assertEqual(['ARTICLE', 'REFEREED'], empty['property'])
+        self.assertEqual(([], [], 0, []), (empty['esource'], empty['data'], empty['total_link_counts'],
+                                           empty['data_links_rows']))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)